@@ -0,0 +1,157 @@
+"""
+Helpers shared by the benchmarks: synthetic data and latency reports.
+"""
+import io
+import json
+import time
+import uuid
+from typing import Callable, List, Optional
+import numpy as np
+import psycopg2
+from PIL import Image
+from src.sql import sql_rebuild_clusters
+
+FACENET_DIMENSION = 128
+FACES_PER_IMAGE = 4
+FACES_PER_PERSON = 5
+# Spread of the faces of one person around its centre, about 0.2 cosine distance
+PERSON_NOISE = 0.05
+
+def vector_literal(vector: np.ndarray) -> str:
+    """
+    Format a vector in pgvector's text representation.
+    """
+    return "[" + ",".join(f"{value:.6f}" for value in vector) + "]"
+
+def unit_vectors(rng: np.random.Generator, count: int) -> np.ndarray:
+    """
+    Draw random L2-normalized vectors.
+    """
+    vectors = rng.standard_normal((count, FACENET_DIMENSION)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def person_faces(rng: np.random.Generator, count: int, faces_per_person: int) -> np.ndarray:
+    """
+    Draw `count` face embeddings in groups of `faces_per_person` around a shared centre,
+    so that the faces of one synthetic person match each other as real faces would.
+    """
+    centres = np.repeat(unit_vectors(rng, (count + faces_per_person - 1) // faces_per_person), faces_per_person, axis=0)[:count]
+    faces = centres + rng.standard_normal(centres.shape).astype(np.float32) * PERSON_NOISE
+    return faces / np.linalg.norm(faces, axis=1, keepdims=True)
+
+def seed_tenant(conn: psycopg2.extensions.connection, tenant_id: str, number_of_faces: int, seed: int = 0,
+                faces_per_person: int = FACES_PER_PERSON, chunk_size: int = 10000) -> None:
+    """
+    Add `number_of_faces` synthetic faces to a tenant using COPY. Can be called several
+    times with different seeds to grow a tenant.
+
+    Every synthetic person gets a cluster and a pending review, like a person first seen
+    by /insert-image. Images get random perceptual hashes and hold up to
+    `FACES_PER_IMAGE` faces.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object.
+        tenant_id (str): The tenant ID to seed.
+        number_of_faces (int): The number of faces to add.
+        seed (int): Seed of the random generator, the same seed gives the same embeddings.
+        faces_per_person (int): The number of faces per cluster, 1 for random unrelated faces.
+        chunk_size (int): The number of faces sent per COPY, a multiple of `faces_per_person`.
+    """
+    rng = np.random.default_rng(seed)
+    chunk_size -= chunk_size % faces_per_person
+    facial_area = json.dumps({"x": 0, "y": 0, "w": 160, "h": 160})
+    start_time = time.perf_counter()
+    with conn.cursor() as cur:
+        for start in range(0, number_of_faces, chunk_size):
+            count = min(chunk_size, number_of_faces - start)
+            image_ids = [str(uuid.uuid4()) for _ in range((count + FACES_PER_IMAGE - 1) // FACES_PER_IMAGE)]
+            images = io.StringIO()
+            for image_id in image_ids:
+                images.write(f"{image_id}\t{tenant_id}\t{int(rng.integers(0, 2 ** 63)):016x}\t{vector_literal(unit_vectors(rng, 1)[0])}\n")
+            images.seek(0)
+            cur.copy_from(images, "images", columns=("id", "tenant_id", "phash", "embedding"))
+
+            # The faces of a person are spread over consecutive images
+            cluster_ids = [str(uuid.uuid4()) for _ in range((count + faces_per_person - 1) // faces_per_person)]
+            faces = io.StringIO()
+            reviews = io.StringIO()
+            for i, embedding in enumerate(person_faces(rng, count, faces_per_person)):
+                cluster_id, image_id = cluster_ids[i // faces_per_person], image_ids[i // FACES_PER_IMAGE]
+                faces.write(f"{uuid.uuid4()}\t{tenant_id}\t{image_id}\t{cluster_id}\t{facial_area}\tt\t{vector_literal(embedding)}\n")
+                if i % faces_per_person == 0:
+                    reviews.write(f"{tenant_id}\t{cluster_id}\t{image_id}\n")
+            faces.seek(0)
+            cur.copy_from(faces, "faces", columns=("id", "tenant_id", "image_id", "cluster_id", "facial_area", "is_auto_matched", "embedding"))
+            reviews.seek(0)
+            cur.copy_from(reviews, "review_pending", columns=("tenant_id", "cluster_id", "image_id"))
+            conn.commit()
+            print(f"Seeded {start + count}/{number_of_faces} faces")
+        # The faces were copied in directly, so their clusters are built afterwards
+        sql_rebuild_clusters(cur, tenant_id)
+        for table in ("images", "faces", "clusters", "review_pending"):
+            cur.execute(f"ANALYZE {table}")
+    conn.commit()
+    print(f"Seeded {number_of_faces} faces in {time.perf_counter() - start_time:.1f}s")
+
+def sample_queries(conn: psycopg2.extensions.connection, tenant_id: str, count: int, seed: int = 1) -> np.ndarray:
+    """
+    Build query embeddings for a seeded tenant: half are perturbed copies of existing
+    faces, which match, and half are random, which do not.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object.
+        tenant_id (str): The tenant ID.
+        count (int): The number of queries.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        np.ndarray: The query embeddings, one per row.
+    """
+    rng = np.random.default_rng(seed)
+    with conn.cursor() as cur:
+        cur.execute("SELECT setseed(%s)", (1 / (seed + 1),))
+        cur.execute("SELECT embedding::real[] FROM faces WHERE tenant_id = %s ORDER BY random() LIMIT %s", (tenant_id, count // 2))
+        existing = np.asarray([row[0] for row in cur.fetchall()], dtype=np.float32).reshape(-1, FACENET_DIMENSION)
+    conn.rollback()
+    hits = existing + rng.standard_normal(existing.shape).astype(np.float32) * PERSON_NOISE
+    queries = np.concatenate([hits, unit_vectors(rng, count - len(existing))])
+    rng.shuffle(queries)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+def synthetic_jpeg(rng: np.random.Generator, width: int = 1024, height: int = 768) -> bytes:
+    """
+    Encode a random but photo-sized JPEG, smooth enough to compress like a photo.
+    """
+    small = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+    image = Image.fromarray(small).resize((width, height), Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def time_calls(fn: Callable[[], object], repeat: int, warmup: int = 1) -> List[float]:
+    """
+    Call `fn` `repeat` times after `warmup` untimed calls and return the latencies in milliseconds.
+    """
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def report(name: str, latencies: List[float], elapsed: Optional[float] = None, errors: int = 0) -> None:
+    """
+    Print the latency percentiles of a run, and its throughput when the wall time is known.
+    """
+    if len(latencies) == 0:
+        print(f"{name:>24}: no successful calls, {errors} errors")
+        return
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    line = f"{name:>24}: p50 {p50:8.2f} ms  p95 {p95:8.2f} ms  p99 {p99:8.2f} ms"
+    if elapsed is not None:
+        line += f"  {len(latencies) / elapsed:8.1f} req/s"
+    if errors > 0:
+        line += f"  {errors} errors"
+    print(line)
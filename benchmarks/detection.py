@@ -0,0 +1,112 @@
+"""
+Detection time and agreement of the detection settings against the current detector.
+
+Runs `DeepFace.extract_faces` with MTCNN at full resolution, which is what the
+pipeline did before src/detection.py, then each combination of `--max-sides` and
+`--cascades` on the same images. For each it reports the latency per image, the
+faces kept at `min_confidence`, and the share of the faces found by the full
+resolution pass that it finds too (boxes overlapping by IoU 0.5 or more).
+
+Point `--images` at a directory of real photos: synthetic images have no faces, so
+they only measure the cost of the detectors.
+
+    python -m benchmarks.detection --images ~/photos --max-sides 0 1600 1024 --cascades none fallback regions
+"""
+import argparse
+import dataclasses
+import io
+import os
+from typing import Any, Dict, List
+import numpy as np
+from deepface import DeepFace
+from PIL import Image
+from benchmarks.common import report, synthetic_jpeg, time_calls
+from src.detection import CASCADES, DEFAULT_DETECTION, DetectionSettings
+from src.models import MODEL_REGISTRY
+from src.pipeline import IMAGE_EXTENSIONS
+
+MATCH_IOU = 0.5
+
+def load_images(directory: str, limit: int) -> List[np.ndarray]:
+    """
+    Decode up to `limit` images of a directory into BGR arrays, as the pipeline passes them to the detector.
+    """
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS and len(images) < limit:
+            images.append(np.asarray(Image.open(os.path.join(directory, name)).convert("RGB"))[:, :, ::-1])
+    return images
+
+def _box_iou(a: Dict[str, int], b: Dict[str, int]) -> float:
+    overlap_w = max(min(a["x"] + a["w"], b["x"] + b["w"]) - max(a["x"], b["x"]), 0)
+    overlap_h = max(min(a["y"] + a["h"], b["y"] + b["h"]) - max(a["y"], b["y"]), 0)
+    overlap = overlap_w * overlap_h
+    union = a["w"] * a["h"] + b["w"] * b["h"] - overlap
+    return overlap / union if union > 0 else 0.0
+
+def measure(name: str, detect: Any, images: List[np.ndarray], min_confidence: float, repeat: int) -> List[List[Dict[str, int]]]:
+    """
+    Time `detect` over the images and report it.
+
+    Returns:
+        list: The boxes of the faces kept in each image.
+    """
+    boxes: List[List[Dict[str, int]]] = []
+
+    def detect_kept(image: np.ndarray) -> List[Dict[str, int]]:
+        try:
+            faces = detect(image)
+        except ValueError:
+            # No face at all
+            return []
+        return [face["facial_area"] for face in faces if face["confidence"] >= min_confidence]
+
+    latencies = []
+    for image in images:
+        latencies.extend(time_calls(lambda: detect_kept(image), repeat, warmup=0))
+        boxes.append(detect_kept(image))
+    report(name, latencies)
+    return boxes
+
+def agreement(reference: List[List[Dict[str, int]]], boxes: List[List[Dict[str, int]]]) -> float:
+    """
+    The share of the reference faces that have a matching box.
+    """
+    found = sum(any(_box_iou(face, box) >= MATCH_IOU for box in image_boxes) for image_faces, image_boxes in zip(reference, boxes) for face in image_faces)
+    total = sum(len(image_faces) for image_faces in reference)
+    return found / total if total > 0 else 1.0
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="Directory of photos, synthetic images are used if omitted")
+    parser.add_argument("--limit", type=int, default=50, help="Maximum number of images")
+    parser.add_argument("--repeat", type=int, default=1, help="Timed calls per image and setting")
+    parser.add_argument("--backend", default=DEFAULT_DETECTION.backend, help="Main detector backend")
+    parser.add_argument("--prefilter", default=DEFAULT_DETECTION.prefilter_backend, help="Cheap detector backend of the cascades")
+    parser.add_argument("--max-sides", type=int, nargs="+", default=[0, 1600, 1024, 640], help="max_side values to measure, 0 for full resolution")
+    parser.add_argument("--cascades", nargs="+", choices=CASCADES, default=list(CASCADES), help="Cascades to measure")
+    args = parser.parse_args()
+
+    if args.images is not None:
+        images = load_images(args.images, args.limit)
+    else:
+        print("No --images given, using synthetic images without faces")
+        rng = np.random.default_rng(0)
+        images = [np.asarray(Image.open(io.BytesIO(synthetic_jpeg(rng, 4000, 3000))).convert("RGB"))[:, :, ::-1] for _ in range(min(args.limit, 5))]
+    megapixels = np.mean([image.shape[0] * image.shape[1] / 1e6 for image in images])
+    print(f"{len(images)} images of {megapixels:.1f} MP on average")
+
+    MODEL_REGISTRY.load()
+    min_confidence = DEFAULT_DETECTION.min_confidence
+    reference = measure(f"current {args.backend}", lambda image: DeepFace.extract_faces(img_path=image, detector_backend=args.backend), images, min_confidence, args.repeat)
+    print(f"{'':>24}  {sum(map(len, reference))} faces")
+    for cascade in args.cascades:
+        for max_side in args.max_sides:
+            settings = dataclasses.replace(DetectionSettings(), backend=args.backend, prefilter_backend=args.prefilter,
+                                           min_confidence=min_confidence, max_side=max_side, cascade=cascade)
+            name = f"{cascade} max_side {max_side}"
+            boxes = measure(name, lambda image: MODEL_REGISTRY.detect_faces(image, settings), images, min_confidence, args.repeat)
+            print(f"{'':>24}  {sum(map(len, boxes))} faces, finds {agreement(reference, boxes):.1%} of the current ones")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Load generator for the HTTP API.
+
+Drives every endpoint of main.py against a running server with `--concurrency`
+requests in flight and reports the throughput and latency percentiles of each. A
+throwaway tenant is filled through /insert-image first, so the read endpoints have
+data to return; the endpoints that delete data run last and the tenant is deleted
+at the end.
+
+Start the server with `fake_models = true` under `[inference]` to measure the service
+without the cost of the face models, and run `python -m src.worker` alongside it for
+/insert-image-async jobs to complete.
+
+    python -m benchmarks.load --url http://localhost:8000 --token <token> --concurrency 16 --requests 500
+"""
+import argparse
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+import numpy as np
+import requests
+from benchmarks.common import report, synthetic_jpeg
+
+BULK_BATCH_SIZE = 8
+
+class LoadGenerator:
+    """
+    Sends requests to the API from a pool of threads, each with its own HTTP session.
+    """
+
+    def __init__(self, url: str, token: str, tenant_id: str, concurrency: int) -> None:
+        self.url = url.rstrip("/")
+        self.headers = {"token": token}
+        self.tenant_id = tenant_id
+        self.concurrency = concurrency
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session.request(method, self.url + path, headers=self.headers, timeout=300, **kwargs)
+
+    def run(self, name: str, call: Callable[[int], requests.Response], count: int) -> List[requests.Response]:
+        """
+        Make `count` calls with `concurrency` in flight and report them.
+
+        Args:
+            name (str): The name of the scenario.
+            call (Callable[[int], requests.Response]): Sends the i-th request.
+            count (int): The number of requests.
+
+        Returns:
+            list: The successful responses.
+        """
+        latencies: List[float] = []
+        responses: List[requests.Response] = []
+        errors = []
+
+        def timed_call(i: int) -> None:
+            start = time.perf_counter()
+            try:
+                response = call(i)
+            except requests.RequestException as e:
+                errors.append(str(e))
+                return
+            elapsed = (time.perf_counter() - start) * 1000
+            if response.ok:
+                latencies.append(elapsed)
+                responses.append(response)
+            else:
+                errors.append(f"{response.status_code} {response.text[:200]}")
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            list(executor.map(timed_call, range(count)))
+        report(name, latencies, time.perf_counter() - start, len(errors))
+        if len(errors) > 0:
+            print(f"{'':>24}  first error: {errors[0]}")
+        return responses
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000", help="Base URL of the API")
+    parser.add_argument("--token", required=True, help="Authentication token from config.toml")
+    parser.add_argument("--tenant-id", default=f"bench_load_{uuid.uuid4().hex[:8]}", help="Throwaway tenant to use, deleted at the end")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    parser.add_argument("--images", type=int, default=100, help="Distinct synthetic images uploaded first")
+    parser.add_argument("--heavy-requests", type=int, default=5, help="Requests for the tenant-wide endpoints, /recluster")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    images = [synthetic_jpeg(rng) for _ in range(args.images)]
+    load = LoadGenerator(args.url, args.token, args.tenant_id, args.concurrency)
+    tenant = {"tenant_id": args.tenant_id}
+
+    def upload(path: str, data: bytes, on_duplicate: str) -> requests.Response:
+        return load.request("POST", path, data={**tenant, "on_duplicate": on_duplicate}, files={"image": ("image.jpg", data, "image/jpeg")})
+
+    load.run("GET /ready", lambda i: load.request("GET", "/ready"), args.requests)
+
+    # Writes: fill the tenant, then re-upload the same images to exercise deduplication
+    inserted = load.run("POST /insert-image", lambda i: upload("/insert-image", images[i], "process"), len(images))
+    load.run("POST /insert-image process", lambda i: upload("/insert-image", images[i % len(images)], "process"), args.requests)
+    load.run("POST /insert-image return", lambda i: upload("/insert-image", images[i % len(images)], "return"), args.requests)
+    load.run("POST /insert-images", lambda i: load.request("POST", "/insert-images", data=tenant, files=[
+        ("images", (f"{j}.jpg", images[(i * BULK_BATCH_SIZE + j) % len(images)], "image/jpeg")) for j in range(BULK_BATCH_SIZE)
+    ]), max(args.requests // BULK_BATCH_SIZE, 1))
+    jobs = load.run("POST /insert-image-async", lambda i: upload("/insert-image-async", images[i % len(images)], "process"), args.requests)
+    job_ids = [response.json()["job_id"] for response in jobs]
+    load.run("GET /jobs/{job_id}", lambda i: load.request("GET", f"/jobs/{job_ids[i % len(job_ids)]}", params=tenant), args.requests if job_ids else 0)
+
+    image_ids = [response.json()["image_id"] for response in inserted]
+    faces: List[Tuple[str, str]] = [item for response in inserted for item in response.json()["face_ids"].items()]
+    if len(image_ids) == 0 or len(faces) == 0:
+        print("No images with faces were inserted, skipping the read endpoints")
+        load.request("DELETE", "/tenant", data=tenant)
+        return
+    cluster_ids = sorted({cluster_id for _, cluster_id in faces})
+    reviews = load.request("GET", "/review-pending-list", params={**tenant, "limit": 1000}).json()["items"]
+
+    # Reads
+    load.run("GET /face", lambda i: load.request("GET", "/face", params={**tenant, "face_id": faces[i % len(faces)][0]}), args.requests)
+    load.run("GET /faces", lambda i: load.request("GET", "/faces", params={**tenant, "image_id": image_ids[i % len(image_ids)]}), args.requests)
+    load.run("GET /cluster", lambda i: load.request("GET", "/cluster", params={**tenant, "cluster_id": cluster_ids[i % len(cluster_ids)]}), args.requests)
+    load.run("GET /images", lambda i: load.request("GET", "/images", params={**tenant, "cluster_id": cluster_ids[i % len(cluster_ids)]}), args.requests)
+    load.run("GET /image", lambda i: load.request("GET", "/image", params={**tenant, "image_id": image_ids[i % len(image_ids)]}), args.requests)
+    load.run("GET /face-batch", lambda i: load.request("GET", "/face-batch", params={**tenant, "face_id": [face[0] for face in faces[i % len(faces):][:50]]}), args.requests)
+    load.run("GET /cluster-batch", lambda i: load.request("GET", "/cluster-batch", params={**tenant, "cluster_id": cluster_ids[i % len(cluster_ids):][:50]}), args.requests)
+    load.run("GET /image-batch", lambda i: load.request("GET", "/image-batch", params={**tenant, "image_id": image_ids[i % len(image_ids):][:50]}), args.requests)
+    load.run("GET /similar-images", lambda i: load.request("GET", "/similar-images", params={**tenant, "image_id": image_ids[i % len(image_ids):][:4]}), args.requests)
+    load.run("GET /review-pending-list", lambda i: load.request("GET", "/review-pending-list", params={**tenant, "limit": 100}), args.requests)
+    if len(reviews) > 0:
+        load.run("GET /review-pending", lambda i: load.request("GET", "/review-pending", data={**tenant, "review_id": reviews[i % len(reviews)]["id"]}), args.requests)
+    load.run("GET /metrics", lambda i: load.request("GET", "/metrics"), args.requests)
+    load.run("GET /debug/profiler", lambda i: load.request("GET", "/debug/profiler"), args.requests)
+
+    # Updates
+    load.run("POST /update-face-cluster", lambda i: load.request("POST", "/update-face-cluster", data={
+        **tenant, "face_id": faces[i % len(faces)][0], "to_cluster_id": cluster_ids[(i + 1) % len(cluster_ids)],
+    }), min(args.requests, len(faces)))
+    load.run("POST /recluster", lambda i: load.request("POST", "/recluster", data={**tenant, "apply": "false"}), args.heavy_requests)
+
+    # Deletes, each consumes its own share of the data
+    quarter = max(len(image_ids) // 4, 1)
+    load.run("DELETE /review-pending", lambda i: load.request("DELETE", "/review-pending", data={**tenant, "review_id": reviews[i]["id"]}), min(args.requests, len(reviews)))
+    load.run("DELETE /face", lambda i: load.request("DELETE", "/face", data={**tenant, "face_id": faces[i][0]}), min(args.requests, len(faces) // 4))
+    load.run("DELETE /image", lambda i: load.request("DELETE", "/image", data={**tenant, "image_id": image_ids[quarter + i]}), min(args.requests, quarter))
+    load.run("DELETE /cluster", lambda i: load.request("DELETE", "/cluster", data={**tenant, "cluster_id": cluster_ids[-1 - i]}), min(args.requests, len(cluster_ids) // 4))
+    load.run("DELETE /tenant", lambda i: load.request("DELETE", "/tenant", data=tenant), 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Compare face matching latency with and without the vector index.
+
+Seeds a synthetic tenant with random embeddings, then times the original exact CTE
+query against `sql_check_matching_faces` with the vector index in place.
+
+    python -m benchmarks.matching_latency --faces 1000000 --queries 200
+"""
+import argparse
+import time
+from typing import Callable, List
+import numpy as np
+import psycopg2
+from benchmarks.common import FACENET_DIMENSION, report, seed_tenant
+from src.sql import sql_check_matching_faces
+from src.utils import get_db_connection
+
+SIMILARITY_THRESHOLD = 0.85
+
+def exact_match(cur: psycopg2.extensions.cursor, tenant_id: str, embedding: List[float], similarity_threshold: float) -> list:
+    """
+    The matching query as it was before the vector index existed.
+    """
+    # Without any index on faces, Postgres could only scan the whole table
+    cur.execute("SET LOCAL enable_indexscan = off; SET LOCAL enable_bitmapscan = off")
+    cur.execute("""
+        WITH RankedFaces AS (
+            SELECT id, cluster_id, embedding <=> %s::vector AS distance
+            FROM faces
+            WHERE tenant_id = %s
+        )
+        SELECT id, cluster_id, distance
+        FROM RankedFaces
+        WHERE distance <= %s
+        ORDER BY distance
+        LIMIT 1
+    """, (embedding, tenant_id, similarity_threshold))
+    return cur.fetchall()
+
+def time_queries(conn: psycopg2.extensions.connection, tenant_id: str, queries: np.ndarray, match: Callable) -> List[float]:
+    """
+    Run `match` once per query vector and return the latencies in milliseconds.
+    """
+    latencies = []
+    with conn.cursor() as cur:
+        for query in queries:
+            start = time.perf_counter()
+            match(cur, tenant_id, query.tolist(), SIMILARITY_THRESHOLD)
+            latencies.append((time.perf_counter() - start) * 1000)
+            conn.rollback()
+    return latencies
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenant-id", default="bench_matching", help="Tenant to seed and query")
+    parser.add_argument("--faces", type=int, default=1_000_000, help="Number of faces to seed")
+    parser.add_argument("--queries", type=int, default=200, help="Number of timed queries per variant")
+    parser.add_argument("--skip-seed", action="store_true", help="Reuse an already seeded tenant")
+    parser.add_argument("--cleanup", action="store_true", help="Delete the tenant when done")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if not args.skip_seed:
+            seed_tenant(conn, args.tenant_id, args.faces, faces_per_person=1)
+        queries = np.random.default_rng(1).standard_normal((args.queries, FACENET_DIMENSION))
+        report("before", time_queries(conn, args.tenant_id, queries, exact_match))
+        report("after", time_queries(conn, args.tenant_id, queries, sql_check_matching_faces))
+        if args.cleanup:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM faces WHERE tenant_id = %s", (args.tenant_id,))
+                cur.execute("DELETE FROM images WHERE tenant_id = %s", (args.tenant_id,))
+                cur.execute("DELETE FROM clusters WHERE tenant_id = %s", (args.tenant_id,))
+                cur.execute("DELETE FROM review_pending WHERE tenant_id = %s", (args.tenant_id,))
+            conn.commit()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
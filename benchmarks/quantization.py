@@ -0,0 +1,117 @@
+"""
+Recall and latency of the quantized vector indexes against exact search.
+
+Matches the same query faces with every quantization whose indexes exist (see
+postgres/migrations/007_quantized_indexes.sql) and several rerank candidate counts,
+and compares each best match with the one found by an exact scan. Also prints the
+size of every vector index, summed over the partitions.
+
+    python -m benchmarks.quantization --faces 1000000 --rerank 10 40 100
+"""
+import argparse
+import time
+from typing import List, Optional, Tuple
+import psycopg2
+import src.sql
+from benchmarks.common import report, sample_queries, seed_tenant
+from benchmarks.matching_latency import exact_match
+from src.sql import sql_match_faces
+from src.utils import get_db_connection
+
+SIMILARITY_THRESHOLD = 0.85
+# The faces index of each quantization, its presence decides whether it is measured
+QUANTIZATION_INDEXES = {
+    "none": "faces_embedding_hnsw_idx",
+    "halfvec": "faces_embedding_halfvec_hnsw_idx",
+    "binary": "faces_embedding_binary_hnsw_idx",
+}
+CLUSTER_INDEXES = ("clusters_embedding_sum_hnsw_idx", "clusters_embedding_sum_halfvec_hnsw_idx", "clusters_embedding_sum_binary_hnsw_idx")
+
+def index_size(cur: psycopg2.extensions.cursor, index: str) -> Optional[int]:
+    """
+    Measure an index in bytes, over all of its partitions, or None if it does not exist.
+    """
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (index,))
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute("SELECT sum(pg_relation_size(relid)) FROM pg_partition_tree(%s::regclass)", (index,))
+    return int(cur.fetchone()[0] or 0)
+
+def exact_matches(conn: psycopg2.extensions.connection, tenant_id: str, queries: List[List[float]]) -> List[Optional[str]]:
+    """
+    Find the best match of each query within the threshold with an exact scan.
+    """
+    matches = []
+    with conn.cursor() as cur:
+        for query in queries:
+            rows = exact_match(cur, tenant_id, query, SIMILARITY_THRESHOLD)
+            matches.append(rows[0][0] if len(rows) > 0 else None)
+            conn.rollback()
+    return matches
+
+def approximate_matches(conn: psycopg2.extensions.connection, tenant_id: str, queries: List[List[float]]) -> Tuple[List[Optional[str]], List[float]]:
+    """
+    Match each query with `sql_match_faces` as configured, returning the matched face IDs and the latencies in milliseconds.
+    """
+    matches, latencies = [], []
+    with conn.cursor() as cur:
+        for query in queries:
+            start = time.perf_counter()
+            match = sql_match_faces(cur, tenant_id, [query], SIMILARITY_THRESHOLD)[0]
+            latencies.append((time.perf_counter() - start) * 1000)
+            matches.append(match[0] if match is not None else None)
+            conn.rollback()
+    return matches, latencies
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenant-id", default="bench_quantization", help="Tenant to seed and query")
+    parser.add_argument("--faces", type=int, default=1_000_000, help="Number of faces to seed")
+    parser.add_argument("--queries", type=int, default=200, help="Number of query faces")
+    parser.add_argument("--rerank", type=int, nargs="+", default=[10, 40, 100], help="rerank_candidates values to measure the quantized indexes with")
+    parser.add_argument("--strategy", choices=["faces", "centroids"], default="faces", help="Matching strategy, \"faces\" measures the faces index alone")
+    parser.add_argument("--skip-seed", action="store_true", help="Reuse an already seeded tenant")
+    parser.add_argument("--cleanup", action="store_true", help="Delete the tenant when done")
+    args = parser.parse_args()
+
+    # Matches must come from Postgres, not from the in-process cache
+    src.sql.EMBEDDING_CACHE.enabled = False
+    src.sql.MATCHING_STRATEGY = args.strategy
+    conn = get_db_connection()
+    try:
+        if not args.skip_seed:
+            seed_tenant(conn, args.tenant_id, args.faces)
+        with conn.cursor() as cur:
+            sizes = {index: index_size(cur, index) for index in list(QUANTIZATION_INDEXES.values()) + list(CLUSTER_INDEXES)}
+        conn.rollback()
+        for index, size in sizes.items():
+            if size is not None:
+                print(f"{index:>40}: {size / 2 ** 20:10.1f} MiB")
+
+        queries = sample_queries(conn, args.tenant_id, args.queries).tolist()
+        exact = exact_matches(conn, args.tenant_id, queries)
+        print(f"{sum(match is not None for match in exact)} of {len(queries)} queries have a match within {SIMILARITY_THRESHOLD}")
+        for quantization, index in QUANTIZATION_INDEXES.items():
+            if sizes[index] is None:
+                print(f"{quantization}: {index} does not exist, skipped")
+                continue
+            src.sql.MATCHING_QUANTIZATION = quantization
+            for rerank in ([None] if quantization == "none" else args.rerank):
+                if rerank is not None:
+                    src.sql.MATCHING_RERANK_CANDIDATES = rerank
+                matches, latencies = approximate_matches(conn, args.tenant_id, queries)
+                recall = sum(match == truth for match, truth in zip(matches, exact)) / len(queries)
+                name = quantization if rerank is None else f"{quantization} rerank {rerank}"
+                report(name, latencies)
+                print(f"{'':>24}  recall@1 {recall:.3f}")
+    finally:
+        if args.cleanup:
+            conn.rollback()
+            with conn.cursor() as cur:
+                for table in ("faces", "images", "clusters", "review_pending"):
+                    cur.execute(f"DELETE FROM {table} WHERE tenant_id = %s", (args.tenant_id,))
+            conn.commit()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Scale scenarios: how matching and the listing queries degrade as a tenant grows.
+
+Grows a synthetic tenant through each of `--sizes` faces (10k, 100k and 1M by
+default). At each size it times `sql_check_matching_faces` under both matching
+strategies, and the first and a deep page of each keyset paginated listing, with
+the same queries at every size so the rows are comparable.
+
+    python -m benchmarks.scale --sizes 10000 100000 1000000 --queries 200 --cleanup
+"""
+import argparse
+from typing import Callable, List
+import psycopg2
+import src.sql
+from benchmarks.common import report, sample_queries, seed_tenant, time_calls
+from src.sql import (sql_check_matching_faces, sql_get_cluster_images, sql_get_faces, sql_get_image_phashes,
+                     sql_get_review_list, sql_get_similar_images)
+from src.utils import get_db_connection
+
+SIMILARITY_THRESHOLD = 0.85
+PAGE_SIZE = 100
+SIMILAR_IMAGES_BATCH = 4
+SIMILAR_IMAGES_MAX_DISTANCE = 6
+
+def _time_query(conn: psycopg2.extensions.connection, query: Callable[[psycopg2.extensions.cursor, int], object], repeat: int) -> List[float]:
+    """
+    Time `query(cur, i)` for i in range(repeat), each in its own transaction.
+    """
+    calls = iter(range(repeat + 1))
+    with conn.cursor() as cur:
+        def call() -> None:
+            query(cur, next(calls))
+            conn.rollback()
+        return time_calls(call, repeat)
+
+def _sample_column(conn: psycopg2.extensions.connection, sql: str, tenant_id: str, count: int) -> list:
+    with conn.cursor() as cur:
+        cur.execute(sql, (tenant_id, count))
+        values = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    return values
+
+def measure(conn: psycopg2.extensions.connection, tenant_id: str, repeat: int) -> None:
+    """
+    Time matching and the listings against the tenant as it is now.
+    """
+    queries = sample_queries(conn, tenant_id, repeat)
+    configured_strategy = src.sql.MATCHING_STRATEGY
+    try:
+        for strategy in ("faces", "centroids"):
+            src.sql.MATCHING_STRATEGY = strategy
+            report(f"match ({strategy})", _time_query(conn, lambda cur, i: sql_check_matching_faces(cur, tenant_id, queries[i % len(queries)].tolist(), SIMILARITY_THRESHOLD), repeat))
+    finally:
+        src.sql.MATCHING_STRATEGY = configured_strategy
+
+    image_ids = _sample_column(conn, "SELECT id FROM images WHERE tenant_id = %s ORDER BY random() LIMIT %s", tenant_id, repeat)
+    cluster_ids = _sample_column(conn, "SELECT id FROM clusters WHERE tenant_id = %s ORDER BY random() LIMIT %s", tenant_id, repeat)
+    # The last page of the review list, where OFFSET pagination would scan every earlier row
+    with conn.cursor() as cur:
+        cur.execute("SELECT max(id) FROM review_pending WHERE tenant_id = %s", (tenant_id,))
+        deep_review_id = (cur.fetchone()[0] or 0) - PAGE_SIZE
+    conn.rollback()
+
+    report("review list page 1", _time_query(conn, lambda cur, i: sql_get_review_list(cur, tenant_id, PAGE_SIZE + 1, None), repeat))
+    report("review list deep page", _time_query(conn, lambda cur, i: sql_get_review_list(cur, tenant_id, PAGE_SIZE + 1, deep_review_id), repeat))
+    report("faces of image", _time_query(conn, lambda cur, i: sql_get_faces(cur, tenant_id, image_ids[i % len(image_ids)], PAGE_SIZE + 1, None), repeat))
+    report("images of cluster", _time_query(conn, lambda cur, i: sql_get_cluster_images(cur, tenant_id, cluster_ids[i % len(cluster_ids)], PAGE_SIZE + 1, None), repeat))
+
+    def similar_images(cur: psycopg2.extensions.cursor, i: int) -> None:
+        batch = image_ids[i % len(image_ids):][:SIMILAR_IMAGES_BATCH]
+        sql_get_similar_images(cur, tenant_id, sql_get_image_phashes(cur, tenant_id, batch), SIMILAR_IMAGES_MAX_DISTANCE)
+    report("similar images", _time_query(conn, similar_images, repeat))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenant-id", default="bench_scale", help="Tenant to seed and query")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="Numbers of faces to measure at, in increasing order")
+    parser.add_argument("--queries", type=int, default=100, help="Timed calls per query and size")
+    parser.add_argument("--skip-seed", action="store_true", help="Measure an already seeded tenant once, at its current size")
+    parser.add_argument("--cleanup", action="store_true", help="Delete the tenant when done")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if args.skip_seed:
+            measure(conn, args.tenant_id, args.queries)
+            return
+        seeded = 0
+        for step, size in enumerate(sorted(args.sizes)):
+            seed_tenant(conn, args.tenant_id, size - seeded, seed=step)
+            seeded = size
+            print(f"--- {size} faces ---")
+            measure(conn, args.tenant_id, args.queries)
+    finally:
+        if args.cleanup:
+            conn.rollback()
+            with conn.cursor() as cur:
+                for table in ("faces", "images", "clusters", "review_pending"):
+                    cur.execute(f"DELETE FROM {table} WHERE tenant_id = %s", (args.tenant_id,))
+            conn.commit()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Micro-benchmarks of the stages of the insert pipeline.
+
+Times decoding, perceptual hashing, face detection, embedding at several batch
+sizes and, given a seeded tenant, face matching. Detection and embedding use the
+real models unless `--fake-models` is passed, in which case the deterministic
+stand-in from src/models.py is used and those two stages measure only its overhead.
+
+    python -m benchmarks.stages --repeat 50
+    python -m benchmarks.stages --fake-models --tenant-id bench_scale
+"""
+import argparse
+import io
+import imagehash
+import numpy as np
+from PIL import Image
+from benchmarks.common import report, synthetic_jpeg, time_calls, unit_vectors
+from src.models import MODEL_REGISTRY, FakeModelRegistry
+from src.sql import sql_match_faces
+from src.utils import get_db_connection
+
+SIMILARITY_THRESHOLD = 0.85
+EMBEDDING_BATCH_SIZES = (1, 8, 32)
+MATCHING_BATCH_SIZES = (1, 4, 16)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20, help="Timed calls per stage")
+    parser.add_argument("--width", type=int, default=1024, help="Width of the synthetic images")
+    parser.add_argument("--height", type=int, default=768, help="Height of the synthetic images")
+    parser.add_argument("--fake-models", action="store_true", help="Use the deterministic stand-in instead of the face models")
+    parser.add_argument("--tenant-id", help="Seeded tenant to time matching against, see benchmarks.scale")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = synthetic_jpeg(rng, args.width, args.height)
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    pixels = np.asarray(image)
+    registry = FakeModelRegistry() if args.fake_models else MODEL_REGISTRY
+    registry.load()
+    print(f"{args.width}x{args.height} JPEG of {len(data) / 1024:.0f} KiB, {'fake' if args.fake_models else 'real'} models")
+
+    report("decode", time_calls(lambda: Image.open(io.BytesIO(data)).convert("RGB"), args.repeat))
+    report("phash", time_calls(lambda: imagehash.phash(image), args.repeat))
+    def detect() -> None:
+        try:
+            registry.detect_faces(pixels[:, :, ::-1])
+        except ValueError:
+            # The synthetic image has no face for the real detector to find
+            pass
+    report("detection", time_calls(detect, args.repeat))
+    crop = rng.random((160, 160, 3), dtype=np.float32)
+    for batch_size in EMBEDDING_BATCH_SIZES:
+        report(f"embedding x{batch_size}", time_calls(lambda: registry.embed_faces([crop] * batch_size), args.repeat))
+
+    if args.tenant_id is not None:
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                for batch_size in MATCHING_BATCH_SIZES:
+                    def match() -> None:
+                        sql_match_faces(cur, args.tenant_id, unit_vectors(rng, batch_size).tolist(), SIMILARITY_THRESHOLD)
+                        conn.rollback()
+                    report(f"matching x{batch_size}", time_calls(match, args.repeat))
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    main()
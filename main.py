@@ -1,100 +1,536 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Header
-import shutil
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Header, Query, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
+from contextlib import asynccontextmanager
+import asyncio
+import json
 import os
+import psycopg2
+import shutil
+import tempfile
+import time
 import uuid
-from deepface import DeepFace
 import uvicorn
-import imagehash
-from PIL import Image
 import toml
-import json
-from typing import List, Dict, Union
+from typing import Any, AsyncIterator, BinaryIO, Callable, Iterator, List, Dict, Optional, Set, Tuple, Union
 from src.sql import *
-from src.utils import db_transaction
+from src.utils import db_transaction, verify_token, get_db_connection, get_db_pool, close_db_pool, encode_cursor, decode_cursor
+from src.models import MODEL_REGISTRY
+from src.inference import inference_queue_size, run_inference, shutdown_inference_executor
+from src.batching import EMBEDDING_BATCHER
+from src.reclustering import RECLUSTER_JOB_KIND
+from src.transfer import export_tenant, iter_tar
+from src.metrics import DUPLICATE_UPLOADS, HTTP_REQUEST_SECONDS, finish_request_timings, register_runtime_collector, start_request_timings
+from src.profiler import PROFILER
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from src.pipeline import DecodedUpload, ImageAnalysis, analyze_image, decode_upload, find_duplicate, hash_content, iter_archive, load_models, save_upload, store_analyses
+from src.pipeline import DEDUP_ENABLED, DEDUP_DEFAULT_ACTION, DEDUP_PHASH_DISTANCE, SIMILARITY_THRESHOLD
+from src.detection import detection_settings
+from src.image_embedding import BACKFILL_JOB_KIND, image_embedding_settings
+from src.crops import remove_crops
+from src.reembedding import REEMBED_JOB_KIND
 
 # Load configuration from config.toml
 config = toml.load("config.toml")
 UPLOAD_DIR = config["paths"]["upload_dir"]
+BULK_CONFIG = config.get("bulk", {})
+BULK_CONCURRENCY = BULK_CONFIG.get("concurrency", 8)
+BULK_WRITE_BATCH_SIZE = BULK_CONFIG.get("write_batch_size", 32)
+BULK_MAX_FILES = BULK_CONFIG.get("max_files", 256)
+SIMILAR_IMAGES_MAX_DISTANCE = config.get("similar_images", {}).get("max_distance", 6)
+HTTP_CONFIG = config.get("http", {})
+HTTP_GZIP = HTTP_CONFIG.get("gzip", False)
+HTTP_GZIP_MIN_SIZE = HTTP_CONFIG.get("gzip_min_size", 1024)
+MAX_BATCH_IDS = HTTP_CONFIG.get("max_batch_ids", 500)
+JOB_METRICS_INTERVAL = config.get("metrics", {}).get("jobs_interval", 15.0)
+
+MAX_PAGE_SIZE = 1000
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the models in the background so the process comes up immediately and
+    # /ready can report when it is able to serve inference requests. Inserts are
+    # refused with 503 until then, see `_require_models`.
+    app.state.model_load = asyncio.get_running_loop().run_in_executor(None, load_models)
+    app.state.model_load.add_done_callback(_report_model_load)
+    get_db_pool()
+    job_counter = asyncio.create_task(_count_jobs_periodically()) if JOB_METRICS_INTERVAL > 0 else None
+    yield
+    if job_counter is not None:
+        job_counter.cancel()
+    shutdown_inference_executor()
+    close_db_pool()
+
+app = FastAPI(lifespan=lifespan)
+
+def _report_model_load(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Could not load the models: {future.exception()}")
+
+def _require_models() -> None:
+    """
+    Refuse a request that runs inference until the models are loaded, instead of
+    making it wait for the load on an inference thread.
+    
+    Raises:
+        HTTPException: 503 while the models are loading or if they failed to load.
+    """
+    if not MODEL_REGISTRY.is_ready():
+        raise HTTPException(status_code=503, detail="The models are still loading" if MODEL_REGISTRY.error is None else f"The models failed to load: {MODEL_REGISTRY.error}")
+
+if HTTP_GZIP:
+    # Only for clients that send Accept-Encoding: gzip
+    app.add_middleware(GZipMiddleware, minimum_size=HTTP_GZIP_MIN_SIZE)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next: Callable) -> Response:
+    """
+    Time every request by route and status, and add the timings of the pipeline stages
+    it went through as a Server-Timing header when `[metrics] server_timing` is on.
+    """
+    timings_token = start_request_timings()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.labels(request.method, route.path if route is not None else "unmatched", str(status)).observe(time.perf_counter() - start)
+        server_timing = finish_request_timings(timings_token)
+    if server_timing is not None:
+        response.headers["Server-Timing"] = server_timing
+    return response
+
+# Job counts by status, refreshed by `_count_jobs_periodically`, None until the first count
+_job_counts: Optional[Dict[str, int]] = None
+
+def _count_jobs(conn: psycopg2.extensions.connection) -> Dict[str, int]:
+    with conn.cursor() as cur:
+        counts = sql_count_jobs(cur)
+    conn.rollback()
+    return counts
 
-MIN_FACE_CONFIDENCE = 0.9
-FACENET_DIMENSION = 128
-SIMILARITY_THRESHOLD = 0.85
+async def _count_jobs_periodically() -> None:
+    """
+    Count the jobs by status every `[metrics] jobs_interval` seconds for /metrics, on
+    a connection of its own: a scrape never waits for the pool nor takes a connection
+    from requests.
+    """
+    global _job_counts
+    conn: Optional[psycopg2.extensions.connection] = None
+    try:
+        while True:
+            try:
+                if conn is None:
+                    conn = await run_in_threadpool(get_db_connection)
+                _job_counts = await run_in_threadpool(_count_jobs, conn)
+            except psycopg2.Error:
+                # Left out of /metrics until the database answers again
+                _job_counts = None
+                if conn is not None:
+                    conn.close()
+                    conn = None
+            await asyncio.sleep(JOB_METRICS_INTERVAL)
+    finally:
+        if conn is not None:
+            conn.close()
 
-app = FastAPI()
+def _runtime_metrics() -> Tuple[Optional[dict], Optional[int], Optional[int], Optional[dict]]:
+    """
+    Read the pool and queue state reported by /metrics, without touching the database.
+    
+    Returns:
+        tuple: The pool statistics, the embedding batcher and inference executor queue sizes, and the last job counts.
+    """
+    pool = get_db_pool()
+    return dict(pool.stats, max_size=pool.max_size), EMBEDDING_BATCHER.pending, inference_queue_size(), _job_counts
+
+register_runtime_collector(_runtime_metrics)
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 @app.post("/insert-image")
-async def insert_image(tenant_id: str = Form(...), image: UploadFile = File(...), token: str = Header(...)) -> Dict[str, Union[str, Dict[str, str]]]:
+async def insert_image(tenant_id: str = Form(...), image: UploadFile = File(...), on_duplicate: str = Form(DEDUP_DEFAULT_ACTION), token: str = Header(...)) -> Dict[str, Union[str, Dict[str, str]]]:
     """
     Insert a new image and its associated faces into the database.
     
     Args:
         tenant_id (str): The tenant ID.
         image (UploadFile): The uploaded image file.
+        on_duplicate (str): What to do when the image was already uploaded to the tenant: "return" the
+            existing image, "reuse" its faces and embeddings for a new image, or "process" it again.
+        token (str): The authentication token.
+    
+    Returns:
+        dict: The image ID and face IDs, and the ID of the existing image if the upload is a duplicate.
+    """
+    verify_token(token)
+    _require_models()
+    if on_duplicate not in ("return", "reuse", "process"):
+        raise HTTPException(status_code=400, detail="on_duplicate must be one of return, reuse or process")
+
+    image_id = str(uuid.uuid4())
+    data = await image.read()
+    try:
+        upload = None
+        if DEDUP_ENABLED and on_duplicate != "process":
+            # Exact re-uploads are found without decoding the image at all
+            content_sha256 = await run_in_threadpool(hash_content, data)
+            duplicate_of = await run_in_threadpool(_find_duplicate, token, tenant_id, content_sha256, None)
+            if duplicate_of is None and DEDUP_PHASH_DISTANCE > 0:
+                upload = await run_inference(decode_upload, data, content_sha256)
+                duplicate_of = await run_in_threadpool(_find_duplicate, token, tenant_id, content_sha256, upload.phash)
+            if duplicate_of is not None:
+                return await _insert_duplicate(token, tenant_id, image_id, data, duplicate_of, on_duplicate, content_sha256, upload)
+        analysis = await _analyze_upload(tenant_id, data, image_id, upload)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    face_ids = (await run_in_threadpool(_store_images, token, tenant_id, [(image_id, analysis)]))[image_id]
+    return {
+      "image_id": image_id, 
+      "face_ids": face_ids
+    }
+
+def _find_duplicate(token: str, tenant_id: str, content_sha256: str, phash: Optional[str]) -> Optional[str]:
+    """
+    Look for an existing image of the tenant that an upload duplicates.
+    
+    Args:
         token (str): The authentication token.
+        tenant_id (str): The tenant ID.
+        content_sha256 (str): The SHA-256 of the upload.
+        phash (Optional[str]): The perceptual hash of the upload, to also look for near-duplicates.
     
     Returns:
-        dict: The image ID and face IDs.
+        Optional[str]: The ID of the existing image, or None.
     """
     with db_transaction(token) as cur:
-        # Save the uploaded image
-        image_id = str(uuid.uuid4())
-        image_path = os.path.join(UPLOAD_DIR, f"{image_id}.jpg")
-        with open(image_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
-
-        # Generate perceptual hash for the image
-        img = Image.open(image_path)
-        phash = str(imagehash.phash(img))
-
-        # Generate embedding for the image
-        image_embedding = DeepFace.represent(img, model_name="Facenet", enforce_detection=False)[0]["embedding"]
-
-        # Extract faces from the image
-        face_objs = DeepFace.extract_faces(img_path=image_path, detector_backend="mtcnn")
-
-        # Insert image record
-        sql_insert_image(cur, tenant_id, image_id, phash, image_embedding)
-
-        # Insert face records
-        face_ids: Dict[str, str] = {}
-        for face_obj in face_objs:
-            if face_obj["confidence"] >= MIN_FACE_CONFIDENCE:
-                face_id = str(uuid.uuid4())
-                new_face_embedding = DeepFace.represent(face_obj["face"], model_name="Facenet", enforce_detection=False)[0]["embedding"]
-                facial_area = face_obj["facial_area"]
-                facial_area_json = json.dumps({
-                  "x":facial_area["x"],
-                  "y":facial_area["y"],
-                  "w":facial_area["w"],
-                  "h":facial_area["h"],
-                })
-
-                # Check for matching faces within the same tenant
-                existing_faces = sql_check_matching_faces(cur, tenant_id, new_face_embedding, SIMILARITY_THRESHOLD)
-                matched_cluster_id = str(uuid.uuid4())
-                if len(existing_faces) > 0:
-                    # If the face is matched with an existing face
-                    matched_face_id, matched_cluster_id, distance = existing_faces[0]
-                    print(f"Matched face {face_id} with {matched_face_id} with distance {distance}")
-                    is_auto_matched = True
-                    sql_insert_face(cur, tenant_id, face_id, image_id, matched_cluster_id, facial_area_json, is_auto_matched, new_face_embedding)
-                else:
-                    # If the face is not matched with any existing face
-                    is_auto_matched = True
-                    sql_insert_face(cur, tenant_id, face_id, image_id, matched_cluster_id, facial_area_json, is_auto_matched, new_face_embedding)
-                    
-                    # Add record to review_pending table
-                    sql_insert_review_pending(cur, tenant_id, matched_cluster_id)
-                face_ids.update({face_id: matched_cluster_id})
+        return find_duplicate(cur, tenant_id, content_sha256, phash, DEDUP_PHASH_DISTANCE)
+
+async def _insert_duplicate(token: str, tenant_id: str, image_id: str, data: bytes, duplicate_of: str, on_duplicate: str, content_sha256: str, upload: Optional[DecodedUpload]) -> Dict[str, Union[str, Dict[str, str]]]:
+    """
+    Answer an upload of an image the tenant already has, without running inference.
+    
+    Args:
+        token (str): The authentication token.
+        tenant_id (str): The tenant ID.
+        image_id (str): The ID for the upload, used when its faces are reused.
+        data (bytes): The raw bytes of the upload.
+        duplicate_of (str): The ID of the existing image.
+        on_duplicate (str): "return" the existing image or "reuse" its faces for a new image.
+        content_sha256 (str): The SHA-256 of the upload.
+        upload (Optional[DecodedUpload]): The decoded upload, if it was decoded to look for near-duplicates.
+    
+    Returns:
+        dict: The image ID and face IDs, and the ID of the existing image.
+    """
+    def copy() -> List[Tuple[str, str]]:
+        with db_transaction(token) as cur:
+            if on_duplicate == "return":
+                return sql_get_image_face_clusters(cur, tenant_id, duplicate_of)
+            return sql_copy_image(cur, tenant_id, duplicate_of, image_id, content_sha256, upload.phash if upload is not None else None)
+
+    DUPLICATE_UPLOADS.labels(on_duplicate).inc()
+    if on_duplicate == "return":
+        image_id = duplicate_of
+    else:
+        await run_in_threadpool(save_upload, data, os.path.join(UPLOAD_DIR, f"{image_id}.jpg"))
+    faces = await run_in_threadpool(copy)
+    return {
+      "image_id": image_id,
+      "face_ids": dict(faces),
+      "duplicate_of": duplicate_of
+    }
+
+@app.post("/insert-image-async", status_code=202)
+async def insert_image_async(tenant_id: str = Form(...), image: UploadFile = File(...), on_duplicate: str = Form(DEDUP_DEFAULT_ACTION), token: str = Header(...)) -> Dict[str, str]:
+    """
+    Accept an image for insertion by the background workers (src/worker.py) and
+    return immediately. Poll /jobs/{job_id} for the image ID and face IDs.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        image (UploadFile): The uploaded image file.
+        on_duplicate (str): What to do when the image was already uploaded to the tenant, as for /insert-image.
+        token (str): The authentication token.
+    
+    Returns:
+        dict: The job ID and the image ID the upload will be stored under.
+    """
+    verify_token(token)
+    if on_duplicate not in ("return", "reuse", "process"):
+        raise HTTPException(status_code=400, detail="on_duplicate must be one of return, reuse or process")
+
+    job_id = str(uuid.uuid4())
+    image_id = str(uuid.uuid4())
+    image_path = os.path.join(UPLOAD_DIR, f"{image_id}.jpg")
+    await run_in_threadpool(save_upload, await image.read(), image_path)
+
+    def enqueue() -> None:
+        with db_transaction(token) as cur:
+            sql_enqueue_job(cur, tenant_id, job_id, "insert_image", {"image_id": image_id, "path": image_path, "on_duplicate": on_duplicate})
+
+    await run_in_threadpool(enqueue)
+    return {"job_id": job_id, "image_id": image_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, tenant_id: str, token: str = Header(...)) -> Dict[str, object]:
+    """
+    Retrieve the status of a background job, and its result once it is done.
+    
+    Args:
+        job_id (str): The job ID.
+        tenant_id (str): The tenant ID.
+        token (str): The authentication token.
+    
+    Returns:
+        dict: The job status ("queued", "running", "done" or "failed"), its result or error, its progress and its timestamps.
+    """
+    with db_transaction(token) as cur:
+        job_id, kind, status, result, error, attempts, created_at, finished_at, progress = sql_get_job(cur, tenant_id, job_id)
         return {
-          "image_id": image_id, 
-          "face_ids": face_ids
+          "job_id": job_id,
+          "kind": kind,
+          "status": status,
+          "result": result,
+          "error": error,
+          "attempts": attempts,
+          "progress": progress,
+          "created_at": created_at.isoformat(),
+          "finished_at": finished_at.isoformat() if finished_at is not None else None
         }
 
+@app.post("/insert-images")
+async def insert_images(tenant_id: str = Form(...), images: Optional[List[UploadFile]] = File(None), archive: Optional[UploadFile] = File(None), token: str = Header(...)) -> StreamingResponse:
+    """
+    Insert many images and their associated faces into the database.
+    
+    Images are analyzed concurrently and written in batches. One JSON line is streamed
+    back per image as soon as it has been stored.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        images (List[UploadFile]): The uploaded image files.
+        archive (UploadFile): A zip or tar archive of images, instead of or in addition to `images`.
+        token (str): The authentication token.
+    
+    Returns:
+        StreamingResponse: NDJSON lines with the file name and either the image ID and face IDs, or an error.
+    """
+    verify_token(token)
+    _require_models()
+    images = images or []
+    if len(images) == 0 and archive is None:
+        raise HTTPException(status_code=400, detail="No images or archive provided")
+    if len(images) > BULK_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_FILES} files per request, upload an archive instead")
+
+    # FastAPI closes the uploads when this function returns, before the response is streamed
+    files = [(image.filename, _detach_upload(image)) for image in images]
+    archive_file = _detach_upload(archive) if archive is not None else None
+
+    def read_uploads() -> Iterator[Tuple[str, bytes]]:
+        try:
+            for filename, file in files:
+                with file:
+                    yield filename, file.read()
+            if archive_file is not None:
+                with archive_file:
+                    yield from iter_archive(archive_file)
+        finally:
+            for _, file in files:
+                file.close()
+            if archive_file is not None:
+                archive_file.close()
+
+    return StreamingResponse(_ingest_uploads(token, tenant_id, iterate_in_threadpool(read_uploads())), media_type="application/x-ndjson")
+
+async def _analyze_upload(tenant_id: str, data: bytes, image_id: str, upload: Optional[DecodedUpload] = None) -> ImageAnalysis:
+    """
+    Save an upload and run it through detection and embedding.
+    
+    The upload is saved while the in-memory copy goes through detection and embedding
+    off the event loop, so other requests keep being served.
+    
+    Args:
+        tenant_id (str): The tenant ID, which selects the detection settings.
+        data (bytes): The raw bytes of the upload.
+        image_id (str): The image ID the upload is saved under.
+        upload (Optional[DecodedUpload]): The decoded upload, if it has already been decoded.
+    
+    Returns:
+        ImageAnalysis: The embedded analysis of the image.
+    """
+    saving = asyncio.ensure_future(run_in_threadpool(save_upload, data, os.path.join(UPLOAD_DIR, f"{image_id}.jpg")))
+    try:
+        if upload is None:
+            upload = await run_inference(decode_upload, data)
+        analysis = await run_inference(analyze_image, upload, detection_settings(tenant_id), image_embedding_settings(tenant_id))
+        # Read first: a switch to another model in the meantime is then caught by `store_analyses`
+        model_version = MODEL_REGISTRY.face_model_name
+        analysis.attach_embeddings(await EMBEDDING_BATCHER.embed(analysis.embedding_inputs()), model_version)
+    finally:
+        await saving
+    return analysis
+
+async def _ingest_uploads(token: str, tenant_id: str, uploads: AsyncIterator[Tuple[str, bytes]]) -> AsyncIterator[str]:
+    """
+    Analyze uploads with bounded concurrency and store them in batched transactions.
+    
+    Args:
+        token (str): The authentication token.
+        tenant_id (str): The tenant ID.
+        uploads (AsyncIterator[Tuple[str, bytes]]): The file names and raw bytes of the images.
+    
+    Yields:
+        str: One NDJSON line per image.
+    """
+    running: Set[asyncio.Future] = set()
+    analyzed: List[Tuple[str, str, ImageAnalysis]] = []
+
+    async def analyze(filename: str, data: bytes) -> Tuple[str, str, Union[ImageAnalysis, Exception]]:
+        image_id = str(uuid.uuid4())
+        try:
+            analysis = await _analyze_upload(tenant_id, data, image_id)
+        except Exception as e:
+            return filename, image_id, e
+        analysis.release_pixels()
+        return filename, image_id, analysis
+
+    async def store() -> List[str]:
+        batch = [(image_id, analysis) for _, image_id, analysis in analyzed]
+        try:
+            results = await run_in_threadpool(_store_images, token, tenant_id, batch)
+            lines = [{"filename": filename, "image_id": image_id, "face_ids": results[image_id]} for filename, image_id, _ in analyzed]
+        except HTTPException as e:
+            lines = [{"filename": filename, "error": e.detail} for filename, _, _ in analyzed]
+        analyzed.clear()
+        return [json.dumps(line) + "\n" for line in lines]
+
+    async def collect(done: Set[asyncio.Future]) -> List[str]:
+        lines = []
+        for task in done:
+            filename, image_id, result = task.result()
+            if isinstance(result, Exception):
+                lines.append(json.dumps({"filename": filename, "error": str(result)}) + "\n")
+            else:
+                analyzed.append((filename, image_id, result))
+        if len(analyzed) >= BULK_WRITE_BATCH_SIZE:
+            lines.extend(await store())
+        return lines
+
+    async for filename, data in uploads:
+        if len(running) >= BULK_CONCURRENCY:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for line in await collect(done):
+                yield line
+        running.add(asyncio.ensure_future(analyze(filename, data)))
+    while len(running) > 0:
+        done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for line in await collect(done):
+            yield line
+    if len(analyzed) > 0:
+        for line in await store():
+            yield line
+
+def _detach_upload(upload: UploadFile) -> BinaryIO:
+    """
+    Reopen the spooled file of an upload so that it stays readable after FastAPI has
+    closed the request's uploads.
+    
+    Args:
+        upload (UploadFile): The uploaded file.
+    
+    Returns:
+        BinaryIO: A new file object for the same data, positioned at its start.
+    """
+    upload.file.rollover()
+    file = os.fdopen(os.dup(upload.file.fileno()), "rb")
+    file.seek(0)
+    return file
+
+def _store_images(token: str, tenant_id: str, analyses: List[Tuple[str, ImageAnalysis]]) -> Dict[str, Dict[str, str]]:
+    """
+    Insert analyzed images and their faces in a single transaction.
+    
+    Args:
+        token (str): The authentication token.
+        tenant_id (str): The tenant ID.
+        analyses (List[Tuple[str, ImageAnalysis]]): The image IDs and the results of the inference stage.
+    
+    Returns:
+        dict: For each image ID, its face IDs mapped to their cluster IDs.
+    """
+    with db_transaction(token) as cur:
+        return store_analyses(cur, tenant_id, analyses, SIMILARITY_THRESHOLD)
+
+@app.get("/metrics")
+def metrics() -> Response:
+    """
+    Expose the Prometheus metrics of this process.
+    
+    Returns:
+        Response: The metrics in the Prometheus text format.
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.post("/debug/profiler")
+def control_profiler(action: str = Form(...), interval_ms: float = Form(10.0), token: str = Header(...)) -> Dict[str, object]:
+    """
+    Start or stop the sampling profiler of this process.
+    
+    Args:
+        action (str): "start" or "stop".
+        interval_ms (float): The time between two samples when starting.
+        token (str): The authentication token.
+    
+    Returns:
+        dict: Whether the profiler is running and the number of samples taken.
+    """
+    verify_token(token)
+    if action == "start":
+        if not 1 <= interval_ms <= 1000:
+            raise HTTPException(status_code=400, detail="interval_ms must be between 1 and 1000")
+        PROFILER.start(interval_ms / 1000)
+    elif action == "stop":
+        PROFILER.stop()
+    else:
+        raise HTTPException(status_code=400, detail="action must be start or stop")
+    return {"running": PROFILER.running, "samples": PROFILER.samples}
+
+@app.get("/debug/profiler")
+def get_profile(token: str = Header(...)) -> PlainTextResponse:
+    """
+    Retrieve the stacks sampled by the profiler, in collapsed stack format.
+    
+    Args:
+        token (str): The authentication token.
+    
+    Returns:
+        PlainTextResponse: One line per distinct stack with its sample count.
+    """
+    verify_token(token)
+    return PlainTextResponse(PROFILER.report())
+
+@app.get("/ready")
+async def ready() -> JSONResponse:
+    """
+    Report whether the face models are loaded and the service can accept uploads.
+    
+    Returns:
+        JSONResponse: 200 with the model load time when ready, 503 otherwise.
+    """
+    if not MODEL_REGISTRY.is_ready():
+        return JSONResponse(status_code=503, content={"status": "loading" if MODEL_REGISTRY.error is None else "error", "error": MODEL_REGISTRY.error})
+    return JSONResponse(content={"status": "ready", "model_load_seconds": MODEL_REGISTRY.load_seconds})
+
 @app.delete("/image")
-async def delete_image(tenant_id: str = Form(...), image_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
+def delete_image(tenant_id: str = Form(...), image_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
     """
     Delete an image and its associated faces from the database.
     
@@ -107,14 +543,12 @@ async def delete_image(tenant_id: str = Form(...), image_id: str = Form(...), to
         dict: The status of the operation.
     """
     with db_transaction(token) as cur:
-        # Delete faces associated with the image
-        sql_delete_faces_by_image(cur, tenant_id, image_id)
-        # Delete the image record
+        # Delete the image record and the faces associated with it
         sql_delete_image(cur, tenant_id, image_id)
         return {"status": "success"}
 
 @app.delete("/face")
-async def delete_face(tenant_id: str = Form(...), face_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
+def delete_face(tenant_id: str = Form(...), face_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
     """
     Delete a face record from the database.
     
@@ -131,9 +565,13 @@ async def delete_face(tenant_id: str = Form(...), face_id: str = Form(...), toke
         return {"status": "success"}
 
 @app.delete("/cluster")
-async def delete_cluster(tenant_id: str = Form(...), cluster_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
+def delete_cluster(tenant_id: str = Form(...), cluster_id: str = Form(...), token: str = Header(...)) -> JSONResponse:
     """
-    Delete a cluster and their associated faces and images from the database.
+    Delete a cluster and their associated faces from the database, along with the
+    images that show no other cluster.
+    
+    A cluster that spans more than one delete chunk is deleted by the background
+    workers: the first chunk is deleted right away and a job is queued for the rest.
     
     Args:
         tenant_id (str): The tenant ID.
@@ -141,34 +579,153 @@ async def delete_cluster(tenant_id: str = Form(...), cluster_id: str = Form(...)
         token (str): The authentication token.
     
     Returns:
-        dict: The status of the operation.
+        JSONResponse: 200 once the cluster is deleted, or 202 with the ID of the job deleting the rest.
     """
     with db_transaction(token) as cur:
-        sql_delete_faces_by_cluster(cur, tenant_id, cluster_id)
-        sql_delete_images_by_cluster(cur, tenant_id, cluster_id)
-        return {"status": "success"}
+        if sql_delete_cluster_chunk(cur, tenant_id, cluster_id, DELETE_CHUNK_SIZE):
+            return JSONResponse(content={"status": "success"})
+        job_id = str(uuid.uuid4())
+        sql_enqueue_job(cur, tenant_id, job_id, "delete_cluster", {"cluster_id": cluster_id})
+        return JSONResponse(status_code=202, content={"status": "queued", "job_id": job_id})
 
 @app.delete("/tenant")
-async def delete_tenant(tenant_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
+def delete_tenant(tenant_id: str = Form(...), token: str = Header(...)) -> JSONResponse:
     """
     Delete a tenant and their associated faces and images from the database.
     
+    A tenant with dedicated partitions is deleted by dropping them. Otherwise the
+    first delete chunk is deleted right away, and if anything is left a job is queued
+    to delete the rest in the background.
+    
     Args:
         tenant_id (str): The tenant ID.
         token (str): The authentication token.
     
     Returns:
-        dict: The status of the operation.
+        JSONResponse: 200 once the tenant is deleted, or 202 with the ID of the job deleting the rest.
     """
     with db_transaction(token) as cur:
-        # Delete faces associated with the tenant
-        sql_delete_faces_by_tenant(cur, tenant_id)
-        # Delete images associated with the tenant
-        sql_delete_images_by_tenant(cur, tenant_id)
-        return {"status": "success"}
+        deleted = sql_drop_tenant_partitions(cur, tenant_id) or sql_delete_tenant_chunk(cur, tenant_id, DELETE_CHUNK_SIZE)
+        if not deleted:
+            job_id = str(uuid.uuid4())
+            sql_enqueue_job(cur, tenant_id, job_id, "delete_tenant", {})
+            return JSONResponse(status_code=202, content={"status": "queued", "job_id": job_id})
+    # The face crops go once the deletion is committed, a queued deletion removes them when it finishes
+    remove_crops(tenant_id)
+    return JSONResponse(content={"status": "success"})
+
+@app.get("/export-tenant")
+def export_tenant_archive(tenant_id: str, token: str = Header(...)) -> StreamingResponse:
+    """
+    Download the images and faces of a tenant as a tar archive of the export format
+    of src/transfer.py. The export is written to disk first, then streamed and deleted.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        token (str): The authentication token.
+    
+    Returns:
+        StreamingResponse: The tar archive.
+    """
+    verify_token(token)
+    export_path = tempfile.mkdtemp(prefix="export-", dir=UPLOAD_DIR)
+    pool = get_db_pool()
+    conn = pool.acquire()
+    try:
+        export_tenant(conn, tenant_id, export_path)
+    except Exception:
+        shutil.rmtree(export_path, ignore_errors=True)
+        raise
+    finally:
+        pool.release(conn)
+
+    def stream() -> Iterator[bytes]:
+        try:
+            yield from iter_tar(export_path)
+        finally:
+            shutil.rmtree(export_path, ignore_errors=True)
+
+    return StreamingResponse(stream(), media_type="application/x-tar", headers={"Content-Disposition": 'attachment; filename="export.tar"'})
+
+@app.post("/import-tenant", status_code=202)
+def import_tenant_archive(tenant_id: str = Form(...), archive: UploadFile = File(...), dedicated: bool = Form(False), token: str = Header(...)) -> Dict[str, str]:
+    """
+    Accept an archive made by /export-tenant for import into a tenant without data by
+    the background workers. Poll /jobs/{job_id} for the outcome.
+    
+    Args:
+        tenant_id (str): The tenant to import into, which may differ from the exported one.
+        archive (UploadFile): The tar archive, compressed or not.
+        dedicated (bool): Load the tenant into dedicated partitions, see src/partitioning.py.
+        token (str): The authentication token.
+    
+    Returns:
+        dict: The job ID.
+    """
+    verify_token(token)
+    job_id = str(uuid.uuid4())
+    archive_path = os.path.join(UPLOAD_DIR, f"import-{job_id}.tar")
+    # Copied in chunks, an archive can be larger than memory
+    with open(archive_path, "wb") as file:
+        shutil.copyfileobj(archive.file, file)
+    with db_transaction(token) as cur:
+        sql_enqueue_job(cur, tenant_id, job_id, "import_tenant", {"path": archive_path, "dedicated": dedicated})
+    return {"job_id": job_id, "status": "queued"}
+
+@app.post("/image-embeddings")
+def compute_image_embeddings(tenant_id: str = Form(...), recompute: bool = Form(False), token: str = Header(...)) -> JSONResponse:
+    """
+    Make sure every image of a tenant has its whole-image embedding, by queuing a job
+    that computes the missing ones. A feature that needs the embeddings of a tenant
+    whose mode is "lazy" calls this first. See src/image_embedding.py.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        recompute (bool): Recompute the embeddings that already exist, after changing the descriptor.
+        token (str): The authentication token.
+    
+    Returns:
+        JSONResponse: 200 if no image is missing its embedding, or 202 with the ID of the job computing them.
+    """
+    verify_token(token)
+    settings = image_embedding_settings(tenant_id)
+    if settings.mode == "off":
+        raise HTTPException(status_code=409, detail="Image embeddings are turned off for this tenant")
+    with db_transaction(token) as cur:
+        job_id = sql_find_active_job(cur, tenant_id, BACKFILL_JOB_KIND)
+        if job_id is None:
+            if not recompute and len(sql_get_images_to_embed(cur, tenant_id, "", 1, False)) == 0:
+                return JSONResponse(content={"status": "success"})
+            job_id = str(uuid.uuid4())
+            sql_enqueue_job(cur, tenant_id, job_id, BACKFILL_JOB_KIND, {"descriptor": settings.descriptor, "recompute": recompute})
+        return JSONResponse(status_code=202, content={"status": "queued", "job_id": job_id})
+
+@app.post("/face-embeddings")
+def compute_face_embeddings(tenant_id: str = Form(...), model_name: str = Form(...), token: str = Header(...)) -> JSONResponse:
+    """
+    Queue a job that embeds the stored face crops of a tenant with another face model,
+    ahead of switching to it. The job reports its progress to GET /jobs/{job_id}, and
+    resumes where it stopped if it is queued again. See src/reembedding.py.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        model_name (str): The DeepFace model to roll out.
+        token (str): The authentication token.
+    
+    Returns:
+        JSONResponse: 202 with the ID of the job, or of the one already queued or running.
+    """
+    with db_transaction(token) as cur:
+        if model_name == sql_get_face_model(cur):
+            raise HTTPException(status_code=409, detail=f"The faces are already embedded with {model_name}")
+        job_id = sql_find_active_job(cur, tenant_id, REEMBED_JOB_KIND)
+        if job_id is None:
+            job_id = str(uuid.uuid4())
+            sql_enqueue_job(cur, tenant_id, job_id, REEMBED_JOB_KIND, {"model_name": model_name})
+        return JSONResponse(status_code=202, content={"status": "queued", "job_id": job_id})
 
 @app.get("/review-pending")
-async def review_pending(tenant_id: str = Form(...), review_id: str = Form(...), token: str = Header(...)) -> Dict[str, int | str]:
+def review_pending(tenant_id: str = Form(...), review_id: str = Form(...), token: str = Header(...)) -> Dict[str, int | str]:
     """
     Retrieve a review pending record from the database.
     
@@ -187,25 +744,59 @@ async def review_pending(tenant_id: str = Form(...), review_id: str = Form(...),
         return {"id": review[0], "cluster_id": review[1], "image_id": review[2]}
 
 @app.get("/review-pending-list")
-async def get_review_list(tenant_id: str, skip: int = 0, limit: int = 10, token: str = Header(...)) -> List[Dict[str, int | str]]:
+def get_review_list(tenant_id: str, limit: int = 10, cursor: Optional[str] = None, token: str = Header(...)) -> Dict[str, List[Dict[str, int | str]] | Optional[str]]:
     """
-    Retrieve a list of review pending records from the database.
+    Retrieve a page of review pending records from the database.
     
     Args:
         tenant_id (str): The tenant ID.
-        skip (int): The number of records to skip.
         limit (int): The maximum number of records to return.
+        cursor (Optional[str]): The `next_cursor` of the previous page, omitted for the first page.
         token (str): The authentication token.
     
     Returns:
-        list: A list of review pending records.
+        dict: The review pending records, and the cursor of the next page or None on the last page.
     """
+    _check_page_size(limit)
+    after = decode_cursor(cursor, (int,))
     with db_transaction(token) as cur:
-        review_list = sql_get_review_list(cur, tenant_id, limit, skip)
-        return [{"id": review[0], "cluster_id": review[1], "image_id": review[2]} for review in review_list]
+        # Read one extra row to know whether there is a next page
+        review_list = sql_get_review_list(cur, tenant_id, limit + 1, after[0] if after is not None else None)
+        page, next_cursor = _paginate(review_list, limit, lambda review: [review[0]])
+        return {
+          "items": [{"id": review[0], "cluster_id": review[1], "image_id": review[2]} for review in page],
+          "next_cursor": next_cursor
+        }
+
+def _check_page_size(limit: int) -> None:
+    """
+    Reject page sizes outside of 1 to MAX_PAGE_SIZE.
+    
+    Args:
+        limit (int): The requested page size.
+    """
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+def _paginate(rows: List[Any], limit: int, sort_key: Callable[[Any], List[str | int]]) -> Tuple[List[Any], Optional[str]]:
+    """
+    Split the rows of a keyset query run with `limit + 1` into a page and the cursor of the next one.
+    
+    Args:
+        rows (List[Any]): The rows returned by the query.
+        limit (int): The page size.
+        sort_key (Callable): Returns the sort key values of a row.
+    
+    Returns:
+        tuple: The rows of the page, and the cursor of the next page or None on the last page.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode_cursor(sort_key(page[-1]))
 
 @app.delete("/review-pending")
-async def delete_review_pending(tenant_id: str = Form(...), review_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
+def delete_review_pending(tenant_id: str = Form(...), review_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
     """
     Delete a review pending record from the database.
     
@@ -222,7 +813,7 @@ async def delete_review_pending(tenant_id: str = Form(...), review_id: str = For
         return {"status": "success"}
 
 @app.post("/update-face-cluster")
-async def update_face_cluster(tenant_id: str = Form(...), face_id: str = Form(...), to_cluster_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
+def update_face_cluster(tenant_id: str = Form(...), face_id: str = Form(...), to_cluster_id: str = Form(...), token: str = Header(...)) -> Dict[str, str]:
     """
     Update the cluster ID of a face record in the database.
     
@@ -239,8 +830,33 @@ async def update_face_cluster(tenant_id: str = Form(...), face_id: str = Form(..
         sql_update_face_owner(cur, tenant_id, face_id, to_cluster_id)
         return {"status": "success"}
 
+@app.post("/recluster")
+def recluster(tenant_id: str = Form(...), apply: bool = Form(False), token: str = Header(...)) -> JSONResponse:
+    """
+    Queue a job merging the clusters of a tenant whose centroids are close, see
+    src/reclustering.py. Faces that were moved by hand with /update-face-cluster are
+    never moved. The merges are reported by /jobs/{job_id} once the job is done.
+    
+    A job that only proposes merges does not write, so one that applies them is
+    queued even while one that proposes them is queued or running, and vice versa.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        apply (bool): Apply the merges rather than only proposing them.
+        token (str): The authentication token.
+    
+    Returns:
+        JSONResponse: 202 with the ID of the job, or of the one with the same `apply` already queued or running for the tenant.
+    """
+    with db_transaction(token) as cur:
+        job_id = sql_find_active_job(cur, tenant_id, RECLUSTER_JOB_KIND, {"apply": apply})
+        if job_id is None:
+            job_id = str(uuid.uuid4())
+            sql_enqueue_job(cur, tenant_id, job_id, RECLUSTER_JOB_KIND, {"apply": apply})
+        return JSONResponse(status_code=202, content={"status": "queued", "job_id": job_id})
+
 @app.get("/face")
-async def get_face(tenant_id: str, face_id: str, token: str = Header(...)) -> Dict[str, str | bool]:
+def get_face(tenant_id: str, face_id: str, token: str = Header(...)) -> Dict[str, str | bool]:
     """
     Retrieve a face record from the database.
     
@@ -262,7 +878,7 @@ async def get_face(tenant_id: str, face_id: str, token: str = Header(...)) -> Di
         }
 
 @app.get("/cluster")
-async def get_cluster(tenant_id: str, cluster_id: str, token: str = Header(...)) -> Dict[str, int]:
+def get_cluster(tenant_id: str, cluster_id: str, token: str = Header(...)) -> Dict[str, int]:
     """
     Retrieve a cluster record from the database.
     
@@ -279,7 +895,7 @@ async def get_cluster(tenant_id: str, cluster_id: str, token: str = Header(...))
         return {"number_of_faces":number_of_faces, "number_of_images": number_of_images}
 
 @app.get("/image")
-async def get_image(tenant_id: str, image_id: str, token: str = Header(...)) -> Dict[str, List[str] | str]:
+def get_image(tenant_id: str, image_id: str, token: str = Header(...)) -> Dict[str, List[str] | str]:
     """
     Retrieve an image record from the database.
     
@@ -295,30 +911,165 @@ async def get_image(tenant_id: str, image_id: str, token: str = Header(...)) ->
         face_ids, cluster_ids, phash = sql_get_image(cur, tenant_id, image_id)
         return {"face_ids": face_ids, "cluster_ids": cluster_ids, "phash": phash}
 
+def _batch_ids(ids: List[str]) -> List[str]:
+    """
+    Deduplicate the IDs of a batch read, keeping their order, and enforce `[http] max_batch_ids`.
+    
+    Args:
+        ids (List[str]): The requested IDs.
+    
+    Returns:
+        list: The distinct IDs.
+    """
+    distinct = list(dict.fromkeys(ids))
+    if len(distinct) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} IDs can be requested at once")
+    return distinct
+
+@app.get("/face-batch", response_class=ORJSONResponse)
+def get_face_batch(tenant_id: str, face_id: List[str] = Query(...), token: str = Header(...)) -> ORJSONResponse:
+    """
+    Retrieve several face records with one query.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        face_id (List[str]): The face IDs, the parameter is repeated for each face.
+        token (str): The authentication token.
+    
+    Returns:
+        ORJSONResponse: The face records by face ID, and the face IDs that were not found.
+    """
+    verify_token(token)
+    face_ids = _batch_ids(face_id)
+    with db_transaction(token) as cur:
+        faces = {
+            found_id: {"cluster_id": cluster_id, "image_id": image_id, "facial_area": facial_area, "is_auto_matched": is_auto_matched}
+            for found_id, cluster_id, image_id, facial_area, is_auto_matched in sql_get_faces_by_id(cur, tenant_id, face_ids)
+        }
+    return ORJSONResponse({"faces": faces, "missing": [missing_id for missing_id in face_ids if missing_id not in faces]})
+
+@app.get("/cluster-batch", response_class=ORJSONResponse)
+def get_cluster_batch(tenant_id: str, cluster_id: List[str] = Query(...), token: str = Header(...)) -> ORJSONResponse:
+    """
+    Retrieve the statistics of several clusters with one query.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        cluster_id (List[str]): The cluster IDs, the parameter is repeated for each cluster.
+        token (str): The authentication token.
+    
+    Returns:
+        ORJSONResponse: The cluster records by cluster ID, and the cluster IDs that have no faces.
+    """
+    verify_token(token)
+    cluster_ids = _batch_ids(cluster_id)
+    with db_transaction(token) as cur:
+        clusters = {
+            found_id: {"number_of_faces": number_of_faces, "number_of_images": number_of_images}
+            for found_id, number_of_faces, number_of_images in sql_get_clusters_by_id(cur, tenant_id, cluster_ids)
+        }
+    return ORJSONResponse({"clusters": clusters, "missing": [missing_id for missing_id in cluster_ids if missing_id not in clusters]})
+
+@app.get("/image-batch", response_class=ORJSONResponse)
+def get_image_batch(tenant_id: str, image_id: List[str] = Query(...), token: str = Header(...)) -> ORJSONResponse:
+    """
+    Retrieve several image records and their faces and clusters with one query.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        image_id (List[str]): The image IDs, the parameter is repeated for each image.
+        token (str): The authentication token.
+    
+    Returns:
+        ORJSONResponse: The image records by image ID, and the image IDs that were not found.
+    """
+    verify_token(token)
+    image_ids = _batch_ids(image_id)
+    with db_transaction(token) as cur:
+        images = {
+            found_id: {"face_ids": face_ids, "cluster_ids": cluster_ids, "phash": phash}
+            for found_id, face_ids, cluster_ids, phash in sql_get_images_by_id(cur, tenant_id, image_ids)
+        }
+    return ORJSONResponse({"images": images, "missing": [missing_id for missing_id in image_ids if missing_id not in images]})
+
+@app.get("/similar-images")
+def get_similar_images(tenant_id: str, image_id: List[str] = Query(...), max_distance: int = SIMILAR_IMAGES_MAX_DISTANCE, token: str = Header(...)) -> Dict[str, Dict[str, List[Dict[str, str | int]]] | List[str]]:
+    """
+    Retrieve the near-duplicates of one or more images, by perceptual hash.
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        image_id (List[str]): The image IDs, the parameter can be repeated to look up several images, up to `[http] max_batch_ids`.
+        max_distance (int): The maximum Hamming distance between the 64-bit perceptual hashes.
+        token (str): The authentication token.
+    
+    Returns:
+        dict: The similar images of each found image, closest first, and the image IDs that were not found.
+    """
+    verify_token(token)
+    image_ids = _batch_ids(image_id)
+    if not 0 <= max_distance <= 16:
+        raise HTTPException(status_code=400, detail="max_distance must be between 0 and 16")
+    with db_transaction(token) as cur:
+        image_phashes = sql_get_image_phashes(cur, tenant_id, image_ids)
+        matches = sql_get_similar_images(cur, tenant_id, image_phashes, max_distance)
+        similar: Dict[str, List[Dict[str, str | int]]] = {found_id: [] for found_id, _ in image_phashes}
+        for query_id, similar_id, distance in matches:
+            similar[query_id].append({"image_id": similar_id, "distance": distance})
+        return {"similar": similar, "missing": [missing_id for missing_id in image_ids if missing_id not in similar]}
+
 @app.get("/faces")
-async def get_faces(tenant_id: str, image_id: str, skip: int = 0, limit: int = 10, token: str = Header(...)) -> List[Dict[str, str | bool]]:
+def get_faces(tenant_id: str, image_id: str, limit: int = 10, cursor: Optional[str] = None, token: str = Header(...)) -> Dict[str, List[Dict[str, str | bool]] | Optional[str]]:
     """
-    Retrieve a list of face records from the database.
+    Retrieve a page of the face records of an image from the database.
     
     Args:
         tenant_id (str): The tenant ID.
         image_id (str): The image ID.
-        skip (int): The number of records to skip.
         limit (int): The maximum number of records to return.
+        cursor (Optional[str]): The `next_cursor` of the previous page, omitted for the first page.
+        token (str): The authentication token.
+    
+    Returns:
+        dict: The face records, and the cursor of the next page or None on the last page.
+    """
+    _check_page_size(limit)
+    after = decode_cursor(cursor, (str,))
+    with db_transaction(token) as cur:
+        faces = sql_get_faces(cur, tenant_id, image_id, limit + 1, after[0] if after is not None else None)
+        page, next_cursor = _paginate(faces, limit, lambda face: [face[0]])
+        return {
+          "items": [{
+            "id": face[0], 
+            "cluster_id": face[1], 
+            "image_id": face[2], 
+            "facial_area": face[3], 
+            "is_auto_matched": face[4]
+          } for face in page],
+          "next_cursor": next_cursor
+        }
+
+@app.get("/images")
+def get_images(tenant_id: str, cluster_id: str, limit: int = 10, cursor: Optional[str] = None, token: str = Header(...)) -> Dict[str, List[str] | Optional[str]]:
+    """
+    Retrieve a page of the images that contain a face of a cluster (user).
+    
+    Args:
+        tenant_id (str): The tenant ID.
+        cluster_id (str): The cluster ID.
+        limit (int): The maximum number of image IDs to return.
+        cursor (Optional[str]): The `next_cursor` of the previous page, omitted for the first page.
         token (str): The authentication token.
     
     Returns:
-        list: A list of face records.
+        dict: The image IDs, and the cursor of the next page or None on the last page.
     """
+    _check_page_size(limit)
+    after = decode_cursor(cursor, (str,))
     with db_transaction(token) as cur:
-        faces = sql_get_faces(cur, tenant_id, image_id, limit, skip)
-        return [{
-          "id": face[0], 
-          "cluster_id": face[1], 
-          "image_id": face[2], 
-          "facial_area": face[3], 
-          "is_auto_matched": face[4]
-        } for face in faces]
+        image_ids = sql_get_cluster_images(cur, tenant_id, cluster_id, limit + 1, after[0] if after is not None else None)
+        page, next_cursor = _paginate(image_ids, limit, lambda image_id: [image_id])
+        return {"items": page, "next_cursor": next_cursor}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
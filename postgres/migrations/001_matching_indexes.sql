@@ -0,0 +1,24 @@
+-- Add the face matching and tenant lookup indexes to a database created before they
+-- were part of schema.sql. Run with psql outside of a transaction block, as
+-- CREATE INDEX CONCURRENTLY does not block inserts while the indexes are built:
+--
+--   psql -d facerec_db -f postgres/migrations/001_matching_indexes.sql
+
+-- Building HNSW is much faster when the graph fits in maintenance_work_mem
+SET maintenance_work_mem = '2GB';
+SET max_parallel_maintenance_workers = 4;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS images_tenant_id_idx ON images (tenant_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS faces_tenant_image_idx ON faces (tenant_id, image_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS faces_tenant_cluster_idx ON faces (tenant_id, cluster_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS faces_embedding_hnsw_idx ON faces USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- IVFFlat builds faster and uses less memory than HNSW but recalls less at the same
+-- latency. To use it instead, build it once the table holds representative data and
+-- set `index = "ivfflat"` in the [matching] section of config.toml:
+--
+--   CREATE INDEX CONCURRENTLY IF NOT EXISTS faces_embedding_ivfflat_idx ON faces USING ivfflat (embedding vector_cosine_ops) WITH (lists = 1000);
+
+ANALYZE images;
+ANALYZE faces;
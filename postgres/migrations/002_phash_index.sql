@@ -0,0 +1,19 @@
+-- Store the perceptual hash of each image as a 64-bit integer and index its four
+-- 16-bit substrings for near-duplicate lookups (GET /similar-images). Adding the
+-- generated columns rewrites the images table, so run this in a quiet period:
+--
+--   psql -d facerec_db -f postgres/migrations/002_phash_index.sql
+
+ALTER TABLE images
+  ADD COLUMN IF NOT EXISTS phash_int BIGINT GENERATED ALWAYS AS (('x' || lpad(phash, 16, '0'))::bit(64)::bigint) STORED,
+  ADD COLUMN IF NOT EXISTS phash_0 INTEGER GENERATED ALWAYS AS (('x' || substr(lpad(phash, 16, '0'), 1, 4))::bit(16)::integer) STORED,
+  ADD COLUMN IF NOT EXISTS phash_1 INTEGER GENERATED ALWAYS AS (('x' || substr(lpad(phash, 16, '0'), 5, 4))::bit(16)::integer) STORED,
+  ADD COLUMN IF NOT EXISTS phash_2 INTEGER GENERATED ALWAYS AS (('x' || substr(lpad(phash, 16, '0'), 9, 4))::bit(16)::integer) STORED,
+  ADD COLUMN IF NOT EXISTS phash_3 INTEGER GENERATED ALWAYS AS (('x' || substr(lpad(phash, 16, '0'), 13, 4))::bit(16)::integer) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS images_tenant_phash_0_idx ON images (tenant_id, phash_0);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS images_tenant_phash_1_idx ON images (tenant_id, phash_1);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS images_tenant_phash_2_idx ON images (tenant_id, phash_2);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS images_tenant_phash_3_idx ON images (tenant_id, phash_3);
+
+ANALYZE images;
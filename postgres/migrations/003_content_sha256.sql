@@ -0,0 +1,9 @@
+-- Record the SHA-256 of each upload so that re-uploads of the same file can skip
+-- detection and embedding. Images stored before this migration have no hash and are
+-- only found as near-duplicates by perceptual hash.
+--
+--   psql -d facerec_db -f postgres/migrations/003_content_sha256.sql
+
+ALTER TABLE images ADD COLUMN IF NOT EXISTS content_sha256 CHAR(64);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS images_tenant_content_sha256_idx ON images (tenant_id, content_sha256);
@@ -0,0 +1,18 @@
+-- Composite indexes for the keyset paginated listings (GET /review-pending-list,
+-- GET /faces, GET /images), and the image_id column of review_pending that the
+-- review endpoints return. The new face indexes replace the two-column ones they
+-- extend. Run outside of a transaction block:
+--
+--   psql -d facerec_db -f postgres/migrations/004_keyset_pagination.sql
+
+ALTER TABLE review_pending ADD COLUMN IF NOT EXISTS image_id VARCHAR(255);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS review_pending_tenant_id_idx ON review_pending (tenant_id, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS faces_tenant_image_id_idx ON faces (tenant_id, image_id, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS faces_tenant_cluster_image_idx ON faces (tenant_id, cluster_id, image_id);
+
+DROP INDEX CONCURRENTLY IF EXISTS faces_tenant_image_idx;
+DROP INDEX CONCURRENTLY IF EXISTS faces_tenant_cluster_idx;
+
+ANALYZE faces;
+ANALYZE review_pending;
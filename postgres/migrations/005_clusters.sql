@@ -0,0 +1,35 @@
+-- Create the clusters table used by centroid matching and fill it from the existing
+-- faces. Requires pgvector 0.7 or later for l2_normalize. Run it while no images are
+-- being inserted, faces written during the backfill would be missing from their
+-- cluster until it is rebuilt:
+--
+--   psql -d facerec_db -f postgres/migrations/005_clusters.sql
+
+CREATE TABLE IF NOT EXISTS clusters (
+  tenant_id VARCHAR(255) NOT NULL,
+  id VARCHAR(255) NOT NULL,
+  embedding_sum VECTOR(128) NOT NULL,
+  face_count INTEGER NOT NULL,
+  radius REAL NOT NULL DEFAULT 0,
+  PRIMARY KEY (tenant_id, id)
+);
+
+INSERT INTO clusters (tenant_id, id, embedding_sum, face_count, radius)
+SELECT tenant_id, cluster_id, sum(l2_normalize(embedding)), count(*), 0
+FROM faces
+GROUP BY tenant_id, cluster_id
+ON CONFLICT (tenant_id, id) DO NOTHING;
+
+UPDATE clusters
+SET radius = members.radius
+FROM (
+  SELECT faces.tenant_id, faces.cluster_id, max(faces.embedding <=> clusters.embedding_sum) AS radius
+  FROM faces
+  JOIN clusters ON clusters.tenant_id = faces.tenant_id AND clusters.id = faces.cluster_id
+  GROUP BY faces.tenant_id, faces.cluster_id
+) AS members
+WHERE clusters.tenant_id = members.tenant_id AND clusters.id = members.cluster_id;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS clusters_embedding_sum_hnsw_idx ON clusters USING hnsw (embedding_sum vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+ANALYZE clusters;
@@ -0,0 +1,20 @@
+-- Create the job queue used by /insert-image-async and src/worker.py:
+--
+--   psql -d facerec_db -f postgres/migrations/006_jobs.sql
+
+CREATE TABLE IF NOT EXISTS jobs (
+  id VARCHAR(255) PRIMARY KEY,
+  tenant_id VARCHAR(255) NOT NULL,
+  kind VARCHAR(64) NOT NULL,
+  status VARCHAR(16) NOT NULL DEFAULT 'queued',
+  payload JSONB NOT NULL,
+  result JSONB,
+  error TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  started_at TIMESTAMPTZ,
+  finished_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS jobs_available_idx ON jobs (available_at) WHERE status IN ('queued', 'running');
@@ -0,0 +1,33 @@
+-- Compact vector indexes for [matching] quantization in config.toml. They index an
+-- expression over the existing columns, so nothing is rewritten: the full-precision
+-- embeddings stay in the tables and are used to rerank the candidates. Compare the
+-- options with `python -m benchmarks.quantization` before switching.
+--
+--   psql -d facerec_db -f postgres/migrations/007_quantized_indexes.sql
+--
+-- The tables are partitioned, which rules out CREATE INDEX CONCURRENTLY: inserts wait
+-- while each index is built. The casts are to the dimension of the Facenet embeddings,
+-- src/reembedding.py builds the indexes again for the dimension of another model.
+
+-- Building HNSW is much faster when the graph fits in maintenance_work_mem
+SET maintenance_work_mem = '2GB';
+SET max_parallel_maintenance_workers = 4;
+
+-- quantization = "halfvec": 16-bit floats, half the size of the full-precision indexes
+CREATE INDEX IF NOT EXISTS faces_embedding_halfvec_hnsw_idx ON faces USING hnsw ((embedding::halfvec(128)) halfvec_cosine_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX IF NOT EXISTS clusters_embedding_sum_halfvec_hnsw_idx ON clusters USING hnsw ((embedding_sum::halfvec(128)) halfvec_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- quantization = "binary": one bit per dimension, a 32nd of the size, and a recall that
+-- depends on rerank_candidates. To use it instead, build:
+--
+--   CREATE INDEX IF NOT EXISTS faces_embedding_binary_hnsw_idx ON faces USING hnsw ((binary_quantize(embedding)::bit(128)) bit_hamming_ops) WITH (m = 16, ef_construction = 64);
+--   CREATE INDEX IF NOT EXISTS clusters_embedding_sum_binary_hnsw_idx ON clusters USING hnsw ((binary_quantize(embedding_sum)::bit(128)) bit_hamming_ops) WITH (m = 16, ef_construction = 64);
+
+-- Once config.toml uses a quantized index everywhere, the full-precision indexes only
+-- cost memory and can be dropped:
+--
+--   DROP INDEX faces_embedding_hnsw_idx;
+--   DROP INDEX clusters_embedding_sum_hnsw_idx;
+
+ANALYZE faces;
+ANALYZE clusters;
@@ -0,0 +1,12 @@
+-- Let the whole-image embedding be computed later or not at all, see
+-- [image_embedding] in config.toml. Existing embeddings are kept, and the partial
+-- index lets the backfill job find the images still missing one.
+--
+--   psql -d facerec_db -f postgres/migrations/008_nullable_image_embedding.sql
+--
+-- The tables are partitioned, which rules out CREATE INDEX CONCURRENTLY: inserts wait
+-- while the index is built, which is quick while no embedding is missing.
+
+ALTER TABLE images ALTER COLUMN embedding DROP NOT NULL;
+
+CREATE INDEX IF NOT EXISTS images_missing_embedding_idx ON images (tenant_id, id) WHERE embedding IS NULL;
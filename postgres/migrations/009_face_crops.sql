@@ -0,0 +1,48 @@
+-- Keep the aligned face crops and record the face model, so that a new face model
+-- can be rolled out by re-embedding the crops, see src/reembedding.py. Adding
+-- columns without a default does not rewrite the tables, and neither does
+-- dropping the dimension of images.embedding, whose "facenet" descriptor then takes
+-- that of the face model.
+--
+--   psql -d facerec_db -f postgres/migrations/009_face_crops.sql
+
+ALTER TABLE faces ADD COLUMN IF NOT EXISTS crop_offset BIGINT;
+ALTER TABLE faces ADD COLUMN IF NOT EXISTS crop_length INTEGER;
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS progress JSONB;
+
+ALTER TABLE images ALTER COLUMN embedding TYPE vector;
+
+CREATE TABLE IF NOT EXISTS face_model (
+  singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+  model_version VARCHAR(64) NOT NULL,
+  switched_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+INSERT INTO face_model (model_version) VALUES ('Facenet') ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS face_embeddings_next (
+  model_version VARCHAR(64) NOT NULL,
+  tenant_id VARCHAR(255) NOT NULL,
+  face_id VARCHAR(255) NOT NULL,
+  embedding VECTOR NOT NULL,
+  PRIMARY KEY (model_version, tenant_id, face_id)
+);
+
+CREATE TABLE IF NOT EXISTS face_model_switch_log (
+  tenant_id VARCHAR(255) NOT NULL,
+  face_id VARCHAR(255),
+  cluster_id VARCHAR(255) NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION log_face_model_switch() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP <> 'INSERT' THEN
+    INSERT INTO face_model_switch_log (tenant_id, face_id, cluster_id) VALUES (OLD.tenant_id, NULL, OLD.cluster_id);
+  END IF;
+  IF TG_OP <> 'DELETE' THEN
+    INSERT INTO face_model_switch_log (tenant_id, face_id, cluster_id) VALUES (NEW.tenant_id, NEW.id, NEW.cluster_id);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
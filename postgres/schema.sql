@@ -1,30 +1,162 @@
 -- Enable pgvector extension
 CREATE EXTENSION IF NOT EXISTS vector;
 
+-- The tenant-scoped tables are partitioned by tenant. Tenants share the DEFAULT
+-- partition, itself split into 16 hash partitions, until `python -m src.partitioning
+-- promote` moves one into list partitions of its own, which deleting the tenant then
+-- drops. See src/partitioning.py.
+
+-- Tenants with dedicated partitions, and the suffix of their partition names
+CREATE TABLE IF NOT EXISTS tenant_partitions (
+  tenant_id VARCHAR(255) PRIMARY KEY,
+  suffix VARCHAR(64) NOT NULL UNIQUE,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
 -- Create image table
 CREATE TABLE IF NOT EXISTS images (
-  id VARCHAR(255) PRIMARY KEY NOT NULL,
+  id VARCHAR(255) NOT NULL,
   tenant_id VARCHAR(255) NOT NULL,
   phash VARCHAR(255) NOT NULL,
-  embedding VECTOR(128) NOT NULL
-);
+  embedding VECTOR, -- Whole-image embedding, NULL until computed, see [image_embedding] in config.toml. Its dimension depends on the descriptor
+  content_sha256 CHAR(64), -- SHA-256 of the uploaded bytes, used to skip inference for re-uploads
+  -- The 64-bit perceptual hash as an integer, and split into four 16-bit substrings
+  -- for multi-index hashing: two hashes within Hamming distance r share at least one
+  -- substring within distance r / 4, which can be looked up in a B-tree.
+  phash_int BIGINT GENERATED ALWAYS AS (('x' || lpad(phash, 16, '0'))::bit(64)::bigint) STORED,
+  phash_0 INTEGER GENERATED ALWAYS AS (('x' || substr(lpad(phash, 16, '0'), 1, 4))::bit(16)::integer) STORED,
+  phash_1 INTEGER GENERATED ALWAYS AS (('x' || substr(lpad(phash, 16, '0'), 5, 4))::bit(16)::integer) STORED,
+  phash_2 INTEGER GENERATED ALWAYS AS (('x' || substr(lpad(phash, 16, '0'), 9, 4))::bit(16)::integer) STORED,
+  phash_3 INTEGER GENERATED ALWAYS AS (('x' || substr(lpad(phash, 16, '0'), 13, 4))::bit(16)::integer) STORED,
+  PRIMARY KEY (tenant_id, id)
+) PARTITION BY LIST (tenant_id);
 
 -- Create face table
+-- There is no foreign key to images: it would make every partition drop and attach
+-- check the other table. Faces are deleted explicitly before their images.
 CREATE TABLE IF NOT EXISTS faces (
-  id VARCHAR(255) PRIMARY KEY,
+  id VARCHAR(255) NOT NULL,
   tenant_id VARCHAR(255) NOT NULL,
   image_id VARCHAR(255) NOT NULL,
   cluster_id VARCHAR(255) NOT NULL,
   facial_area JSONB NOT NULL, -- X,Y,W,H that represents the facial area
   is_auto_matched BOOLEAN DEFAULT FALSE, -- Indicates if the face was auto matched by the face recognition algorithm
-  embedding VECTOR(128) NOT NULL,
-  FOREIGN KEY (image_id) REFERENCES images(id) ON DELETE CASCADE
-);
+  embedding VECTOR(128) NOT NULL, -- The dimension of the face model, changed by src/reembedding.py when it switches to another
+  crop_offset BIGINT, -- Where the aligned face crop is in the tenant's pack file, see src/crops.py, NULL if it was not kept
+  crop_length INTEGER,
+  PRIMARY KEY (tenant_id, id)
+) PARTITION BY LIST (tenant_id);
+
+-- Create cluster table, maintained by src/sql.py as faces are inserted, moved and deleted
+CREATE TABLE IF NOT EXISTS clusters (
+  tenant_id VARCHAR(255) NOT NULL,
+  id VARCHAR(255) NOT NULL,
+  embedding_sum VECTOR(128) NOT NULL, -- Sum of the L2-normalized member embeddings, cosine distance to it is distance to the centroid
+  face_count INTEGER NOT NULL,
+  radius REAL NOT NULL DEFAULT 0, -- Largest distance of a member to the centroid when it joined
+  PRIMARY KEY (tenant_id, id)
+) PARTITION BY LIST (tenant_id);
+
+-- Indexes for the tenant-scoped lookups and deletes in src/sql.py
+CREATE INDEX IF NOT EXISTS images_tenant_id_idx ON images (tenant_id);
+CREATE INDEX IF NOT EXISTS images_tenant_content_sha256_idx ON images (tenant_id, content_sha256);
+CREATE INDEX IF NOT EXISTS images_tenant_phash_0_idx ON images (tenant_id, phash_0);
+CREATE INDEX IF NOT EXISTS images_tenant_phash_1_idx ON images (tenant_id, phash_1);
+CREATE INDEX IF NOT EXISTS images_tenant_phash_2_idx ON images (tenant_id, phash_2);
+CREATE INDEX IF NOT EXISTS images_tenant_phash_3_idx ON images (tenant_id, phash_3);
+CREATE INDEX IF NOT EXISTS images_missing_embedding_idx ON images (tenant_id, id) WHERE embedding IS NULL;
+-- The trailing columns are the sort keys of the keyset paginated listings (GET /faces, GET /images)
+CREATE INDEX IF NOT EXISTS faces_tenant_image_id_idx ON faces (tenant_id, image_id, id);
+CREATE INDEX IF NOT EXISTS faces_tenant_cluster_image_idx ON faces (tenant_id, cluster_id, image_id);
+
+-- Approximate nearest neighbour index used to match new faces (cosine distance, <=>)
+CREATE INDEX IF NOT EXISTS faces_embedding_hnsw_idx ON faces USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- First stage of centroid matching ([matching] strategy = "centroids"), the nearest clusters of a new face
+CREATE INDEX IF NOT EXISTS clusters_embedding_sum_hnsw_idx ON clusters USING hnsw (embedding_sum vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- With [matching] quantization = "halfvec" or "binary", the indexes above are replaced by
+-- the quantized ones in postgres/migrations/007_quantized_indexes.sql
 
 -- Create review pending table
 CREATE TABLE IF NOT EXISTS review_pending (
-  id SERIAL PRIMARY KEY,
+  id SERIAL NOT NULL,
   tenant_id VARCHAR(255) NOT NULL,
-  cluster_id VARCHAR(255) NOT NULL,
-  FOREIGN KEY (cluster_id) REFERENCES faces(cluster_id) ON DELETE CASCADE
+  cluster_id VARCHAR(255) NOT NULL, -- Clusters are deleted with their last face, so this cannot be a foreign key
+  image_id VARCHAR(255), -- The image the cluster was first seen in
+  PRIMARY KEY (tenant_id, id)
+) PARTITION BY LIST (tenant_id);
+
+-- The shared partitions, 16 hash partitions per table
+DO $$
+DECLARE
+  parent TEXT;
+BEGIN
+  FOREACH parent IN ARRAY ARRAY['images', 'faces', 'clusters', 'review_pending'] LOOP
+    EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I DEFAULT PARTITION BY HASH (tenant_id)', parent || '_shared', parent);
+    FOR remainder IN 0..15 LOOP
+      EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES WITH (MODULUS 16, REMAINDER %s)', parent || '_shared_' || remainder, parent || '_shared', remainder);
+    END LOOP;
+  END LOOP;
+END $$;
+
+-- Create job table, a queue polled by src/worker.py with FOR UPDATE SKIP LOCKED
+CREATE TABLE IF NOT EXISTS jobs (
+  id VARCHAR(255) PRIMARY KEY,
+  tenant_id VARCHAR(255) NOT NULL,
+  kind VARCHAR(64) NOT NULL, -- Selects the handler that runs the job
+  status VARCHAR(16) NOT NULL DEFAULT 'queued', -- queued, running, done or failed
+  payload JSONB NOT NULL,
+  result JSONB,
+  error TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  available_at TIMESTAMPTZ NOT NULL DEFAULT now(), -- When a queued job may run, or when the lease of a running job expires
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  started_at TIMESTAMPTZ,
+  finished_at TIMESTAMPTZ,
+  progress JSONB -- Reported by long jobs while they run
+);
+
+CREATE INDEX IF NOT EXISTS jobs_available_idx ON jobs (available_at) WHERE status IN ('queued', 'running');
+
+-- The face model whose embeddings faces.embedding holds. Inserts read it under a
+-- shared advisory lock and embed with it, src/reembedding.py switches it under the
+-- exclusive one.
+CREATE TABLE IF NOT EXISTS face_model (
+  singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+  model_version VARCHAR(64) NOT NULL,
+  switched_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+INSERT INTO face_model (model_version) VALUES ('Facenet') ON CONFLICT DO NOTHING;
+
+-- Embeddings of another face model computed by src/reembedding.py, moved into
+-- faces.embedding when it switches to that model
+CREATE TABLE IF NOT EXISTS face_embeddings_next (
+  model_version VARCHAR(64) NOT NULL,
+  tenant_id VARCHAR(255) NOT NULL,
+  face_id VARCHAR(255) NOT NULL,
+  embedding VECTOR NOT NULL,
+  PRIMARY KEY (model_version, tenant_id, face_id)
 );
+
+-- The faces inserted, deleted or moved while src/reembedding.py switches to another
+-- face model, logged by a trigger it only adds for the switch, so that it can catch
+-- up with them. face_id is NULL when only the cluster changed.
+CREATE TABLE IF NOT EXISTS face_model_switch_log (
+  tenant_id VARCHAR(255) NOT NULL,
+  face_id VARCHAR(255),
+  cluster_id VARCHAR(255) NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION log_face_model_switch() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP <> 'INSERT' THEN
+    INSERT INTO face_model_switch_log (tenant_id, face_id, cluster_id) VALUES (OLD.tenant_id, NULL, OLD.cluster_id);
+  END IF;
+  IF TG_OP <> 'DELETE' THEN
+    INSERT INTO face_model_switch_log (tenant_id, face_id, cluster_id) VALUES (NEW.tenant_id, NEW.id, NEW.cluster_id);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
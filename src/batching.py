@@ -0,0 +1,95 @@
+import asyncio
+from typing import Callable, List, Optional, Tuple
+import numpy as np
+import toml
+from src.inference import get_inference_executor
+from src.metrics import timed
+from src.models import MODEL_REGISTRY
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+INFERENCE_CONFIG = config.get("inference", {})
+MAX_BATCH_SIZE = INFERENCE_CONFIG.get("max_batch_size", 32)
+MAX_BATCH_WAIT_MS = INFERENCE_CONFIG.get("max_batch_wait_ms", 5)
+
+class EmbeddingBatcher:
+    """
+    Collects images to embed from all in-flight requests and runs them through the
+    face model as stacked batches.
+
+    A batch is flushed as soon as it holds `max_batch_size` items, or `max_wait_ms`
+    after its first item arrived, whichever comes first. The batcher must only be
+    used from the event loop thread; the forward passes run on the inference executor.
+    """
+
+    def __init__(self, embed_fn: Callable[[List[np.ndarray]], List[List[float]]], max_batch_size: int, max_wait_ms: float) -> None:
+        self._embed_fn = embed_fn
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._pending: List[Tuple[np.ndarray, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def embed(self, images: List[np.ndarray]) -> List[List[float]]:
+        """
+        Queue images for embedding and wait for their vectors.
+
+        Args:
+            images (List[np.ndarray]): RGB face crops or whole images.
+
+        Returns:
+            list: One embedding vector per input, in the same order.
+        """
+        if len(images) == 0:
+            return []
+        loop = asyncio.get_running_loop()
+        futures = []
+        for image in images:
+            future = loop.create_future()
+            self._pending.append((image, future))
+            futures.append(future)
+
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_wait, self._flush)
+        # Includes the time spent waiting for the batch to fill up
+        with timed("embedding"):
+            return list(await asyncio.gather(*futures))
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of images waiting for the next batch.
+        """
+        return len(self._pending)
+
+    def _flush(self) -> None:
+        """
+        Submit everything that is pending, split into batches of at most `max_batch_size`.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+        for start in range(0, len(pending), self._max_batch_size):
+            batch = pending[start:start + self._max_batch_size]
+            task = loop.run_in_executor(get_inference_executor(), self._embed_fn, [image for image, _ in batch])
+            task.add_done_callback(lambda task, batch=batch: self._resolve(task, batch))
+
+    @staticmethod
+    def _resolve(task: asyncio.Future, batch: List[Tuple[np.ndarray, asyncio.Future]]) -> None:
+        """
+        Hand the result of a batched forward pass back to each waiting request.
+        """
+        error = task.exception()
+        embeddings = task.result() if error is None else None
+        for i, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(embeddings[i])
+
+EMBEDDING_BATCHER = EmbeddingBatcher(MODEL_REGISTRY.embed_faces, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS)
@@ -0,0 +1,130 @@
+"""
+Storage of the aligned face crops, so that the faces can be embedded again with
+another model without detecting them again, see src/reembedding.py.
+
+The crops of a tenant are JPEG images appended one after the other to a single pack
+file, `<crop_dir>/<tenant>.pack`, and each face records the offset and length of its
+crop in `faces.crop_offset` and `faces.crop_length`. A crop is read with one
+positioned read, and thousands of crops cost one file instead of thousands. Crops of
+deleted faces stay in the pack until the tenant is deleted.
+"""
+import os
+import threading
+import urllib.parse
+from typing import List, Tuple
+import cv2
+import numpy as np
+import toml
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where only one process may write crops: the lock below is per process
+    fcntl = None
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+CROP_DIR = config["paths"].get("crop_dir", os.path.join(config["paths"]["upload_dir"], "crops"))
+CROPS_CONFIG = config.get("crops", {})
+CROPS_ENABLED = CROPS_CONFIG.get("enabled", True)
+CROP_MAX_SIDE = CROPS_CONFIG.get("max_side", 224)
+CROP_QUALITY = CROPS_CONFIG.get("quality", 90)
+
+_append_lock = threading.Lock()
+
+def pack_path(tenant_id: str) -> str:
+    """
+    The pack file of a tenant, with the tenant ID escaped into a file name.
+    """
+    return os.path.join(CROP_DIR, urllib.parse.quote(tenant_id, safe="") + ".pack")
+
+def encode_crop(face: np.ndarray) -> bytes:
+    """
+    Compress an aligned face crop, downscaled to `max_side` if it is larger.
+
+    Args:
+        face (np.ndarray): An RGB face, either uint8 or scaled to [0, 1].
+
+    Returns:
+        bytes: The JPEG image.
+    """
+    if face.dtype != np.uint8:
+        face = np.clip(face * 255, 0, 255).astype(np.uint8)
+    height, width = face.shape[:2]
+    if max(height, width) > CROP_MAX_SIDE:
+        scale = CROP_MAX_SIDE / max(height, width)
+        face = cv2.resize(face, (max(round(width * scale), 1), max(round(height * scale), 1)), interpolation=cv2.INTER_AREA)
+    ok, data = cv2.imencode(".jpg", np.ascontiguousarray(face[:, :, ::-1]), [cv2.IMWRITE_JPEG_QUALITY, CROP_QUALITY])
+    if not ok:
+        raise ValueError("Could not encode the face crop")
+    return data.tobytes()
+
+def decode_crop(data: bytes) -> np.ndarray:
+    """
+    Decompress a face crop written by `encode_crop`.
+
+    Returns:
+        np.ndarray: The RGB face as uint8.
+    """
+    face = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if face is None:
+        raise ValueError("Corrupt face crop")
+    return face[:, :, ::-1]
+
+def append_crops(tenant_id: str, crops: List[bytes]) -> List[Tuple[int, int]]:
+    """
+    Append crops to the pack file of a tenant. Concurrent writers, in this process or
+    others, take turns on a lock of the file.
+
+    Args:
+        tenant_id (str): The tenant ID.
+        crops (List[bytes]): The encoded crops.
+
+    Returns:
+        list: The offset and length of each crop, in the same order.
+    """
+    if len(crops) == 0:
+        return []
+    os.makedirs(CROP_DIR, exist_ok=True)
+    with _append_lock, open(pack_path(tenant_id), "ab") as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        offset = file.seek(0, os.SEEK_END)
+        file.write(b"".join(crops))
+        # Flushed before the lock is released by closing the file
+        file.flush()
+    locations = []
+    for crop in crops:
+        locations.append((offset, len(crop)))
+        offset += len(crop)
+    return locations
+
+def read_crops(tenant_id: str, locations: List[Tuple[int, int]]) -> List[bytes]:
+    """
+    Read crops from the pack file of a tenant, in offset order to keep the reads sequential.
+
+    Args:
+        tenant_id (str): The tenant ID.
+        locations (List[Tuple[int, int]]): The offset and length of each crop.
+
+    Returns:
+        list: The encoded crops, in the order of `locations`.
+    """
+    crops: List[bytes] = [b""] * len(locations)
+    with open(pack_path(tenant_id), "rb") as file:
+        for i in sorted(range(len(locations)), key=lambda i: locations[i][0]):
+            offset, length = locations[i]
+            file.seek(offset)
+            crops[i] = file.read(length)
+            if len(crops[i]) != length:
+                raise ValueError(f"The crop pack of tenant {tenant_id} is truncated")
+    return crops
+
+def remove_crops(tenant_id: str) -> None:
+    """
+    Delete the pack file of a tenant, once the tenant is deleted.
+    """
+    try:
+        os.remove(pack_path(tenant_id))
+    except FileNotFoundError:
+        pass
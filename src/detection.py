@@ -0,0 +1,222 @@
+"""
+Face detection, configured per tenant under `[detection]` in config.toml.
+
+Detectors run on a copy of the image downscaled to `max_side`, and the boxes they
+return are mapped back to the original image, from which the faces are cropped and
+aligned. The cost of MTCNN grows with the number of pixels, so this makes detection
+on large photos much cheaper, while the crops keep their full resolution.
+
+A cascade can run a cheap detector first. With `cascade = "fallback"` its faces are
+kept and the main detector only runs when it finds none. With `cascade = "regions"`
+the main detector runs on the region around each of its candidates instead of on the
+whole image, and on the whole image when there is no candidate.
+
+    [detection]
+    max_side = 1600
+
+    [detection.tenants.my_tenant]
+    cascade = "regions"
+    prefilter_backend = "ssd"
+"""
+import dataclasses
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import cv2
+import numpy as np
+import toml
+from deepface.models.Detector import FacialAreaRegion
+from deepface.modules.detection import align_img_wrt_eyes, project_facial_area
+from src.metrics import DETECTOR_RUNS, timed
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+DETECTION_CONFIG = config.get("detection", {})
+
+CASCADES = ("none", "fallback", "regions")
+# Overlapping regions of a "regions" cascade can find the same face twice
+DUPLICATE_IOU = 0.5
+
+@dataclass(frozen=True)
+class DetectionSettings:
+    """
+    How the faces of a tenant's images are detected.
+
+    Attributes:
+        backend (str): The DeepFace detector backend whose faces are kept.
+        min_confidence (float): Faces below this detector confidence are dropped.
+        max_side (int): Longest side, in pixels, images are downscaled to before detection, 0 to detect at full resolution.
+        cascade (str): "none" to run `backend` alone, or "fallback" or "regions" to run `prefilter_backend` first.
+        prefilter_backend (str): The cheap detector backend of the cascade.
+        prefilter_min_confidence (float): Faces of the cheap detector below this confidence are not candidates.
+        region_margin (float): Margin around each candidate searched by a "regions" cascade, as a fraction of its size.
+    """
+    backend: str = "mtcnn"
+    min_confidence: float = 0.9
+    max_side: int = 0
+    cascade: str = "none"
+    prefilter_backend: str = "opencv"
+    prefilter_min_confidence: float = 0.8
+    region_margin: float = 0.5
+
+    def backends(self) -> List[str]:
+        """
+        List the detector backends these settings run.
+        """
+        return [self.backend] if self.cascade == "none" else [self.prefilter_backend, self.backend]
+
+def _parse_settings(values: Dict[str, Any], base: DetectionSettings) -> DetectionSettings:
+    settings = dataclasses.replace(base, **values)
+    if settings.cascade not in CASCADES:
+        raise ValueError(f"[detection] cascade must be one of {', '.join(CASCADES)}, not {settings.cascade}")
+    return settings
+
+DEFAULT_DETECTION = _parse_settings({key: value for key, value in DETECTION_CONFIG.items() if key != "tenants"}, DetectionSettings())
+# Tenants override any of the defaults under [detection.tenants.<tenant_id>]
+TENANT_DETECTION = {tenant_id: _parse_settings(values, DEFAULT_DETECTION) for tenant_id, values in DETECTION_CONFIG.get("tenants", {}).items()}
+# Every backend in use, loaded when the process starts
+DETECTOR_BACKENDS = sorted({backend for settings in [DEFAULT_DETECTION, *TENANT_DETECTION.values()] for backend in settings.backends()})
+
+def detection_settings(tenant_id: str) -> DetectionSettings:
+    """
+    Look up the detection settings of a tenant.
+
+    Args:
+        tenant_id (str): The tenant ID.
+
+    Returns:
+        DetectionSettings: The tenant's settings, or the defaults.
+    """
+    return TENANT_DETECTION.get(tenant_id, DEFAULT_DETECTION)
+
+def _scale_point(point: Optional[Tuple[int, int]], scale: float, dx: int = 0, dy: int = 0) -> Optional[Tuple[int, int]]:
+    if point is None:
+        return None
+    return (int(point[0] * scale) + dx, int(point[1] * scale) + dy)
+
+def _scale_region(region: FacialAreaRegion, scale: float, dx: int = 0, dy: int = 0) -> FacialAreaRegion:
+    """
+    Map a region found in a scaled or cropped copy of an image back to the image.
+    """
+    return FacialAreaRegion(
+        x=int(region.x * scale) + dx, y=int(region.y * scale) + dy, w=int(region.w * scale), h=int(region.h * scale),
+        left_eye=_scale_point(region.left_eye, scale, dx, dy), right_eye=_scale_point(region.right_eye, scale, dx, dy),
+        confidence=region.confidence,
+    )
+
+def _run_detector(detector: Any, backend: str, image: np.ndarray, max_side: int, scope: str) -> List[FacialAreaRegion]:
+    """
+    Run a detector on an image downscaled to `max_side`.
+
+    Returns:
+        list: The regions found, in the coordinates of `image`.
+    """
+    DETECTOR_RUNS.labels(backend, scope).inc()
+    height, width = image.shape[:2]
+    if max_side <= 0 or max(height, width) <= max_side:
+        return detector.detect_faces(image)
+    scale = max_side / max(height, width)
+    with timed("detection_downscale"):
+        small = cv2.resize(image, (max(round(width * scale), 1), max(round(height * scale), 1)), interpolation=cv2.INTER_AREA)
+    return [_scale_region(region, 1 / scale) for region in detector.detect_faces(small)]
+
+def _iou(a: FacialAreaRegion, b: FacialAreaRegion) -> float:
+    overlap_w = max(min(a.x + a.w, b.x + b.w) - max(a.x, b.x), 0)
+    overlap_h = max(min(a.y + a.h, b.y + b.h) - max(a.y, b.y), 0)
+    overlap = overlap_w * overlap_h
+    union = a.w * a.h + b.w * b.h - overlap
+    return overlap / union if union > 0 else 0.0
+
+def _detect_in_regions(detector: Any, backend: str, image: np.ndarray, candidates: List[FacialAreaRegion], settings: DetectionSettings) -> List[FacialAreaRegion]:
+    """
+    Run a detector on the region around each candidate, dropping faces found twice.
+    """
+    height, width = image.shape[:2]
+    regions: List[FacialAreaRegion] = []
+    for candidate in candidates:
+        margin = int(max(candidate.w, candidate.h) * settings.region_margin)
+        left, top = max(candidate.x - margin, 0), max(candidate.y - margin, 0)
+        right, bottom = min(candidate.x + candidate.w + margin, width), min(candidate.y + candidate.h + margin, height)
+        window = np.ascontiguousarray(image[top:bottom, left:right])
+        for region in _run_detector(detector, backend, window, settings.max_side, "region"):
+            region = _scale_region(region, 1, left, top)
+            duplicate = next((i for i, kept in enumerate(regions) if _iou(kept, region) > DUPLICATE_IOU), None)
+            if duplicate is None:
+                regions.append(region)
+            elif region.confidence > regions[duplicate].confidence:
+                regions[duplicate] = region
+    return regions
+
+def _extract_face(image: np.ndarray, region: FacialAreaRegion) -> np.ndarray:
+    """
+    Crop a face from the full-resolution image and align it on its eyes, as DeepFace
+    does but rotating only a window around the face instead of the whole image.
+
+    Returns:
+        np.ndarray: The aligned RGB face scaled to [0, 1].
+    """
+    height, width = image.shape[:2]
+    x, y, w, h = int(region.x), int(region.y), int(region.w), int(region.h)
+    margin = max(w, h)
+    left, top, right, bottom = x - margin, y - margin, x + w + margin, y + h + margin
+    window = image[max(top, 0):min(bottom, height), max(left, 0):min(right, width)]
+    # Black where the window leaves the image, like the border DeepFace adds
+    window = cv2.copyMakeBorder(window, max(-top, 0), max(bottom - height, 0), max(-left, 0), max(right - width, 0), cv2.BORDER_CONSTANT, value=[0, 0, 0])
+    aligned, angle = align_img_wrt_eyes(window, _scale_point(region.left_eye, 1, -left, -top), _scale_point(region.right_eye, 1, -left, -top))
+    x1, y1, x2, y2 = project_facial_area((x - left, y - top, x - left + w, y - top + h), angle, (window.shape[0], window.shape[1]))
+    return aligned[int(y1):int(y2), int(x1):int(x2), ::-1] / 255
+
+def extract_faces(image: np.ndarray, settings: DetectionSettings, get_detector: Callable[[str], Any]) -> List[Dict[str, Any]]:
+    """
+    Detect and align the faces in an image.
+
+    Args:
+        image (np.ndarray): A BGR image.
+        settings (DetectionSettings): The detection settings of the tenant.
+        get_detector (Callable[[str], Any]): Returns the DeepFace detector of a backend.
+
+    Returns:
+        list: The faces in the format of `DeepFace.extract_faces`, with `face`, `facial_area` and `confidence`.
+
+    Raises:
+        ValueError: If no face is detected, as `DeepFace.extract_faces` does.
+    """
+    # The detectors run OpenCV on the array, which needs it contiguous
+    image = np.ascontiguousarray(image)
+    height, width = image.shape[:2]
+    detector = get_detector(settings.backend)
+    if settings.cascade == "none":
+        regions = _run_detector(detector, settings.backend, image, settings.max_side, "image")
+    else:
+        with timed("detection_prefilter"):
+            candidates = [
+                region for region in _run_detector(get_detector(settings.prefilter_backend), settings.prefilter_backend, image, settings.max_side, "image")
+                if region.confidence >= settings.prefilter_min_confidence
+            ]
+        if len(candidates) == 0:
+            regions = _run_detector(detector, settings.backend, image, settings.max_side, "image")
+        elif settings.cascade == "fallback":
+            regions = candidates
+        else:
+            regions = _detect_in_regions(detector, settings.backend, image, candidates, settings)
+
+    faces = []
+    for region in regions:
+        face = _extract_face(image, region)
+        if face.shape[0] == 0 or face.shape[1] == 0:
+            continue
+        x, y = max(0, int(region.x)), max(0, int(region.y))
+        faces.append({
+            "face": face,
+            "facial_area": {
+                "x": x,
+                "y": y,
+                "w": min(width - x - 1, int(region.w)),
+                "h": min(height - y - 1, int(region.h)),
+                "left_eye": region.left_eye,
+                "right_eye": region.right_eye,
+            },
+            "confidence": round(region.confidence, 2),
+        })
+    if len(faces) == 0:
+        raise ValueError("Face could not be detected")
+    return faces
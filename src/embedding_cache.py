@@ -0,0 +1,277 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import psycopg2
+import toml
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+CACHE_CONFIG = config.get("embedding_cache", {})
+CACHE_ENABLED = CACHE_CONFIG.get("enabled", False)
+CACHE_MEMORY_BUDGET_MB = CACHE_CONFIG.get("memory_budget_mb", 512)
+CACHE_MIN_FACES = CACHE_CONFIG.get("min_faces", 10000)
+CACHE_TTL_SECONDS = CACHE_CONFIG.get("ttl_seconds", 300)
+
+# Rough per-face cost of the id and cluster id strings kept next to the matrix
+_BYTES_PER_FACE_METADATA = 200
+
+TenantRows = List[Tuple[str, str, str, List[float]]]
+
+class TenantEmbeddings:
+    """
+    The faces of one tenant as a contiguous float32 matrix of L2-normalized rows, so
+    cosine distance to every face is a single matrix product.
+
+    Rows are kept dense: removing a face moves the last row into its slot.
+    """
+
+    def __init__(self, rows: TenantRows, dimension: int) -> None:
+        self.face_ids: List[str] = [row[0] for row in rows]
+        self.image_ids: List[str] = [row[1] for row in rows]
+        self.cluster_ids: List[str] = [row[2] for row in rows]
+        self.size = len(rows)
+        self.matrix = np.zeros((max(self.size, 16), dimension), dtype=np.float32)
+        if self.size > 0:
+            self.matrix[:self.size] = _normalize(np.asarray([row[3] for row in rows], dtype=np.float32))
+        self.rows: Dict[str, int] = {face_id: i for i, face_id in enumerate(self.face_ids)}
+        self.loaded_at = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.size * _BYTES_PER_FACE_METADATA
+
+    def add(self, face_id: str, image_id: str, cluster_id: str, embedding: List[float]) -> None:
+        if face_id in self.rows:
+            return
+        if self.size == self.matrix.shape[0]:
+            grown = np.zeros((self.matrix.shape[0] * 2, self.matrix.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.matrix[:self.size]
+            self.matrix = grown
+        self.matrix[self.size] = _normalize(np.asarray([embedding], dtype=np.float32))[0]
+        self.face_ids.append(face_id)
+        self.image_ids.append(image_id)
+        self.cluster_ids.append(cluster_id)
+        self.rows[face_id] = self.size
+        self.size += 1
+
+    def remove(self, face_id: str) -> None:
+        row = self.rows.pop(face_id, None)
+        if row is None:
+            return
+        last = self.size - 1
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.face_ids[row] = self.face_ids[last]
+            self.image_ids[row] = self.image_ids[last]
+            self.cluster_ids[row] = self.cluster_ids[last]
+            self.rows[self.face_ids[row]] = row
+        self.face_ids.pop()
+        self.image_ids.pop()
+        self.cluster_ids.pop()
+        self.size = last
+
+    def remove_where(self, image_id: Optional[str] = None, cluster_id: Optional[str] = None) -> None:
+        face_ids = [
+            face_id for i, face_id in enumerate(self.face_ids)
+            if (image_id is not None and self.image_ids[i] == image_id) or (cluster_id is not None and self.cluster_ids[i] == cluster_id)
+        ]
+        for face_id in face_ids:
+            self.remove(face_id)
+
+    def move(self, face_id: str, cluster_id: str) -> None:
+        row = self.rows.get(face_id)
+        if row is not None:
+            self.cluster_ids[row] = cluster_id
+
+    def nearest(self, embeddings: List[List[float]]) -> List[Optional[Tuple[str, str, float]]]:
+        """
+        Find the closest face to each query with one matrix-matrix product.
+
+        Returns:
+            list: (face ID, cluster ID, cosine distance) per query, None if the tenant has no faces.
+        """
+        if self.size == 0:
+            return [None for _ in embeddings]
+        queries = _normalize(np.asarray(embeddings, dtype=np.float32))
+        similarities = self.matrix[:self.size] @ queries.T
+        best_rows = np.argmax(similarities, axis=0)
+        return [
+            (self.face_ids[row], self.cluster_ids[row], float(1.0 - similarities[row, i]))
+            for i, row in enumerate(best_rows)
+        ]
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class EmbeddingCache:
+    """
+    An in-process, per-tenant cache of face embeddings used to match new faces without
+    querying Postgres.
+
+    Tenants are loaded lazily on their first match once they hold at least `min_faces`
+    faces, and the least recently used ones are evicted to stay within the memory
+    budget. The write functions in src/sql.py keep cached tenants current: their
+    changes are queued on the connection and applied once the transaction commits,
+    so concurrent matches never see faces or clusters that may still be rolled back.
+
+    Each server process has its own cache and only sees its own writes, so with
+    several workers a tenant is also reloaded `ttl_seconds` after it was loaded.
+    """
+
+    def __init__(self, enabled: bool, memory_budget_bytes: int, min_faces: int, ttl_seconds: float) -> None:
+        self.enabled = enabled
+        self.memory_budget_bytes = memory_budget_bytes
+        self.min_faces = min_faces
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.RLock()
+        self._tenants: "OrderedDict[str, TenantEmbeddings]" = OrderedDict()
+        self._skipped: Dict[str, float] = {}
+        self._writes: Dict[str, int] = {}
+        self._clears = 0
+
+    def match(self, cur: psycopg2.extensions.cursor, tenant_id: str, embeddings: List[List[float]], similarity_threshold: float,
+              count_faces: Callable[[psycopg2.extensions.cursor, str], int],
+              load_faces: Callable[[psycopg2.extensions.cursor, str], TenantRows]) -> Optional[List[List[Tuple[str, str, float]]]]:
+        """
+        Match faces against the cached embeddings of a tenant, loading it if needed.
+
+        Args:
+            cur (psycopg2.extensions.cursor): Database cursor object, used to load the tenant.
+            tenant_id (str): The tenant ID.
+            embeddings (List[List[float]]): The embedding vectors of the new faces.
+            similarity_threshold (float): The similarity threshold for matching faces.
+            count_faces (Callable): Returns the number of faces of a tenant.
+            load_faces (Callable): Returns (face ID, image ID, cluster ID, embedding) rows of a tenant.
+
+        Returns:
+            Optional[list]: Per query, a list with the best match within the threshold (or
+            empty), or None if the tenant is not cached and should be matched in Postgres.
+        """
+        tenant = self._get(cur, tenant_id, len(embeddings[0]), count_faces, load_faces)
+        if tenant is None:
+            return None
+        with self._lock:
+            nearest = tenant.nearest(embeddings)
+        return [[match] if match is not None and match[2] <= similarity_threshold else [] for match in nearest]
+
+    def _get(self, cur: psycopg2.extensions.cursor, tenant_id: str, dimension: int,
+             count_faces: Callable[[psycopg2.extensions.cursor, str], int],
+             load_faces: Callable[[psycopg2.extensions.cursor, str], TenantRows]) -> Optional[TenantEmbeddings]:
+        now = time.monotonic()
+        with self._lock:
+            tenant = self._tenants.get(tenant_id)
+            # Another dimension means the faces were switched to another model since
+            if tenant is not None and now - tenant.loaded_at < self.ttl_seconds and tenant.matrix.shape[1] == dimension:
+                self._tenants.move_to_end(tenant_id)
+                return tenant
+            if self._skipped.get(tenant_id, 0.0) > now:
+                return None
+            writes_before = (self._writes.get(tenant_id, 0), self._clears)
+
+        number_of_faces = count_faces(cur, tenant_id)
+        estimated_bytes = number_of_faces * (dimension * 4 + _BYTES_PER_FACE_METADATA)
+        if number_of_faces < self.min_faces or estimated_bytes > self.memory_budget_bytes:
+            with self._lock:
+                self._tenants.pop(tenant_id, None)
+                self._skipped[tenant_id] = now + self.ttl_seconds
+            return None
+
+        tenant = TenantEmbeddings(load_faces(cur, tenant_id), dimension)
+        with self._lock:
+            if (self._writes.get(tenant_id, 0), self._clears) != writes_before:
+                # A write landed while loading, the snapshot may already be stale
+                return tenant
+            self._tenants[tenant_id] = tenant
+            self._tenants.move_to_end(tenant_id)
+            self._evict()
+        return tenant
+
+    def _evict(self) -> None:
+        total = sum(tenant.nbytes for tenant in self._tenants.values())
+        while total > self.memory_budget_bytes and len(self._tenants) > 1:
+            _, evicted = self._tenants.popitem(last=False)
+            total -= evicted.nbytes
+
+    def _write(self, cur: psycopg2.extensions.cursor, tenant_id: str, change: Callable[[TenantEmbeddings], None]) -> None:
+        """
+        Apply a write to the cached embeddings of a tenant once the writer's transaction
+        commits. Counting the write then also keeps a load that started before the
+        commit from caching a snapshot without it.
+        """
+        if not self.enabled:
+            return
+        on_commit = getattr(cur.connection, "on_commit", None)
+        if on_commit is None:
+            # A connection without the hook: drop the tenant rather than show uncommitted rows
+            self.invalidate(tenant_id)
+            return
+
+        def apply() -> None:
+            with self._lock:
+                self._writes[tenant_id] = self._writes.get(tenant_id, 0) + 1
+                tenant = self._tenants.get(tenant_id)
+                if tenant is not None:
+                    change(tenant)
+        on_commit.append(apply)
+
+    def add_face(self, cur: psycopg2.extensions.cursor, tenant_id: str, face_id: str, image_id: str, cluster_id: str, embedding: List[float]) -> None:
+        self._write(cur, tenant_id, lambda tenant: tenant.add(face_id, image_id, cluster_id, embedding))
+
+    def remove_face(self, cur: psycopg2.extensions.cursor, tenant_id: str, face_id: str) -> None:
+        self._write(cur, tenant_id, lambda tenant: tenant.remove(face_id))
+
+    def remove_faces_by_image(self, cur: psycopg2.extensions.cursor, tenant_id: str, image_id: str) -> None:
+        self._write(cur, tenant_id, lambda tenant: tenant.remove_where(image_id=image_id))
+
+    def remove_faces_by_cluster(self, cur: psycopg2.extensions.cursor, tenant_id: str, cluster_id: str, image_ids: List[str]) -> None:
+        """
+        Remove the faces of a cluster found in some of its images, as one chunk of a
+        cluster deletion does.
+        """
+        image_id_set = set(image_ids)
+
+        def remove(tenant: TenantEmbeddings) -> None:
+            for face_id in [face_id for i, face_id in enumerate(tenant.face_ids) if tenant.cluster_ids[i] == cluster_id and tenant.image_ids[i] in image_id_set]:
+                tenant.remove(face_id)
+        self._write(cur, tenant_id, remove)
+
+    def move_face(self, cur: psycopg2.extensions.cursor, tenant_id: str, face_id: str, cluster_id: str) -> None:
+        self._write(cur, tenant_id, lambda tenant: tenant.move(face_id, cluster_id))
+
+    def invalidate(self, tenant_id: str, cur: Optional[psycopg2.extensions.cursor] = None) -> None:
+        """
+        Drop a tenant from the cache, it is reloaded on its next match.
+
+        Args:
+            tenant_id (str): The tenant ID.
+            cur (Optional[psycopg2.extensions.cursor]): The cursor of a transaction rewriting the tenant, to drop it
+                again once it commits, in case a match reloaded it in the meantime.
+        """
+        with self._lock:
+            self._writes[tenant_id] = self._writes.get(tenant_id, 0) + 1
+            self._tenants.pop(tenant_id, None)
+            self._skipped.pop(tenant_id, None)
+        on_commit = getattr(cur.connection, "on_commit", None) if cur is not None else None
+        if on_commit is not None:
+            on_commit.append(lambda: self.invalidate(tenant_id))
+
+    def clear(self, cur: Optional[psycopg2.extensions.cursor] = None) -> None:
+        """
+        Drop every tenant from the cache, as when the faces are switched to another model.
+
+        Args:
+            cur (Optional[psycopg2.extensions.cursor]): The cursor of the transaction switching the faces, to drop
+                them again once it commits.
+        """
+        with self._lock:
+            self._clears += 1
+            self._tenants.clear()
+            self._skipped.clear()
+        on_commit = getattr(cur.connection, "on_commit", None) if cur is not None else None
+        if on_commit is not None:
+            on_commit.append(self.clear)
+
+EMBEDDING_CACHE = EmbeddingCache(CACHE_ENABLED, CACHE_MEMORY_BUDGET_MB * 1024 * 1024, CACHE_MIN_FACES, CACHE_TTL_SECONDS)
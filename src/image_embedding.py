@@ -0,0 +1,194 @@
+"""
+The whole-image embedding stored in `images.embedding`, configured per tenant under
+`[image_embedding]` in config.toml.
+
+`mode` decides when it is computed:
+
+- "eager" computes it while the image is inserted.
+- "lazy" leaves it NULL until a backfill job computes the missing ones, queued by
+  POST /image-embeddings or from the command line, once a feature needs them.
+- "off" never computes it.
+
+`descriptor` decides what it is: "facenet" runs the face model over the whole
+image, an extra forward pass per upload, while "thumbnail" is a cheap global
+descriptor of the image's layout and colours computed on the CPU in well under a
+millisecond. The first has the dimension of the face model, the second 128, and
+both are compared by cosine distance, but they are not comparable with each other:
+backfill with `--recompute` after changing it.
+
+    python -m src.image_embedding --tenant-id my_tenant               # compute the missing embeddings
+    python -m src.image_embedding --tenant-id my_tenant --recompute   # recompute all of them
+"""
+import argparse
+import dataclasses
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+import psycopg2
+import toml
+from PIL import Image
+from src.models import MODEL_REGISTRY
+from src.sql import sql_get_images_to_embed, sql_set_image_embeddings
+from src.utils import get_db_connection
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+UPLOAD_DIR = config["paths"]["upload_dir"]
+IMAGE_EMBEDDING_CONFIG = config.get("image_embedding", {})
+BACKFILL_BATCH_SIZE = IMAGE_EMBEDDING_CONFIG.get("backfill_batch_size", 32)
+
+MODES = ("eager", "lazy", "off")
+DESCRIPTORS = ("facenet", "thumbnail")
+BACKFILL_JOB_KIND = "backfill_image_embeddings"
+
+@dataclass(frozen=True)
+class ImageEmbeddingSettings:
+    """
+    How the whole-image embeddings of a tenant are computed.
+
+    Attributes:
+        mode (str): "eager" at insertion, "lazy" by a backfill job, or "off".
+        descriptor (str): "facenet" or "thumbnail".
+    """
+    mode: str = "lazy"
+    descriptor: str = "facenet"
+
+    @property
+    def embeds_with_face_model(self) -> bool:
+        """
+        Whether the insert pipeline passes the whole image to the face model.
+        """
+        return self.mode == "eager" and self.descriptor == "facenet"
+
+def _parse_settings(values: Dict[str, Any], base: ImageEmbeddingSettings) -> ImageEmbeddingSettings:
+    settings = dataclasses.replace(base, **{key: value for key, value in values.items() if key in ("mode", "descriptor")})
+    if settings.mode not in MODES:
+        raise ValueError(f"[image_embedding] mode must be one of {', '.join(MODES)}, not {settings.mode}")
+    if settings.descriptor not in DESCRIPTORS:
+        raise ValueError(f"[image_embedding] descriptor must be one of {', '.join(DESCRIPTORS)}, not {settings.descriptor}")
+    return settings
+
+DEFAULT_IMAGE_EMBEDDING = _parse_settings(IMAGE_EMBEDDING_CONFIG, ImageEmbeddingSettings())
+# Tenants override the defaults under [image_embedding.tenants.<tenant_id>]
+TENANT_IMAGE_EMBEDDING = {tenant_id: _parse_settings(values, DEFAULT_IMAGE_EMBEDDING) for tenant_id, values in IMAGE_EMBEDDING_CONFIG.get("tenants", {}).items()}
+
+def image_embedding_settings(tenant_id: str) -> ImageEmbeddingSettings:
+    """
+    Look up the whole-image embedding settings of a tenant.
+
+    Args:
+        tenant_id (str): The tenant ID.
+
+    Returns:
+        ImageEmbeddingSettings: The tenant's settings, or the defaults.
+    """
+    return TENANT_IMAGE_EMBEDDING.get(tenant_id, DEFAULT_IMAGE_EMBEDDING)
+
+def thumbnail_descriptor(image: Image.Image) -> List[float]:
+    """
+    Describe an image by an 8x8 grayscale thumbnail and a 64-bin colour histogram.
+
+    The thumbnail is centred on its mean so that brightness does not dominate, and the
+    histogram is square-rooted so that one large colour area does not either. Each
+    half is L2-normalized, so both weigh the same in the cosine distance.
+
+    Args:
+        image (Image.Image): An RGB image.
+
+    Returns:
+        list: The 128-dimensional unit vector.
+    """
+    thumbnail = np.asarray(image.convert("L").resize((8, 8), Image.BILINEAR), dtype=np.float32).ravel()
+    thumbnail -= thumbnail.mean()
+    # Four levels per channel
+    levels = np.asarray(image.resize((64, 64), Image.BILINEAR), dtype=np.uint8) // 64
+    bins = (levels[:, :, 0].astype(np.int64) * 16 + levels[:, :, 1] * 4 + levels[:, :, 2]).ravel()
+    histogram = np.sqrt(np.bincount(bins, minlength=64).astype(np.float32))
+    halves = [half / max(float(np.linalg.norm(half)), 1e-12) for half in (thumbnail, histogram)]
+    return (np.concatenate(halves) / np.sqrt(2)).tolist()
+
+def embed_images(images: List[Image.Image], descriptor: str) -> List[List[float]]:
+    """
+    Compute the whole-image embeddings of several images.
+
+    Args:
+        images (List[Image.Image]): RGB images.
+        descriptor (str): "facenet" or "thumbnail".
+
+    Returns:
+        list: One embedding per image, in the same order.
+    """
+    if descriptor == "thumbnail":
+        return [thumbnail_descriptor(image) for image in images]
+    return MODEL_REGISTRY.embed_faces([np.asarray(image) for image in images])
+
+def upload_path(image_id: str) -> str:
+    """
+    The path an upload was saved to by the insert endpoints.
+    """
+    return os.path.join(UPLOAD_DIR, f"{image_id}.jpg")
+
+def backfill_image_embeddings(conn: psycopg2.extensions.connection, tenant_id: str, descriptor: str, recompute: bool = False,
+                              on_batch: Optional[Callable[[psycopg2.extensions.cursor], None]] = None) -> Dict[str, int]:
+    """
+    Compute the missing whole-image embeddings of a tenant from the saved uploads,
+    `BACKFILL_BATCH_SIZE` images per transaction. Images whose upload is no longer on
+    disk are skipped.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each batch.
+        tenant_id (str): The tenant ID.
+        descriptor (str): "facenet" or "thumbnail".
+        recompute (bool): Also recompute the embeddings that already exist.
+        on_batch (Optional[Callable[[psycopg2.extensions.cursor], None]]): Called in the transaction of each batch.
+
+    Returns:
+        dict: The number of images embedded and of images whose upload is missing.
+    """
+    embedded = missing = 0
+    after_image_id = ""
+    while True:
+        with conn.cursor() as cur:
+            image_ids = sql_get_images_to_embed(cur, tenant_id, after_image_id, BACKFILL_BATCH_SIZE, recompute)
+        conn.rollback()
+        if len(image_ids) == 0:
+            break
+        after_image_id = image_ids[-1]
+
+        loaded: List[Tuple[str, Image.Image]] = []
+        for image_id in image_ids:
+            path = upload_path(image_id)
+            if os.path.exists(path):
+                with Image.open(path) as image:
+                    loaded.append((image_id, image.convert("RGB")))
+            else:
+                missing += 1
+        embeddings = embed_images([image for _, image in loaded], descriptor)
+        with conn.cursor() as cur:
+            sql_set_image_embeddings(cur, tenant_id, [(image_id, embedding) for (image_id, _), embedding in zip(loaded, embeddings)])
+            if on_batch is not None:
+                on_batch(cur)
+        conn.commit()
+        embedded += len(loaded)
+    return {"embedded": embedded, "missing_uploads": missing}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenant-id", required=True, help="Tenant whose images to embed")
+    parser.add_argument("--descriptor", choices=DESCRIPTORS, help="Descriptor to compute, by default the tenant's")
+    parser.add_argument("--recompute", action="store_true", help="Recompute the embeddings that already exist")
+    args = parser.parse_args()
+
+    descriptor = args.descriptor or image_embedding_settings(args.tenant_id).descriptor
+    start = time.perf_counter()
+    conn = get_db_connection()
+    try:
+        result = backfill_image_embeddings(conn, args.tenant_id, descriptor, args.recompute)
+    finally:
+        conn.close()
+    print(f"Embedded {result['embedded']} images with {descriptor} in {time.perf_counter() - start:.1f}s, {result['missing_uploads']} uploads missing")
+
+if __name__ == "__main__":
+    main()
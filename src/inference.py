@@ -0,0 +1,65 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+import toml
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+INFERENCE_WORKERS = config.get("inference", {}).get("workers", os.cpu_count() or 1)
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+def get_inference_executor() -> ThreadPoolExecutor:
+    """
+    Get the executor that runs detection and embedding, creating it on first use.
+
+    A thread pool is used rather than a process pool so that every worker shares the
+    single copy of the models held by the model registry. TensorFlow, PIL and NumPy
+    release the GIL in their heavy kernels, so inference still spreads across cores.
+
+    Returns:
+        ThreadPoolExecutor: The inference executor.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+    return _executor
+
+def shutdown_inference_executor() -> None:
+    """
+    Shut down the inference executor, waiting for running jobs to finish.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+async def run_inference(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Run a blocking inference function on the inference executor and await its result.
+
+    Args:
+        fn (Callable): The blocking function to run.
+        *args: Positional arguments for `fn`.
+        **kwargs: Keyword arguments for `fn`.
+
+    Returns:
+        Any: The return value of `fn`.
+    """
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context so that stage timings reach its request
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_inference_executor(), functools.partial(context.run, fn, *args, **kwargs))
+
+def inference_queue_size() -> int:
+    """
+    Count the tasks waiting for an inference thread.
+
+    Returns:
+        int: The number of queued tasks, 0 if the executor has not been created.
+    """
+    # ThreadPoolExecutor has no public accessor for its queue
+    return _executor._work_queue.qsize() if _executor is not None else 0
@@ -0,0 +1,142 @@
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Generator, Iterator, List, Optional, Tuple
+import toml
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+METRICS_CONFIG = config.get("metrics", {})
+SERVER_TIMING_ENABLED = METRICS_CONFIG.get("server_timing", False)
+
+# Buckets from 1 ms to 30 s, the pipeline stages and queries span that whole range
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HTTP_REQUEST_SECONDS = Histogram("facerec_http_request_seconds", "Time spent handling HTTP requests.", ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram("facerec_stage_seconds", "Time spent in each stage of the insert pipeline.", ["stage"], buckets=LATENCY_BUCKETS)
+SQL_SECONDS = Histogram("facerec_sql_seconds", "Time spent in each function of src/sql.py.", ["function"], buckets=LATENCY_BUCKETS)
+EMBEDDING_BATCH_SIZE = Histogram("facerec_embedding_batch_size", "Images per forward pass of the face model.", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+FACES_DETECTED = Counter("facerec_faces_detected_total", "Faces returned by the detector.")
+FACES_REJECTED = Counter("facerec_faces_rejected_total", "Detected faces dropped for a confidence below [detection] min_confidence.")
+DETECTOR_RUNS = Counter("facerec_detector_runs_total", "Detector passes, over a whole image or over the region around a cascade candidate.", ["backend", "scope"])
+DUPLICATE_UPLOADS = Counter("facerec_duplicate_uploads_total", "Uploads recognised as duplicates of an existing image.", ["action"])
+
+# The stage timings of the current request, reported in its Server-Timing header
+_request_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar("request_timings", default=None)
+
+@contextmanager
+def timed(stage: str) -> Generator[None, None, None]:
+    """
+    Time a stage of the pipeline into the stage histogram and the Server-Timing header.
+
+    Args:
+        stage (str): The name of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+def timed_sql(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Decorate a function of src/sql.py to time every call into the SQL histogram.
+
+    Args:
+        fn (Callable): The query function.
+
+    Returns:
+        Callable: The timed function.
+    """
+    histogram = SQL_SECONDS.labels(fn.__name__)
+
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            histogram.observe(elapsed)
+            timings = _request_timings.get()
+            if timings is not None:
+                timings.append((fn.__name__, elapsed))
+    return wrapper
+
+def start_request_timings() -> contextvars.Token:
+    """
+    Start collecting the stage timings of a request, when Server-Timing is enabled.
+
+    Returns:
+        contextvars.Token: The token to pass to `finish_request_timings`.
+    """
+    return _request_timings.set([] if SERVER_TIMING_ENABLED else None)
+
+def finish_request_timings(token: contextvars.Token) -> Optional[str]:
+    """
+    Stop collecting the stage timings of a request and format them.
+
+    Args:
+        token (contextvars.Token): The token returned by `start_request_timings`.
+
+    Returns:
+        Optional[str]: The value of the Server-Timing header, or None.
+    """
+    timings = _request_timings.get()
+    _request_timings.reset(token)
+    if not timings:
+        return None
+    # A stage can run several times per request (one query per face, ...), sum them
+    totals = {}
+    for stage, elapsed in timings:
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    return ", ".join(f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in totals.items())
+
+class RuntimeCollector:
+    """
+    Reports the state of the connection pool and of the work queues when scraped.
+
+    Args:
+        sources (Callable): Returns the pool statistics, the number of images waiting for
+            the embedding batcher, the number of tasks waiting for the inference executor,
+            and the number of jobs per status. Any of them may be None if unavailable.
+    """
+
+    def __init__(self, sources: Callable[[], Tuple[Optional[dict], Optional[int], Optional[int], Optional[dict]]]) -> None:
+        self._sources = sources
+
+    def collect(self) -> Iterator[Any]:
+        pool_stats, batcher_pending, executor_pending, jobs = self._sources()
+        if pool_stats is not None:
+            yield GaugeMetricFamily("facerec_db_pool_in_use", "Database connections currently borrowed from the pool.", value=pool_stats["in_use"])
+            yield GaugeMetricFamily("facerec_db_pool_max_size", "Maximum number of database connections in the pool.", value=pool_stats["max_size"])
+            yield CounterMetricFamily("facerec_db_pool_acquired", "Connections handed out by the pool.", value=pool_stats["acquired"])
+            yield CounterMetricFamily("facerec_db_pool_timeouts", "Requests that gave up waiting for a connection.", value=pool_stats["timeouts"])
+            yield CounterMetricFamily("facerec_db_pool_discarded", "Broken connections replaced by the pool.", value=pool_stats["discarded"])
+            yield CounterMetricFamily("facerec_db_pool_acquire_seconds", "Time spent waiting for a connection.", value=pool_stats["acquire_seconds_total"])
+            yield GaugeMetricFamily("facerec_db_pool_acquire_seconds_max", "Longest wait for a connection.", value=pool_stats["acquire_seconds_max"])
+        if batcher_pending is not None:
+            yield GaugeMetricFamily("facerec_embedding_queue_size", "Images waiting to be embedded.", value=batcher_pending)
+        if executor_pending is not None:
+            yield GaugeMetricFamily("facerec_inference_queue_size", "Tasks waiting for an inference thread.", value=executor_pending)
+        if jobs is not None:
+            family = GaugeMetricFamily("facerec_jobs", "Jobs in the queue table by status.", labels=["status"])
+            for status, count in jobs.items():
+                family.add_metric([status], count)
+            yield family
+
+def register_runtime_collector(sources: Callable[[], Tuple[Optional[dict], Optional[int], Optional[int], Optional[dict]]]) -> None:
+    """
+    Register the collector for the pool and queue metrics with the default registry.
+
+    Args:
+        sources (Callable): See `RuntimeCollector`.
+    """
+    REGISTRY.register(RuntimeCollector(sources))
@@ -0,0 +1,255 @@
+import hashlib
+import threading
+import time
+from typing import Any, Dict, List, Optional
+import cv2
+import numpy as np
+import tensorflow as tf
+import toml
+from deepface import DeepFace
+from deepface.modules import preprocessing
+from src.detection import DEFAULT_DETECTION, DETECTOR_BACKENDS, DetectionSettings, extract_faces
+from src.metrics import EMBEDDING_BATCH_SIZE, timed
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+INFERENCE_CONFIG = config.get("inference", {})
+FAKE_MODELS = INFERENCE_CONFIG.get("fake_models", False)
+# 0 leaves TensorFlow's default of one thread per core
+INTRA_OP_THREADS = INFERENCE_CONFIG.get("intra_op_threads", 0)
+INTER_OP_THREADS = INFERENCE_CONFIG.get("inter_op_threads", 0)
+
+# The DeepFace model that embeds faces until the face_model table is read. The
+# processes follow the model recorded there, which src/reembedding.py switches.
+FACE_MODEL_NAME = INFERENCE_CONFIG.get("model_name", "Facenet")
+FACENET_DIMENSION = 128
+
+class ModelRegistry:
+    """
+    Process-wide registry that builds the DeepFace models once and keeps them alive.
+
+    DeepFace caches every model it builds, so loading them here means that later
+    `DeepFace.represent` and `DeepFace.extract_faces` calls reuse the same instances
+    instead of paying the load cost on the first request.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        # The face model that embeds faces, see `use_face_model`
+        self.face_model_name = FACE_MODEL_NAME
+        # The face models built so far, by name: the current one is built by `load`,
+        # the others on first use
+        self.face_models: Dict[str, Any] = {}
+        self.detectors: Dict[str, Any] = {}
+        self.load_seconds: Optional[float] = None
+        self.error: Optional[str] = None
+        # Read by `load`, the pre-fork launcher lowers them to share the cores between workers
+        self.intra_op_threads = INTRA_OP_THREADS
+        self.inter_op_threads = INTER_OP_THREADS
+
+    def is_ready(self) -> bool:
+        """
+        Check whether the models are loaded and warmed up.
+
+        Returns:
+            bool: True if the models are ready to serve requests.
+        """
+        return self._ready.is_set()
+
+    def load(self) -> None:
+        """
+        Build the face recognition and detection models and run a warm-up inference.
+
+        Safe to call from several threads; only the first call does the work and the
+        others wait until it has finished.
+
+        Raises:
+            Exception: If the models cannot be built.
+        """
+        with self._lock:
+            if self._ready.is_set():
+                return
+            start = time.perf_counter()
+            try:
+                self._pin_threads()
+                self.face_models[self.face_model_name] = DeepFace.build_model(self.face_model_name, task="facial_recognition")
+                for backend in DETECTOR_BACKENDS:
+                    self.detectors[backend] = DeepFace.build_model(backend, task="face_detector")
+                self._warm_up()
+            except Exception as e:
+                self.error = str(e)
+                raise
+            self.load_seconds = time.perf_counter() - start
+            self.error = None
+            self._ready.set()
+            print(f"Loaded {self.face_model_name} and {', '.join(DETECTOR_BACKENDS)} in {self.load_seconds:.2f}s")
+
+    def detect_faces(self, image: np.ndarray, settings: Optional[DetectionSettings] = None) -> List[Dict[str, Any]]:
+        """
+        Detect and align the faces in an image, see src/detection.py.
+        
+        Args:
+            image (np.ndarray): A BGR image array.
+            settings (Optional[DetectionSettings]): The detection settings of the tenant, by default those of [detection].
+        
+        Returns:
+            list: The DeepFace face objects with `face`, `facial_area` and `confidence`.
+        """
+        self.load()
+        return extract_faces(image, settings or DEFAULT_DETECTION, self.detector)
+
+    def detector(self, backend: str) -> Any:
+        """
+        Get the DeepFace detector of a backend. The backends of config.toml are built
+        by `load`, any other on first use.
+        
+        Args:
+            backend (str): The detector backend.
+        
+        Returns:
+            Any: The detector.
+        """
+        if backend not in self.detectors:
+            self.detectors[backend] = DeepFace.build_model(backend, task="face_detector")
+        return self.detectors[backend]
+
+    def use_face_model(self, model_name: str) -> bool:
+        """
+        Embed faces with another model by default, once the stored faces have been
+        switched to it. Called before `load`, it is the model that gets loaded;
+        afterwards, it is built on first use.
+        
+        Args:
+            model_name (str): The DeepFace model name.
+        
+        Returns:
+            bool: Whether the model changed.
+        """
+        if model_name == self.face_model_name:
+            return False
+        self.face_model_name = model_name
+        return True
+
+    def recognition_model(self, model_name: str) -> Any:
+        """
+        Get a DeepFace face model: the current one, built by `load`, or another one,
+        built on first use.
+        
+        Args:
+            model_name (str): The DeepFace model name.
+        
+        Returns:
+            Any: The face model.
+        """
+        if model_name not in self.face_models and model_name == self.face_model_name:
+            self.load()
+        if model_name not in self.face_models:
+            with self._lock:
+                if model_name not in self.face_models:
+                    self.face_models[model_name] = DeepFace.build_model(model_name, task="facial_recognition")
+        return self.face_models[model_name]
+
+    def embedding_dimension(self, model_name: str) -> int:
+        """
+        The length of the embeddings of a face model.
+        """
+        return self.recognition_model(model_name).output_shape
+
+    def embed_faces(self, faces: List[np.ndarray], model_name: Optional[str] = None) -> List[List[float]]:
+        """
+        Embed a list of face crops with a single forward pass of a face model.
+        
+        Args:
+            faces (List[np.ndarray]): RGB images of any size, either uint8 or scaled to [0, 1].
+            model_name (Optional[str]): The face model, by default the current one. Only
+                Keras models, which take a batch, are supported.
+        
+        Returns:
+            list: One embedding vector per input, in the same order.
+        """
+        if len(faces) == 0:
+            return []
+        face_model = self.recognition_model(model_name or self.face_model_name)
+        EMBEDDING_BATCH_SIZE.observe(len(faces))
+        target_size = face_model.input_shape
+        with timed("embedding_preprocess"):
+            batch = np.concatenate([
+                preprocessing.normalize_input(preprocessing.resize_image(face, (target_size[1], target_size[0])), normalization="base")
+                for face in faces
+            ])
+        with timed("embedding_forward"):
+            return face_model.model(batch, training=False).numpy().tolist()
+
+    def _pin_threads(self) -> None:
+        """
+        Limit the threads TensorFlow and OpenCV run each operation on. TensorFlow only
+        accepts this before its first operation, which building the models is.
+        """
+        if self.intra_op_threads > 0:
+            tf.config.threading.set_intra_op_parallelism_threads(self.intra_op_threads)
+            cv2.setNumThreads(self.intra_op_threads)
+        if self.inter_op_threads > 0:
+            tf.config.threading.set_inter_op_parallelism_threads(self.inter_op_threads)
+
+    def _warm_up(self) -> None:
+        """
+        Run one inference through each model so that graph tracing and memory
+        allocation happen before the first real request.
+        """
+        blank = np.zeros((160, 160, 3), dtype=np.uint8)
+        for detector in self.detectors.values():
+            detector.detect_faces(blank)
+        self.embed_faces([blank, blank])
+
+class FakeModelRegistry(ModelRegistry):
+    """
+    A deterministic stand-in for the face models, for benchmarks and for machines that
+    cannot run them. Nothing is loaded and every call is cheap, so what is measured is
+    the rest of the pipeline.
+
+    Each image gets one to three face boxes laid out in a row, chosen from a hash of
+    its pixels, and each crop gets a random unit vector seeded by a hash of its pixels.
+    The same image therefore always yields the same faces and embeddings.
+    """
+
+    def load(self) -> None:
+        with self._lock:
+            if not self._ready.is_set():
+                self.load_seconds = 0.0
+                self._ready.set()
+
+    def detect_faces(self, image: np.ndarray, settings: Optional[DetectionSettings] = None) -> List[Dict[str, Any]]:
+        self.load()
+        height, width = image.shape[:2]
+        seed = _pixel_hash(image[::8, ::8])
+        number_of_faces = 1 + seed % 3
+        size = max(min(height, width // number_of_faces) // 2, 1)
+        faces = []
+        for i in range(number_of_faces):
+            x, y = i * (width // number_of_faces), (height - size) // 2
+            crop = image[y:y + size, x:x + size, ::-1]
+            faces.append({"face": crop.astype(np.float32) / 255, "facial_area": {"x": x, "y": y, "w": size, "h": size}, "confidence": 0.99})
+        return faces
+
+    def recognition_model(self, model_name: str) -> Any:
+        return None
+
+    def embedding_dimension(self, model_name: str) -> int:
+        return FACENET_DIMENSION
+
+    def embed_faces(self, faces: List[np.ndarray], model_name: Optional[str] = None) -> List[List[float]]:
+        EMBEDDING_BATCH_SIZE.observe(len(faces))
+        model_name = model_name or self.face_model_name
+        # Another model gives other embeddings of the same face
+        salt = 0 if model_name == FACE_MODEL_NAME else _pixel_hash(np.frombuffer(model_name.encode(), dtype=np.uint8))
+        embeddings = []
+        for face in faces:
+            vector = np.random.default_rng(_pixel_hash(face) ^ salt).standard_normal(FACENET_DIMENSION)
+            embeddings.append((vector / np.linalg.norm(vector)).tolist())
+        return embeddings
+
+def _pixel_hash(pixels: np.ndarray) -> int:
+    return int.from_bytes(hashlib.blake2b(np.ascontiguousarray(pixels).tobytes(), digest_size=8).digest(), "little")
+
+MODEL_REGISTRY = FakeModelRegistry() if FAKE_MODELS else ModelRegistry()
@@ -0,0 +1,263 @@
+"""
+Maintenance of the tenant partitions of images, faces, clusters and review_pending.
+
+Every tenant starts out in the shared partitions, the 16 hash partitions under the
+DEFAULT list partition of each table. A large tenant can be promoted to list
+partitions of its own: its vector indexes then only hold its own faces, and deleting
+it drops the partitions instead of deleting its rows one by one.
+
+    python -m src.partitioning promote --tenant-id my_tenant   # promote one tenant
+    python -m src.partitioning promote --min-faces 1000000     # promote every tenant above a size
+    python -m src.partitioning migrate                         # convert a database created before partitioning
+
+Both commands lock the tables they move rows between. Promotion holds an exclusive
+lock on the shared partitions while it checks that none of the tenant's rows are left
+in them, so run it off-peak. Stop the API and the workers while migrating.
+"""
+import argparse
+import hashlib
+import os
+import time
+from typing import List, Optional
+import psycopg2
+import toml
+from psycopg2 import sql
+from src.sql import PARTITIONED_TABLES
+from src.utils import get_db_connection
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+PARTITIONING_CONFIG = config.get("partitioning", {})
+PROMOTE_MIN_FACES = PARTITIONING_CONFIG.get("promote_min_faces", 1_000_000)
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), "..", "postgres", "schema.sql")
+# Bulk loads are much faster without them, they are created again from the schema afterwards
+VECTOR_INDEXES = ("faces_embedding_hnsw_idx", "clusters_embedding_sum_hnsw_idx")
+
+def partition_suffix(tenant_id: str) -> str:
+    """
+    Derive the suffix of the partition names of a tenant. Tenant IDs can be any string,
+    so they are hashed into a valid identifier.
+
+    Args:
+        tenant_id (str): The tenant ID.
+
+    Returns:
+        str: The suffix, e.g. faces_<suffix> is the faces partition of the tenant.
+    """
+    return "t_" + hashlib.sha1(tenant_id.encode()).hexdigest()[:16]
+
+def _copied_columns(cur: psycopg2.extensions.cursor, table: str, source: Optional[str] = None) -> sql.Composed:
+    """
+    List the columns of a table that can be inserted, which excludes the generated ones.
+    With `source`, only those it also has: the others are left to their defaults, as
+    for a database that predates the migrations adding them.
+    """
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+          AND (%s IS NULL OR column_name IN (
+              SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s
+          ))
+        ORDER BY ordinal_position
+    """, (table, source, source))
+    return sql.SQL(", ").join(sql.Identifier(row[0]) for row in cur.fetchall())
+
+def create_tenant_tables(cur: psycopg2.extensions.cursor, tenant_id: str) -> Optional[str]:
+    """
+    Create the dedicated partitions of a tenant as standalone tables and register them
+    in tenant_partitions. Fill them, then attach them with `attach_tenant_tables`,
+    which builds their indexes in bulk.
+
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+
+    Returns:
+        Optional[str]: The suffix of the tables, or None if the tenant already has dedicated partitions.
+    """
+    suffix = partition_suffix(tenant_id)
+    cur.execute("INSERT INTO tenant_partitions (tenant_id, suffix) VALUES (%s, %s) ON CONFLICT (tenant_id) DO NOTHING", (tenant_id, suffix))
+    if cur.rowcount == 0:
+        return None
+    for table in PARTITIONED_TABLES:
+        partition = sql.Identifier(f"{table}_{suffix}")
+        cur.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING GENERATED)").format(partition, sql.Identifier(table)))
+        # Lets ATTACH skip scanning the new partition to validate it
+        cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK (tenant_id = {})").format(partition, sql.Identifier(f"{table}_{suffix}_tenant_check"), sql.Literal(tenant_id)))
+    return suffix
+
+def attach_tenant_tables(cur: psycopg2.extensions.cursor, tenant_id: str, suffix: str) -> None:
+    """
+    Attach the tables created by `create_tenant_tables` as the partitions of the tenant.
+
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        suffix (str): The suffix of the tables.
+    """
+    for table in PARTITIONED_TABLES:
+        # Builds the partition's indexes, and scans the shared partitions for rows of the tenant
+        cur.execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ({})").format(
+            sql.Identifier(table), sql.Identifier(f"{table}_{suffix}"), sql.Literal(tenant_id)))
+
+def promote_tenant(conn: psycopg2.extensions.connection, tenant_id: str) -> None:
+    """
+    Move a tenant from the shared partitions to dedicated list partitions, in a single
+    transaction.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed on success.
+        tenant_id (str): The tenant ID.
+    """
+    start = time.perf_counter()
+    try:
+        with conn.cursor() as cur:
+            suffix = create_tenant_tables(cur, tenant_id)
+            if suffix is None:
+                print(f"Tenant {tenant_id} already has dedicated partitions")
+                conn.rollback()
+                return
+            for table in PARTITIONED_TABLES:
+                columns = _copied_columns(cur, table)
+                cur.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} WHERE tenant_id = %s").format(
+                    sql.Identifier(f"{table}_{suffix}"), columns, columns, sql.Identifier(table)), (tenant_id,))
+                moved = cur.rowcount
+                cur.execute(sql.SQL("DELETE FROM {} WHERE tenant_id = %s").format(sql.Identifier(table)), (tenant_id,))
+                print(f"Moved {moved} rows of {table}")
+            attach_tenant_tables(cur, tenant_id, suffix)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    analyze_tenant_tables(conn, suffix)
+    print(f"Promoted tenant {tenant_id} to partitions *_{suffix} in {time.perf_counter() - start:.1f}s")
+
+def analyze_tenant_tables(conn: psycopg2.extensions.connection, suffix: str) -> None:
+    """
+    Collect the planner statistics of the dedicated partitions of a tenant, which
+    autovacuum has not seen yet after a bulk load.
+    """
+    with conn.cursor() as cur:
+        for table in PARTITIONED_TABLES:
+            cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(f"{table}_{suffix}")))
+    conn.commit()
+
+def large_shared_tenants(conn: psycopg2.extensions.connection, min_faces: int, faces_table: str = "faces_shared") -> List[str]:
+    """
+    Find the tenants of the shared partitions that hold at least `min_faces` faces.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object.
+        min_faces (int): The number of faces from which a tenant is promoted.
+        faces_table (str): The table to count faces in.
+
+    Returns:
+        list: The tenant IDs, largest first.
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT tenant_id FROM {} GROUP BY tenant_id HAVING count(*) >= %s ORDER BY count(*) DESC").format(sql.Identifier(faces_table)), (min_faces,))
+        tenant_ids = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    return tenant_ids
+
+def _relkind(cur: psycopg2.extensions.cursor, table: str) -> Optional[str]:
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+def _apply_schema(cur: psycopg2.extensions.cursor) -> None:
+    with open(SCHEMA_PATH) as file:
+        cur.execute(file.read())
+
+def migrate(conn: psycopg2.extensions.connection, promote_min_faces: Optional[int], keep_old: bool) -> None:
+    """
+    Convert the tables of a database created before partitioning.
+
+    The old tables are renamed to *_unpartitioned, the partitioned ones are created from
+    postgres/schema.sql and filled one tenant per transaction. An interrupted migration
+    resumes where it stopped when run again.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object.
+        promote_min_faces (Optional[int]): Tenants with at least this many faces get dedicated partitions, None for none.
+        keep_old (bool): Keep the *_unpartitioned tables instead of dropping them at the end.
+    """
+    with conn.cursor() as cur:
+        if _relkind(cur, "images") == "p" and _relkind(cur, "images_unpartitioned") is None:
+            print("The database is already partitioned")
+            conn.rollback()
+            return
+        if _relkind(cur, "images") == "r":
+            for table in PARTITIONED_TABLES:
+                cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(table), sql.Identifier(f"{table}_unpartitioned")))
+                # Free the index names for the partitioned tables
+                cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s", (f"{table}_unpartitioned",))
+                for (index,) in cur.fetchall():
+                    cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(sql.Identifier(index), sql.Identifier(f"{index}_unpartitioned")))
+            cur.execute("ALTER SEQUENCE IF EXISTS review_pending_id_seq RENAME TO review_pending_id_seq_unpartitioned")
+            _apply_schema(cur)
+            for index in VECTOR_INDEXES:
+                cur.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(index)))
+            conn.commit()
+            print("Created the partitioned tables")
+            if promote_min_faces is not None:
+                for tenant_id in large_shared_tenants(conn, promote_min_faces, "faces_unpartitioned"):
+                    # Nothing has been copied yet, so there are no rows to move
+                    suffix = partition_suffix(tenant_id)
+                    for table in PARTITIONED_TABLES:
+                        cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES IN ({})").format(
+                            sql.Identifier(f"{table}_{suffix}"), sql.Identifier(table), sql.Literal(tenant_id)))
+                    cur.execute("INSERT INTO tenant_partitions (tenant_id, suffix) VALUES (%s, %s)", (tenant_id, suffix))
+                    conn.commit()
+                    print(f"Created dedicated partitions for tenant {tenant_id}")
+
+        cur.execute(" UNION ".join(f"SELECT DISTINCT tenant_id FROM {table}_unpartitioned" for table in PARTITIONED_TABLES))
+        tenant_ids = [row[0] for row in cur.fetchall()]
+        columns = {table: _copied_columns(cur, table, f"{table}_unpartitioned") for table in PARTITIONED_TABLES}
+        conn.rollback()
+        for i, tenant_id in enumerate(tenant_ids):
+            cur.execute(" UNION ALL ".join(f"(SELECT 1 FROM {table} WHERE tenant_id = %s LIMIT 1)" for table in PARTITIONED_TABLES), (tenant_id,) * len(PARTITIONED_TABLES))
+            if cur.fetchone() is None:
+                for table in PARTITIONED_TABLES:
+                    cur.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} WHERE tenant_id = %s").format(
+                        sql.Identifier(table), columns[table], columns[table], sql.Identifier(f"{table}_unpartitioned")), (tenant_id,))
+            conn.commit()
+            print(f"Copied tenant {i + 1}/{len(tenant_ids)}")
+
+        cur.execute("SELECT setval(pg_get_serial_sequence('review_pending', 'id'), COALESCE((SELECT max(id) FROM review_pending), 0) + 1, false)")
+        print("Building the vector indexes")
+        _apply_schema(cur)
+        if not keep_old:
+            cur.execute(sql.SQL("DROP TABLE {}").format(sql.SQL(", ").join(sql.Identifier(f"{table}_unpartitioned") for table in PARTITIONED_TABLES)))
+        conn.commit()
+        for table in PARTITIONED_TABLES:
+            cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+        conn.commit()
+    print("Migration done")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    promote = commands.add_parser("promote", help="Move tenants to dedicated partitions")
+    promote.add_argument("--tenant-id", help="Tenant to promote")
+    promote.add_argument("--min-faces", type=int, help=f"Promote every shared tenant with at least this many faces (default {PROMOTE_MIN_FACES})")
+    migrate_parser = commands.add_parser("migrate", help="Convert a database created before partitioning")
+    migrate_parser.add_argument("--promote-min-faces", type=int, help="Give tenants with at least this many faces dedicated partitions")
+    migrate_parser.add_argument("--keep-old", action="store_true", help="Keep the *_unpartitioned tables")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if args.command == "migrate":
+            migrate(conn, args.promote_min_faces, args.keep_old)
+        elif args.tenant_id is not None:
+            promote_tenant(conn, args.tenant_id)
+        else:
+            for tenant_id in large_shared_tenants(conn, args.min_faces if args.min_faces is not None else PROMOTE_MIN_FACES):
+                promote_tenant(conn, tenant_id)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
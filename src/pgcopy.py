@@ -0,0 +1,155 @@
+"""
+Reading and writing the binary format of Postgres `COPY ... (FORMAT BINARY)`.
+
+A COPY stream is a header, then one tuple per row made of a field count and each
+field as its length and its bytes in the type's binary representation, then a
+trailer. Only the framing is handled here, fields are passed through as bytes, plus
+the encoders of the few types this service writes itself. See
+https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+"""
+import struct
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+
+SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+# The signature, no flags and no header extension
+HEADER = SIGNATURE + struct.pack(">ii", 0, 0)
+TRAILER = struct.pack(">h", -1)
+# pgvector's binary representation: dimension, an unused int16, then big-endian float4s
+VECTOR_DTYPE = np.dtype(">f4")
+
+Row = List[Optional[bytes]]
+
+class CopyBinaryReader:
+    """
+    Incremental parser of a COPY BINARY stream, fed with chunks of any size.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._header_read = False
+        self.done = False
+
+    def feed(self, data: bytes) -> List[Row]:
+        """
+        Add a chunk of the stream.
+
+        Args:
+            data (bytes): The next bytes of the stream.
+
+        Returns:
+            list: The rows completed by the chunk, each a list of fields, None for NULL.
+        """
+        self._buffer += data
+        offset = 0
+        if not self._header_read:
+            if len(self._buffer) < len(SIGNATURE) + 8:
+                return []
+            if bytes(self._buffer[:len(SIGNATURE)]) != SIGNATURE:
+                raise ValueError("Not a COPY BINARY stream")
+            extension_length, = struct.unpack_from(">i", self._buffer, len(SIGNATURE) + 4)
+            offset = len(SIGNATURE) + 8 + extension_length
+            if len(self._buffer) < offset:
+                return []
+            self._header_read = True
+
+        rows = []
+        while not self.done and len(self._buffer) - offset >= 2:
+            field_count, = struct.unpack_from(">h", self._buffer, offset)
+            if field_count == -1:
+                self.done = True
+                offset += 2
+                break
+            row, end = self._parse_row(offset + 2, field_count)
+            if row is None:
+                break
+            rows.append(row)
+            offset = end
+        del self._buffer[:offset]
+        return rows
+
+    def _parse_row(self, offset: int, field_count: int) -> Tuple[Optional[Row], int]:
+        row: Row = []
+        for _ in range(field_count):
+            if len(self._buffer) - offset < 4:
+                return None, offset
+            length, = struct.unpack_from(">i", self._buffer, offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+                continue
+            if len(self._buffer) - offset < length:
+                return None, offset
+            row.append(bytes(self._buffer[offset:offset + length]))
+            offset += length
+        return row, offset
+
+def read_rows(file: BinaryIO, chunk_size: int = 1 << 20) -> Iterator[Row]:
+    """
+    Read the rows of a COPY BINARY file one at a time.
+
+    Args:
+        file (BinaryIO): The file, positioned at the header.
+        chunk_size (int): The number of bytes read at a time.
+
+    Returns:
+        Iterator[Row]: The rows, each a list of fields, None for NULL.
+    """
+    reader = CopyBinaryReader()
+    while not reader.done:
+        data = file.read(chunk_size)
+        if not data:
+            raise ValueError("Truncated COPY BINARY stream")
+        yield from reader.feed(data)
+
+def encode_row(row: Iterable[Optional[bytes]]) -> bytes:
+    """
+    Encode a tuple of the stream from fields already in their binary representation.
+    """
+    fields = list(row)
+    parts = [struct.pack(">h", len(fields))]
+    for field in fields:
+        if field is None:
+            parts.append(struct.pack(">i", -1))
+        else:
+            parts.append(struct.pack(">i", len(field)))
+            parts.append(field)
+    return b"".join(parts)
+
+class CopyBinaryStream:
+    """
+    File-like object that produces a COPY BINARY stream from rows on demand, for
+    `cursor.copy_expert("COPY ... FROM STDIN (FORMAT BINARY)", stream)`. Only the
+    rows needed to fill each read are encoded, so memory stays flat.
+    """
+
+    def __init__(self, rows: Iterable[Iterable[Optional[bytes]]]) -> None:
+        self._rows = iter(rows)
+        self._buffer = bytearray(HEADER)
+        self._finished = False
+        self.rows = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            row = next(self._rows, None)
+            if row is None:
+                self._buffer += TRAILER
+                self._finished = True
+            else:
+                self._buffer += encode_row(row)
+                self.rows += 1
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+def encode_text(value: str) -> bytes:
+    return value.encode()
+
+def encode_vector(values: np.ndarray) -> bytes:
+    return struct.pack(">hh", len(values), 0) + np.asarray(values, dtype=VECTOR_DTYPE).tobytes()
+
+def decode_vector(data: bytes) -> np.ndarray:
+    dimension, _ = struct.unpack_from(">hh", data)
+    return np.frombuffer(data, dtype=VECTOR_DTYPE, count=dimension, offset=4)
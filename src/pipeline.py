@@ -0,0 +1,417 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import uuid
+import zipfile
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+from fastapi import HTTPException
+import imagehash
+import numpy as np
+import psycopg2
+from PIL import Image
+import toml
+from src.crops import CROPS_ENABLED, append_crops, encode_crop
+from src.detection import DetectionSettings
+from src.embedding_cache import EMBEDDING_CACHE
+from src.image_embedding import ImageEmbeddingSettings, thumbnail_descriptor
+from src.metrics import FACES_DETECTED, FACES_REJECTED, timed
+from src.models import MODEL_REGISTRY
+from src.sql import sql_get_face_model, sql_share_face_model, sql_insert_images, sql_insert_faces, sql_insert_review_pendings, sql_match_faces, sql_find_image_by_content, sql_get_similar_images
+from src.utils import get_db_connection
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+DEDUP_CONFIG = config.get("dedup", {})
+DEDUP_ENABLED = DEDUP_CONFIG.get("enabled", True)
+DEDUP_DEFAULT_ACTION = DEDUP_CONFIG.get("default_action", "return")
+DEDUP_PHASH_DISTANCE = DEDUP_CONFIG.get("phash_distance", 0)
+
+SIMILARITY_THRESHOLD = 0.85
+
+@dataclass
+class DetectedFace:
+    """
+    A face found in an uploaded image.
+
+    Attributes:
+        face (Optional[np.ndarray]): The aligned RGB face crop, released once it has been embedded.
+        facial_area_json (str): The facial area in JSON format.
+        confidence (float): The detector confidence.
+        embedding (Optional[List[float]]): The embedding vector of the face, once computed.
+        crop (Optional[bytes]): The face crop encoded for the tenant's pack file, None if crops are not kept, see src/crops.py.
+    """
+    face: Optional[np.ndarray]
+    facial_area_json: str
+    confidence: float
+    embedding: Optional[List[float]] = None
+    crop: Optional[bytes] = None
+
+@dataclass
+class ImageAnalysis:
+    """
+    Everything the insert pipeline derives from an image before touching the database.
+
+    Attributes:
+        phash (str): The perceptual hash of the image.
+        content_sha256 (str): The SHA-256 of the raw upload, in hex.
+        image (Optional[np.ndarray]): The decoded RGB image, released once it has been embedded.
+        faces (List[DetectedFace]): The faces above the confidence threshold.
+        embedding (Optional[List[float]]): The embedding vector of the whole image, once computed, None if it is left to a backfill job.
+        embed_image (bool): Whether the whole image is passed to the face model with the faces.
+        model_version (Optional[str]): The face model that computed the embeddings, None if there were none to compute.
+    """
+    phash: str
+    content_sha256: str
+    image: Optional[np.ndarray]
+    faces: List[DetectedFace]
+    embedding: Optional[List[float]] = None
+    embed_image: bool = False
+    model_version: Optional[str] = None
+
+    def embedding_inputs(self) -> List[np.ndarray]:
+        """
+        List the images that need an embedding: the whole image, if `embed_image`, followed by each face.
+
+        Returns:
+            list: The images to embed, in the order `attach_embeddings` expects.
+        """
+        return ([self.image] if self.embed_image else []) + [face.face for face in self.faces]
+
+    def attach_embeddings(self, embeddings: List[List[float]], model_version: str) -> None:
+        """
+        Store the embeddings computed for `embedding_inputs`.
+
+        Args:
+            embeddings (List[List[float]]): One embedding per input, in the same order.
+            model_version (str): The face model that computed them.
+        """
+        if len(embeddings) > 0:
+            self.model_version = model_version
+        if self.embed_image:
+            self.embedding, embeddings = embeddings[0], embeddings[1:]
+        for face, embedding in zip(self.faces, embeddings):
+            face.embedding = embedding
+
+    def release_pixels(self) -> None:
+        """
+        Drop the decoded image and face crops once the embeddings are computed, so
+        that analyses waiting to be written do not hold on to full-size images.
+        """
+        self.image = None
+        for face in self.faces:
+            face.face = None
+
+def save_upload(data: bytes, image_path: str) -> None:
+    """
+    Write an uploaded file to disk.
+
+    Args:
+        data (bytes): The raw bytes of the upload.
+        image_path (str): The destination path.
+    """
+    with timed("file_write"), open(image_path, "wb") as buffer:
+        buffer.write(data)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
+
+def iter_archive(file: BinaryIO) -> Iterator[Tuple[str, bytes]]:
+    """
+    Read the images of a zip or tar archive one at a time.
+    
+    Tar archives, compressed or not, are read as a stream. Files that do not have an
+    image extension and macOS resource forks are skipped.
+    
+    Args:
+        file (BinaryIO): The archive, positioned at its start.
+    
+    Yields:
+        tuple: The file name and raw bytes of each image.
+    """
+    def is_image(name: str) -> bool:
+        return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS and not os.path.basename(name).startswith("._") and "__MACOSX/" not in name
+
+    if zipfile.is_zipfile(file):
+        file.seek(0)
+        with zipfile.ZipFile(file) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_image(info.filename):
+                    yield info.filename, archive.read(info)
+        return
+
+    file.seek(0)
+    with tarfile.open(fileobj=file, mode="r|*") as archive:
+        for member in archive:
+            if member.isfile() and is_image(member.name):
+                yield member.name, archive.extractfile(member).read()
+
+@dataclass
+class DecodedUpload:
+    """
+    An upload decoded once, with the hashes used to recognise re-uploads.
+
+    Attributes:
+        content_sha256 (str): The SHA-256 of the raw upload, in hex.
+        image (Image.Image): The decoded RGB image.
+        phash (str): The perceptual hash of the image.
+    """
+    content_sha256: str
+    image: Image.Image
+    phash: str
+
+def hash_content(data: bytes) -> str:
+    """
+    Hash the raw bytes of an upload to recognise exact re-uploads.
+
+    Args:
+        data (bytes): The raw bytes of the upload.
+
+    Returns:
+        str: The SHA-256 of the upload, in hex.
+    """
+    with timed("content_hash"):
+        return hashlib.sha256(data).hexdigest()
+
+def decode_upload(data: bytes, content_sha256: Optional[str] = None) -> DecodedUpload:
+    """
+    Decode an upload into an RGB image and hash it. This is the only place the pipeline
+    decodes an upload.
+
+    Args:
+        data (bytes): The raw bytes of the upload.
+        content_sha256 (Optional[str]): The SHA-256 of the upload, if it is already known.
+
+    Returns:
+        DecodedUpload: The decoded image and its hashes.
+    """
+    with timed("decode"):
+        img = Image.open(io.BytesIO(data)).convert("RGB")
+    with timed("phash"):
+        phash = str(imagehash.phash(img))
+    return DecodedUpload(content_sha256 or hash_content(data), img, phash)
+
+def analyze_image(upload: DecodedUpload, detection: DetectionSettings, image_embedding: ImageEmbeddingSettings) -> ImageAnalysis:
+    """
+    Run the detection part of the insert pipeline on a decoded upload.
+    
+    This is blocking and is meant to be run on the inference executor. The same pixel
+    buffer is shared by every stage. Embeddings are computed separately so that they
+    can be batched across requests.
+    
+    Args:
+        upload (DecodedUpload): The decoded upload.
+        detection (DetectionSettings): The detection settings of the tenant, see src/detection.py.
+        image_embedding (ImageEmbeddingSettings): The whole-image embedding settings of the tenant, see src/image_embedding.py.
+    
+    Returns:
+        ImageAnalysis: The hashes, decoded image, detected faces and, for the thumbnail descriptor, the image embedding.
+    """
+    pixels = np.asarray(upload.image)
+
+    # Extract faces from the image, DeepFace expects BGR arrays
+    with timed("detection"):
+        face_objs = MODEL_REGISTRY.detect_faces(pixels[:, :, ::-1], detection)
+    FACES_DETECTED.inc(len(face_objs))
+
+    faces: List[DetectedFace] = []
+    for face_obj in face_objs:
+        if face_obj["confidence"] >= detection.min_confidence:
+            facial_area = face_obj["facial_area"]
+            facial_area_json = json.dumps({
+              "x":facial_area["x"],
+              "y":facial_area["y"],
+              "w":facial_area["w"],
+              "h":facial_area["h"],
+            })
+            crop = None
+            if CROPS_ENABLED:
+                with timed("crop_encode"):
+                    crop = encode_crop(face_obj["face"])
+            faces.append(DetectedFace(face_obj["face"], facial_area_json, face_obj["confidence"], crop=crop))
+        else:
+            FACES_REJECTED.inc()
+
+    embedding = None
+    if image_embedding.mode == "eager" and image_embedding.descriptor == "thumbnail":
+        with timed("image_descriptor"):
+            embedding = thumbnail_descriptor(upload.image)
+    return ImageAnalysis(upload.phash, upload.content_sha256, pixels, faces, embedding, image_embedding.embeds_with_face_model)
+
+def embed_analysis(analysis: ImageAnalysis) -> None:
+    """
+    Embed every face of an analysis, and the whole image if it is embedded by the face model, in one forward pass.
+    
+    This is the blocking counterpart of the cross-request batcher, for callers that
+    are not running on the event loop.
+    
+    Args:
+        analysis (ImageAnalysis): The result of `analyze_image`.
+    """
+    model_version = MODEL_REGISTRY.face_model_name
+    analysis.attach_embeddings(MODEL_REGISTRY.embed_faces(analysis.embedding_inputs(), model_version), model_version)
+
+def use_face_model(model_version: str) -> None:
+    """
+    Embed faces with the face model recorded in the face_model table, which
+    src/reembedding.py switches while the API and the workers keep running.
+    
+    Args:
+        model_version (str): The DeepFace model name.
+    """
+    if MODEL_REGISTRY.use_face_model(model_version):
+        print(f"Embedding faces with {model_version}")
+        # Cached embeddings of the previous model would be matched against the new ones
+        EMBEDDING_CACHE.clear()
+
+def load_models() -> None:
+    """
+    Load the models, with the face model recorded in the database, or that of
+    `[inference] model_name` if it cannot be read.
+    
+    Raises:
+        Exception: If the models cannot be built.
+    """
+    try:
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                use_face_model(sql_get_face_model(cur))
+        finally:
+            conn.close()
+    except psycopg2.Error as e:
+        print(f"Could not read the face model, loading {MODEL_REGISTRY.face_model_name}: {e}")
+    MODEL_REGISTRY.load()
+
+class _BatchFaces:
+    """
+    Faces assigned earlier in the same write batch. They are not in the database yet,
+    so new faces are matched against them in memory.
+    """
+
+    def __init__(self) -> None:
+        self.face_ids: List[str] = []
+        self.cluster_ids: List[str] = []
+        self.embeddings: List[np.ndarray] = []
+
+    def add(self, face_id: str, cluster_id: str, embedding: List[float]) -> None:
+        vector = np.asarray(embedding, dtype=np.float32)
+        self.face_ids.append(face_id)
+        self.cluster_ids.append(cluster_id)
+        self.embeddings.append(vector / max(float(np.linalg.norm(vector)), 1e-12))
+
+    def nearest(self, embedding: List[float]) -> Optional[Tuple[str, str, float]]:
+        if len(self.embeddings) == 0:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        distances = 1.0 - np.stack(self.embeddings) @ (vector / max(float(np.linalg.norm(vector)), 1e-12))
+        best = int(np.argmin(distances))
+        return self.face_ids[best], self.cluster_ids[best], float(distances[best])
+
+def store_analyses(cur: psycopg2.extensions.cursor, tenant_id: str, analyses: List[Tuple[str, ImageAnalysis]], similarity_threshold: float) -> Dict[str, Dict[str, str]]:
+    """
+    Insert analyzed images and their faces, assigning each face to a cluster.
+    
+    All faces are matched against the faces of the tenant with a single query, then
+    against the faces placed earlier in the same batch, so that two faces of the same
+    upload can match each other. All rows are written with batched inserts, and the
+    face crops with one append to the tenant's pack file.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        analyses (List[Tuple[str, ImageAnalysis]]): The image IDs and their embedded analyses.
+        similarity_threshold (float): The similarity threshold for matching faces.
+    
+    Returns:
+        dict: For each image ID, its face IDs mapped to their cluster IDs.
+    
+    Raises:
+        HTTPException: 503 if the faces were switched to another face model while the analyses were embedded.
+    """
+    # The faces are matched against, and stored next to, embeddings of the same model
+    model_version = sql_share_face_model(cur)
+    use_face_model(model_version)
+    if any(analysis.model_version not in (None, model_version) for _, analysis in analyses):
+        raise HTTPException(status_code=503, detail=f"The face model was switched to {model_version} while the upload was analyzed, retry")
+
+    # Check for matching faces within the same tenant
+    with timed("matching"):
+        existing_matches = iter(sql_match_faces(cur, tenant_id, [face.embedding for _, analysis in analyses for face in analysis.faces], similarity_threshold))
+
+    face_rows: List[Tuple[str, str, str, str, bool, List[float], Optional[int], Optional[int]]] = []
+    crops: List[Optional[bytes]] = []
+    new_clusters: List[Tuple[str, str]] = []
+    batch_faces = _BatchFaces()
+    results: Dict[str, Dict[str, str]] = {}
+    for image_id, analysis in analyses:
+        face_ids: Dict[str, str] = {}
+        for face in analysis.faces:
+            face_id = str(uuid.uuid4())
+            best_match = next(existing_matches)
+            batch_match = batch_faces.nearest(face.embedding)
+            if batch_match is not None and batch_match[2] <= similarity_threshold and (best_match is None or batch_match[2] < best_match[2]):
+                best_match = batch_match
+
+            matched_cluster_id = str(uuid.uuid4())
+            if best_match is not None:
+                # If the face is matched with an existing face
+                matched_face_id, matched_cluster_id, distance = best_match
+                print(f"Matched face {face_id} with {matched_face_id} with distance {distance}")
+            else:
+                # If the face is not matched with any existing face, add it to review_pending
+                new_clusters.append((matched_cluster_id, image_id))
+            is_auto_matched = True
+            face_rows.append((face_id, image_id, matched_cluster_id, face.facial_area_json, is_auto_matched, face.embedding, None, None))
+            crops.append(face.crop)
+            batch_faces.add(face_id, matched_cluster_id, face.embedding)
+            face_ids.update({face_id: matched_cluster_id})
+        results[image_id] = face_ids
+
+    with timed("crop_write"):
+        # Crops of a transaction that then fails stay unreferenced in the pack
+        locations = iter(append_crops(tenant_id, [crop for crop in crops if crop is not None]))
+        face_rows = [row[:6] + next(locations) if crop is not None else row for row, crop in zip(face_rows, crops)]
+
+    with timed("insert"):
+        sql_insert_images(cur, tenant_id, [(image_id, analysis.phash, analysis.content_sha256, analysis.embedding) for image_id, analysis in analyses])
+        if len(face_rows) > 0:
+            sql_insert_faces(cur, tenant_id, face_rows)
+        if len(new_clusters) > 0:
+            sql_insert_review_pendings(cur, tenant_id, new_clusters)
+    return results
+
+def find_duplicate(cur: psycopg2.extensions.cursor, tenant_id: str, content_sha256: str, phash: Optional[str], max_phash_distance: int) -> Optional[str]:
+    """
+    Look for an image of the tenant that the upload is a re-upload of.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        content_sha256 (str): The SHA-256 of the upload.
+        phash (Optional[str]): The perceptual hash of the upload, to also look for near-duplicates.
+        max_phash_distance (int): The Hamming distance within which a perceptual hash is a near-duplicate.
+    
+    Returns:
+        Optional[str]: The ID of the existing image, or None.
+    """
+    image_id = sql_find_image_by_content(cur, tenant_id, content_sha256)
+    if image_id is not None or phash is None:
+        return image_id
+    # The upload has no image ID yet, an empty ID cannot collide with a stored one
+    similar = sql_get_similar_images(cur, tenant_id, [("", phash_to_int(phash))], max_phash_distance)
+    return similar[0][1] if len(similar) > 0 else None
+
+def phash_to_int(phash: str) -> int:
+    """
+    Convert a hex perceptual hash to the signed 64-bit integer stored in images.phash_int.
+    
+    Args:
+        phash (str): The perceptual hash in hex.
+    
+    Returns:
+        int: The hash as a signed 64-bit integer.
+    """
+    value = int(phash, 16)
+    return value - (1 << 64) if value >= 1 << 63 else value
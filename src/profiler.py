@@ -0,0 +1,87 @@
+import collections
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+class SamplingProfiler:
+    """
+    A low-overhead statistical profiler that can be switched on and off in a running
+    process.
+
+    While running, a background thread snapshots the stack of every other thread each
+    `interval` seconds and counts identical stacks. The report uses the collapsed stack
+    format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._stacks: Dict[str, int] = collections.Counter()
+        self.interval = 0.01
+        self.samples = 0
+        self.started_at: Optional[float] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float) -> None:
+        """
+        Start sampling, discarding the samples of the previous run.
+
+        Args:
+            interval (float): Seconds between two samples.
+        """
+        with self._lock:
+            if self.running:
+                return
+            self._stacks = collections.Counter()
+            self.samples = 0
+            self.interval = interval
+            self.started_at = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop sampling. The samples are kept until the next start.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def report(self) -> str:
+        """
+        Format the samples collected so far.
+
+        Returns:
+            str: One line per distinct stack, frames separated by semicolons and followed by the sample count.
+        """
+        with self._lock:
+            stacks = dict(self._stacks)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            names.update({thread.ident: thread.name for thread in threading.enumerate()})
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack = ";".join([names.get(thread_id, str(thread_id))] + frames[::-1])
+                with self._lock:
+                    self._stacks[stack] += 1
+            self.samples += 1
+
+PROFILER = SamplingProfiler()
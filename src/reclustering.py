@@ -0,0 +1,206 @@
+"""
+Offline re-clustering of a tenant.
+
+Faces are assigned to clusters one at a time as they are inserted, so the result
+depends on upload order and the same person often ends up split over several
+clusters. This job compares every pair of cluster centroids of a tenant and merges
+the clusters whose centroids are within `merge_threshold` of each other. Merges are
+transitive, like single-linkage clustering. POST /recluster runs it as a job on the
+background workers, see src/worker.py.
+
+    python -m src.reclustering --tenant-id my_tenant          # print the proposed merges
+    python -m src.reclustering --tenant-id my_tenant --apply  # apply them
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import psycopg2
+import toml
+from src.sql import sql_count_clusters, sql_get_embedding_dimension, sql_iter_cluster_centroids, sql_merge_clusters
+from src.utils import get_db_connection
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+RECLUSTERING_CONFIG = config.get("reclustering", {})
+MERGE_THRESHOLD = RECLUSTERING_CONFIG.get("merge_threshold", 0.4)
+BLOCK_SIZE = RECLUSTERING_CONFIG.get("block_size", 4096)
+CHUNK_SIZE = RECLUSTERING_CONFIG.get("chunk_size", 10000)
+UPDATE_BATCH_SIZE = RECLUSTERING_CONFIG.get("update_batch_size", 500)
+WORK_DIR = RECLUSTERING_CONFIG.get("work_dir")
+
+RECLUSTER_JOB_KIND = "recluster"
+
+
+class _ClusterForest:
+    """
+    Union-find over the clusters of a tenant.
+
+    Clusters holding a manually assigned face are pinned: a component never contains
+    two of them, and a pinned cluster is always the root of its component, so faces
+    placed by hand are never moved.
+    """
+
+    def __init__(self, face_counts: np.ndarray, pinned: np.ndarray) -> None:
+        self.parent = np.arange(len(face_counts), dtype=np.int64)
+        self.face_counts = face_counts.astype(np.int64)
+        self.pinned = pinned.copy()
+
+    def find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return int(root)
+
+    def union(self, i: int, j: int) -> None:
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i == root_j or (self.pinned[root_i] and self.pinned[root_j]):
+            return
+        # The pinned cluster, or else the one with more faces, absorbs the other
+        if self.pinned[root_j] or (not self.pinned[root_i] and self.face_counts[root_j] > self.face_counts[root_i]):
+            root_i, root_j = root_j, root_i
+        self.parent[root_j] = root_i
+        self.face_counts[root_i] += self.face_counts[root_j]
+        self.pinned[root_i] |= self.pinned[root_j]
+
+def _load_centroids(conn: psycopg2.extensions.connection, tenant_id: str, path: str, chunk_size: int,
+                    on_progress: Optional[Callable[[], None]] = None) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stream the cluster centroids of a tenant into a memory-mapped file, L2-normalized.
+    `on_progress` is called after each chunk.
+
+    Returns:
+        tuple: The cluster IDs, the centroid memmap, the face counts and the pinned flags.
+    """
+    with conn.cursor() as cur:
+        number_of_clusters = sql_count_clusters(cur, tenant_id)
+        dimension = sql_get_embedding_dimension(cur, "clusters", "embedding_sum")
+    centroids = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(max(number_of_clusters, 1), dimension))
+    cluster_ids: List[str] = []
+    face_counts: List[int] = []
+    pinned: List[bool] = []
+    with conn.cursor(name="reclustering_centroids") as cur:
+        for rows in sql_iter_cluster_centroids(cur, tenant_id, chunk_size):
+            # Clusters created since the count are left for the next run
+            rows = rows[:number_of_clusters - len(cluster_ids)]
+            if len(rows) == 0:
+                break
+            vectors = np.asarray([row[1] for row in rows], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            centroids[len(cluster_ids):len(cluster_ids) + len(rows)] = vectors / np.maximum(norms, 1e-12)
+            cluster_ids.extend(row[0] for row in rows)
+            face_counts.extend(row[2] for row in rows)
+            pinned.extend(row[3] for row in rows)
+            if on_progress is not None:
+                on_progress()
+    conn.rollback()
+    return cluster_ids, centroids, np.asarray(face_counts, dtype=np.int64), np.asarray(pinned, dtype=bool)
+
+def _link_close_centroids(centroids: np.ndarray, size: int, forest: _ClusterForest, merge_threshold: float, block_size: int,
+                          on_progress: Optional[Callable[[], None]] = None) -> None:
+    """
+    Compare every pair of centroids one block pair at a time and union those within
+    `merge_threshold` cosine distance. Only two blocks and their similarity matrix are
+    in memory at once. `on_progress` is called after each row of blocks.
+    """
+    min_similarity = 1.0 - merge_threshold
+    for start_i in range(0, size, block_size):
+        block_i = np.asarray(centroids[start_i:min(start_i + block_size, size)])
+        for start_j in range(start_i, size, block_size):
+            block_j = block_i if start_j == start_i else np.asarray(centroids[start_j:min(start_j + block_size, size)])
+            similarities = block_i @ block_j.T
+            if start_j == start_i:
+                # Each pair once, and not a cluster with itself
+                similarities = np.triu(similarities, k=1)
+            rows, columns = np.nonzero(similarities >= min_similarity)
+            for row, column in zip(rows.tolist(), columns.tolist()):
+                forest.union(start_i + row, start_j + column)
+        if on_progress is not None:
+            on_progress()
+
+def recluster_tenant(conn: psycopg2.extensions.connection, tenant_id: str, apply: bool = False, merge_threshold: float = MERGE_THRESHOLD,
+                     block_size: int = BLOCK_SIZE, chunk_size: int = CHUNK_SIZE, update_batch_size: int = UPDATE_BATCH_SIZE,
+                     on_batch: Optional[Callable[[psycopg2.extensions.cursor], None]] = None,
+                     on_progress: Optional[Callable[[], None]] = None) -> Dict[str, object]:
+    """
+    Find the clusters of a tenant that should be merged, and optionally merge them.
+
+    Memory use is bounded by the block size and the per-cluster bookkeeping; the
+    centroids themselves live in a temporary memory-mapped file. Merges are applied
+    in batches of `update_batch_size` clusters, each in its own transaction, so the
+    faces table is never locked for long.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each batch.
+        tenant_id (str): The tenant ID.
+        apply (bool): Apply the merges rather than only proposing them.
+        merge_threshold (float): The cosine distance between centroids below which two clusters are merged.
+        block_size (int): The number of centroids compared at a time.
+        chunk_size (int): The number of clusters read from the database at a time.
+        update_batch_size (int): The number of merged clusters per write transaction.
+        on_batch (Optional[Callable[[psycopg2.extensions.cursor], None]]): Called in the transaction of each batch of merges.
+        on_progress (Optional[Callable[[], None]]): Called after each chunk of centroids loaded and each row of
+            blocks compared, outside of any transaction of `conn`, which is reading the centroids.
+
+    Returns:
+        dict: The number of clusters, the proposed merges and, when applied, the number of faces moved.
+    """
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=WORK_DIR) as work_dir:
+        cluster_ids, centroids, face_counts, pinned = _load_centroids(conn, tenant_id, os.path.join(work_dir, "centroids.npy"), chunk_size, on_progress)
+        forest = _ClusterForest(face_counts, pinned)
+        _link_close_centroids(centroids, len(cluster_ids), forest, merge_threshold, block_size, on_progress)
+        del centroids
+
+    merged_into: Dict[str, List[str]] = {}
+    for i, cluster_id in enumerate(cluster_ids):
+        root = forest.find(i)
+        if root != i:
+            merged_into.setdefault(cluster_ids[root], []).append(cluster_id)
+    merges = [(source_id, target_id) for target_id, source_ids in merged_into.items() for source_id in source_ids]
+
+    moved_faces: Optional[int] = None
+    if apply:
+        moved_faces = 0
+        try:
+            for batch_start in range(0, len(merges), update_batch_size):
+                with conn.cursor() as cur:
+                    moved_faces += sql_merge_clusters(cur, tenant_id, merges[batch_start:batch_start + update_batch_size])
+                    if on_batch is not None:
+                        on_batch(cur)
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    print(f"Re-clustered tenant {tenant_id}: {len(merges)} of {len(cluster_ids)} clusters merged in {time.perf_counter() - start:.1f}s")
+    return {
+        "clusters": len(cluster_ids),
+        "merged_clusters": len(merges),
+        "merges": [{"cluster_id": target_id, "merged_cluster_ids": source_ids} for target_id, source_ids in merged_into.items()],
+        "applied": apply,
+        "moved_faces": moved_faces,
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenant-id", required=True, help="Tenant to re-cluster")
+    parser.add_argument("--apply", action="store_true", help="Apply the merges instead of only printing them")
+    parser.add_argument("--merge-threshold", type=float, default=MERGE_THRESHOLD, help="Cosine distance between centroids below which clusters are merged")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE, help="Centroids compared at a time")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        result = recluster_tenant(conn, args.tenant_id, apply=args.apply, merge_threshold=args.merge_threshold, block_size=args.block_size)
+        print(json.dumps(result, indent=2))
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
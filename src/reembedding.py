@@ -0,0 +1,355 @@
+"""
+Rolling out another face model by re-embedding the stored face crops, see src/crops.py,
+instead of detecting the faces of every photo again.
+
+1. `crops` stores the crops of faces inserted before crops were kept. It detects the
+   faces of their uploads again, once, and takes the crop of the detected face that
+   overlaps the stored box, or the stored box itself unaligned if none does.
+2. `embed` computes the embeddings of the new model for every face that has a crop,
+   `[reembedding] batch_size` crops per forward pass and per transaction, and stages
+   them in face_embeddings_next next to the current ones. Crops are decoded on every
+   core while TensorFlow runs the batch. It resumes where it stopped, and `queue`
+   runs it as one job per tenant on the workers instead, reporting its progress to
+   GET /jobs/{job_id}.
+3. `switch` embeds the faces inserted since, copies the staged embeddings into new
+   columns typed with the model's dimension, computes the clusters and builds the
+   vector indexes on them, tenant by tenant, while inserts go on. It then blocks the
+   writes to faces and clusters only to catch up with those made meanwhile, swap the
+   new columns for the current ones and record the new model, in one transaction:
+   matching sees either the old embeddings or the new ones. The API and the workers
+   read the model from the face_model table and embed with the new one from then on.
+
+    python -m src.reembedding crops
+    python -m src.reembedding embed --model-name ArcFace --tenant-id my_tenant
+    python -m src.reembedding queue --model-name ArcFace
+    python -m src.reembedding switch --model-name ArcFace
+
+Whole-image embeddings computed with the "facenet" descriptor come from the face
+model too: recompute them after the switch, see src/image_embedding.py.
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+import numpy as np
+import psycopg2
+import toml
+from PIL import Image
+from src.crops import append_crops, decode_crop, encode_crop, read_crops
+from src.detection import detection_settings
+from src.image_embedding import upload_path
+from src.models import MODEL_REGISTRY
+from src.sql import (sql_abort_face_model_switch, sql_compute_next_clusters, sql_count_faces_to_reembed, sql_create_next_embedding_indexes,
+                     sql_enqueue_job, sql_fill_next_embeddings, sql_find_active_job, sql_get_face_model, sql_get_face_tenants,
+                     sql_get_faces_to_reembed, sql_get_faces_without_next_embedding, sql_get_images_without_crops, sql_lock_face_model,
+                     sql_prepare_face_model_switch, sql_set_face_crops, sql_set_face_model, sql_set_next_embeddings, sql_stage_embeddings,
+                     sql_swap_embedding_columns, sql_take_face_model_switch_log, sql_validate_embedding_columns)
+from src.utils import get_db_connection
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+REEMBEDDING_CONFIG = config.get("reembedding", {})
+BATCH_SIZE = REEMBEDDING_CONFIG.get("batch_size", 256)
+CROP_BATCH_SIZE = REEMBEDDING_CONFIG.get("crop_batch_size", 16)
+
+REEMBED_JOB_KIND = "reembed_faces"
+# A detected face is the stored one if their boxes overlap this much
+MATCH_IOU = 0.5
+
+_decode_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="crop-decode")
+
+def _box_iou(a: Dict[str, int], b: Dict[str, int]) -> float:
+    overlap_w = max(min(a["x"] + a["w"], b["x"] + b["w"]) - max(a["x"], b["x"]), 0)
+    overlap_h = max(min(a["y"] + a["h"], b["y"] + b["h"]) - max(a["y"], b["y"]), 0)
+    overlap = overlap_w * overlap_h
+    union = a["w"] * a["h"] + b["w"] * b["h"] - overlap
+    return overlap / union if union > 0 else 0.0
+
+def _crop_stored_face(image: np.ndarray, detected: List[Dict[str, Any]], facial_area: Dict[str, int]) -> bytes:
+    """
+    The crop of a stored face: the detected face that overlaps it most, or its box.
+    """
+    best = max(detected, key=lambda face: _box_iou(face["facial_area"], facial_area), default=None)
+    if best is not None and _box_iou(best["facial_area"], facial_area) >= MATCH_IOU:
+        return encode_crop(best["face"])
+    x, y = max(facial_area["x"], 0), max(facial_area["y"], 0)
+    return encode_crop(image[y:y + facial_area["h"], x:x + facial_area["w"]])
+
+def store_missing_crops(conn: psycopg2.extensions.connection, tenant_id: str) -> Dict[str, int]:
+    """
+    Store the crops of the faces of a tenant that have none, from the saved uploads,
+    `crop_batch_size` images per transaction. Faces whose upload is no longer on disk
+    are skipped.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each batch.
+        tenant_id (str): The tenant ID.
+
+    Returns:
+        dict: The number of faces given a crop and of images whose upload is missing.
+    """
+    settings = detection_settings(tenant_id)
+    stored = missing = 0
+    after_image_id = ""
+    while True:
+        with conn.cursor() as cur:
+            images = sql_get_images_without_crops(cur, tenant_id, after_image_id, CROP_BATCH_SIZE)
+        conn.rollback()
+        if len(images) == 0:
+            break
+        after_image_id = images[-1][0]
+
+        face_ids: List[str] = []
+        crops: List[bytes] = []
+        for image_id, image_face_ids, facial_areas in images:
+            path = upload_path(image_id)
+            if not os.path.exists(path):
+                missing += 1
+                continue
+            with Image.open(path) as upload:
+                image = np.asarray(upload.convert("RGB"))
+            try:
+                detected = MODEL_REGISTRY.detect_faces(image[:, :, ::-1], settings)
+            except ValueError:
+                # No face detected this time, the stored boxes are cropped as they are
+                detected = []
+            for face_id, facial_area in zip(image_face_ids, facial_areas):
+                face_ids.append(face_id)
+                crops.append(_crop_stored_face(image, detected, facial_area))
+        locations = append_crops(tenant_id, crops)
+        with conn.cursor() as cur:
+            sql_set_face_crops(cur, tenant_id, [(face_id, offset, length) for face_id, (offset, length) in zip(face_ids, locations)])
+        conn.commit()
+        stored += len(face_ids)
+    return {"crops": stored, "missing_uploads": missing}
+
+def check_model(model_name: str) -> int:
+    """
+    Build a face model, which fails for a name DeepFace does not know.
+
+    Returns:
+        int: The dimension of its embeddings.
+    """
+    return MODEL_REGISTRY.embedding_dimension(model_name)
+
+def _embed_crops(tenant_id: str, rows: List[Tuple[str, int, int]], model_name: str) -> List[Tuple[str, List[float]]]:
+    """
+    Embed the stored crops of some faces of a tenant with one forward pass.
+
+    Returns:
+        list: The face IDs and their embedding vectors.
+    """
+    crops = read_crops(tenant_id, [(offset, length) for _, offset, length in rows])
+    # OpenCV releases the GIL, the crops are decoded in parallel
+    embeddings = MODEL_REGISTRY.embed_faces(list(_decode_pool.map(decode_crop, crops)), model_name)
+    return [(face_id, embedding) for (face_id, _, _), embedding in zip(rows, embeddings)]
+
+def reembed_tenant(conn: psycopg2.extensions.connection, tenant_id: str, model_name: str, batch_size: int = BATCH_SIZE,
+                   on_batch: Optional[Callable[[psycopg2.extensions.cursor, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Stage the embeddings of `model_name` for the faces of a tenant that have a crop
+    and no staged embedding yet, `batch_size` faces per forward pass.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each batch.
+        tenant_id (str): The tenant ID.
+        model_name (str): The DeepFace model being rolled out.
+        batch_size (int): The number of faces per batch.
+        on_batch (Optional[Callable[[psycopg2.extensions.cursor, Dict[str, Any]], None]]): Called with the progress in the transaction of each batch.
+
+    Returns:
+        dict: The progress: the model, the number of faces of the tenant, of faces with a staged
+            embedding, of faces embedded by this call and of faces without a crop.
+    """
+    check_model(model_name)
+    with conn.cursor() as cur:
+        faces, staged, without_crop = sql_count_faces_to_reembed(cur, tenant_id, model_name)
+    progress = {"model_version": model_name, "faces": faces, "staged": staged, "embedded": 0, "without_crop": without_crop}
+    after_face_id = ""
+    while True:
+        with conn.cursor() as cur:
+            rows = sql_get_faces_to_reembed(cur, tenant_id, model_name, after_face_id, batch_size)
+        if len(rows) == 0:
+            break
+        after_face_id = rows[-1][0]
+
+        embeddings = _embed_crops(tenant_id, rows, model_name)
+        with conn.cursor() as cur:
+            sql_stage_embeddings(cur, tenant_id, model_name, embeddings)
+            progress["staged"] += len(rows)
+            progress["embedded"] += len(rows)
+            if on_batch is not None:
+                on_batch(cur, progress)
+        conn.commit()
+    return progress
+
+def _catch_up(cur: psycopg2.extensions.cursor, model_name: str, batch_size: int) -> int:
+    """
+    Embed the faces inserted since the switch started, and compute again the clusters
+    that faces were inserted into, deleted from or moved between, from the faces
+    logged in face_model_switch_log.
+
+    Returns:
+        int: The number of faces embedded.
+
+    Raises:
+        ValueError: If an inserted face has no crop to embed.
+    """
+    logged: Dict[str, Tuple[Set[str], Set[str]]] = {}
+    for tenant_id, face_id, cluster_id in sql_take_face_model_switch_log(cur):
+        face_ids, cluster_ids = logged.setdefault(tenant_id, (set(), set()))
+        if face_id is not None:
+            face_ids.add(face_id)
+        cluster_ids.add(cluster_id)
+    embedded = 0
+    for tenant_id, (face_ids, cluster_ids) in logged.items():
+        rows = sql_get_faces_without_next_embedding(cur, tenant_id, sorted(face_ids))
+        without_crop = [face_id for face_id, offset, _ in rows if offset is None]
+        if len(without_crop) > 0:
+            raise ValueError(f"Faces of {tenant_id} were inserted without a crop during the switch, enable [crops]: {json.dumps(without_crop)}")
+        for start in range(0, len(rows), batch_size):
+            sql_set_next_embeddings(cur, tenant_id, _embed_crops(tenant_id, rows[start:start + batch_size], model_name))
+        sql_compute_next_clusters(cur, tenant_id, sorted(cluster_ids))
+        embedded += len(rows)
+    return embedded
+
+def switch_model(conn: psycopg2.extensions.connection, model_name: str, batch_size: int = BATCH_SIZE) -> Dict[str, Any]:
+    """
+    Replace the embeddings of every face with those staged for `model_name`, whatever
+    their dimension, see step 3 of the module docstring. Inserts only wait for the
+    last transaction, which catches up with the faces written since the previous one
+    and swaps the columns. A failed switch drops what it added and can be run again.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each step.
+        model_name (str): The DeepFace model to switch to.
+        batch_size (int): The number of faces per batch when embedding the faces inserted since `embed`.
+
+    Returns:
+        dict: The previous and new models, and the number of tenants and faces switched.
+
+    Raises:
+        ValueError: If the model is already in use, or if a face has no crop to embed.
+    """
+    dimension = check_model(model_name)
+    with conn.cursor() as cur:
+        previous = sql_get_face_model(cur)
+    conn.rollback()
+    if previous == model_name:
+        raise ValueError(f"The faces are already embedded with {model_name}")
+    try:
+        # Faces written from then on are logged, those written before are all staged below
+        with conn.cursor() as cur:
+            sql_prepare_face_model_switch(cur, dimension)
+        conn.commit()
+        with conn.cursor() as cur:
+            tenants = sql_get_face_tenants(cur)
+        conn.rollback()
+        progress = {tenant_id: reembed_tenant(conn, tenant_id, model_name, batch_size) for tenant_id in tenants}
+        incomplete = {tenant_id: tenant["faces"] - tenant["staged"] for tenant_id, tenant in progress.items() if tenant["staged"] < tenant["faces"]}
+        if len(incomplete) > 0:
+            raise ValueError(f"Faces without a crop, run the crops command or delete them: {json.dumps(incomplete)}")
+        faces = 0
+        for tenant_id in tenants:
+            with conn.cursor() as cur:
+                faces += sql_fill_next_embeddings(cur, tenant_id, model_name)
+                sql_compute_next_clusters(cur, tenant_id)
+            conn.commit()
+        conn.set_session(autocommit=True)
+        try:
+            with conn.cursor() as cur:
+                sql_create_next_embedding_indexes(cur, dimension)
+        finally:
+            conn.set_session(autocommit=False)
+        with conn.cursor() as cur:
+            faces += _catch_up(cur, model_name, batch_size)
+        conn.commit()
+
+        with conn.cursor() as cur:
+            sql_lock_face_model(cur)
+            faces += _catch_up(cur, model_name, batch_size)
+            sql_swap_embedding_columns(cur)
+            sql_set_face_model(cur, model_name)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        with conn.cursor() as cur:
+            sql_abort_face_model_switch(cur)
+        conn.commit()
+        raise
+    with conn.cursor() as cur:
+        sql_validate_embedding_columns(cur)
+    conn.commit()
+    return {"previous_model_version": previous, "model_version": model_name, "tenants": len(tenants), "faces": faces}
+
+def queue_reembedding(conn: psycopg2.extensions.connection, tenant_ids: List[str], model_name: str) -> List[str]:
+    """
+    Queue a job staging the embeddings of `model_name` for each tenant, unless one is already queued or running.
+
+    Returns:
+        list: The job IDs, in the order of `tenant_ids`.
+    """
+    job_ids = []
+    with conn.cursor() as cur:
+        for tenant_id in tenant_ids:
+            job_id = sql_find_active_job(cur, tenant_id, REEMBED_JOB_KIND)
+            if job_id is None:
+                job_id = str(uuid.uuid4())
+                sql_enqueue_job(cur, tenant_id, job_id, REEMBED_JOB_KIND, {"model_name": model_name})
+            job_ids.append(job_id)
+    conn.commit()
+    return job_ids
+
+def _print_progress(tenant_id: str, progress: Dict[str, Any], start: float) -> None:
+    print(f"{tenant_id}: {progress['staged']}/{progress['faces']} faces embedded with {progress['model_version']}, "
+          f"{progress['embedded'] / (time.perf_counter() - start):.0f} faces/s", flush=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    crops_parser = commands.add_parser("crops", help="Store the crops of the faces that have none")
+    crops_parser.add_argument("--tenant-id", help="Tenant whose faces to crop, every tenant if omitted")
+    for name, description in [("embed", "Stage the embeddings of a model"), ("queue", "Queue jobs staging the embeddings of a model")]:
+        command_parser = commands.add_parser(name, help=description)
+        command_parser.add_argument("--model-name", required=True, help="DeepFace model to roll out")
+        command_parser.add_argument("--tenant-id", help="Tenant whose faces to embed, every tenant if omitted")
+        if name == "embed":
+            command_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Faces per forward pass")
+    switch_parser = commands.add_parser("switch", help="Switch every face to the staged embeddings of a model")
+    switch_parser.add_argument("--model-name", required=True, help="DeepFace model to switch to")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            tenant_ids = [args.tenant_id] if getattr(args, "tenant_id", None) is not None else sql_get_face_tenants(cur)
+        conn.rollback()
+        if args.command == "crops":
+            for tenant_id in tenant_ids:
+                result = store_missing_crops(conn, tenant_id)
+                print(f"{tenant_id}: {result['crops']} crops stored, {result['missing_uploads']} uploads missing")
+        elif args.command == "embed":
+            for tenant_id in tenant_ids:
+                tenant_start = time.perf_counter()
+                result = reembed_tenant(conn, tenant_id, args.model_name, args.batch_size,
+                                        on_batch=lambda cur, progress: _print_progress(tenant_id, progress, tenant_start))
+                if result["without_crop"] > 0:
+                    print(f"{tenant_id}: {result['without_crop']} faces have no crop, run the crops command")
+        elif args.command == "queue":
+            check_model(args.model_name)
+            for tenant_id, job_id in zip(tenant_ids, queue_reembedding(conn, tenant_ids, args.model_name)):
+                print(f"{tenant_id}: job {job_id}")
+        else:
+            result = switch_model(conn, args.model_name)
+            print(f"Switched {result['faces']} faces of {result['tenants']} tenants from {result['previous_model_version']} to {result['model_version']}, "
+                  f"the API and the workers embed new faces with it from now on")
+    finally:
+        conn.close()
+    print(f"Done in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Production launcher: a Gunicorn master that forks `[serving] workers` Uvicorn workers.
+
+The master imports the application, and with it TensorFlow, DeepFace, OpenCV and the
+rest of the service, once before forking, and freezes the garbage collector so that
+those pages stay shared copy-on-write between the workers. The models themselves are
+built by each worker right after the fork, before it accepts connections: TensorFlow
+is not fork-safe once it has run an operation, the same reason src/worker.py spawns
+its processes. Each worker runs TensorFlow on its share of the cores, so that workers
+do not oversubscribe them.
+
+    python -m src.serve --workers 4
+
+`kill -HUP <master pid>` starts new workers and stops the old ones once they have
+finished their in-flight requests, within `graceful_timeout`. It reloads the
+configuration of the launcher but not the code, which was loaded by the master:
+restart the launcher to deploy new code.
+
+Every `memory_report_interval` seconds the master prints the memory of each worker.
+RSS counts the pages shared with the master and the other workers in full, PSS
+divides them between the processes sharing them, and USS is what exiting the worker
+would free. Size pods by the total PSS, and the cost of one more worker by its USS.
+"""
+import argparse
+import gc
+import os
+import time
+from typing import Any, Dict, List, Optional
+import psutil
+import toml
+from gunicorn.app.base import BaseApplication
+from gunicorn.arbiter import Arbiter
+from src.models import INTRA_OP_THREADS, MODEL_REGISTRY
+from src.pipeline import load_models
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+SERVING_CONFIG = config.get("serving", {})
+SERVING_BIND = SERVING_CONFIG.get("bind", "0.0.0.0:8000")
+SERVING_WORKERS = SERVING_CONFIG.get("workers", 2)
+SERVING_TIMEOUT = SERVING_CONFIG.get("timeout", 120)
+SERVING_GRACEFUL_TIMEOUT = SERVING_CONFIG.get("graceful_timeout", 30)
+MEMORY_REPORT_INTERVAL = SERVING_CONFIG.get("memory_report_interval", 60)
+
+MB = 1 << 20
+
+def process_memory(pid: int) -> Optional[Dict[str, int]]:
+    """
+    Read the memory use of a process.
+
+    Args:
+        pid (int): The process ID.
+
+    Returns:
+        Optional[dict]: The RSS, shared, PSS and USS in bytes, or None if the process is gone.
+    """
+    try:
+        info = psutil.Process(pid).memory_full_info()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
+    return {"rss": info.rss, "shared": info.shared, "pss": info.pss, "uss": info.uss}
+
+def format_memory(name: str, memory: Dict[str, int]) -> str:
+    return f"{name:>14}  rss {memory['rss'] / MB:7.0f} MB  shared {memory['shared'] / MB:7.0f} MB  pss {memory['pss'] / MB:7.0f} MB  uss {memory['uss'] / MB:7.0f} MB"
+
+class MemoryReportingArbiter(Arbiter):
+    """
+    The Gunicorn master, printing the memory of itself and of every worker from its
+    main loop every `MEMORY_REPORT_INTERVAL` seconds.
+    """
+
+    def __init__(self, app: BaseApplication) -> None:
+        super().__init__(app)
+        self._next_report = time.monotonic() + MEMORY_REPORT_INTERVAL
+
+    def manage_workers(self) -> None:
+        super().manage_workers()
+        if MEMORY_REPORT_INTERVAL > 0 and time.monotonic() >= self._next_report:
+            self._next_report = time.monotonic() + MEMORY_REPORT_INTERVAL
+            self.report_memory()
+
+    def report_memory(self) -> None:
+        lines: List[str] = []
+        total_pss = 0
+        for name, pid in [("master", self.pid), *((f"worker {worker.age}", pid) for pid, worker in sorted(self.WORKERS.items()))]:
+            memory = process_memory(pid)
+            if memory is not None:
+                lines.append(format_memory(name, memory))
+                total_pss += memory["pss"]
+        print("\n".join(["Memory use:", *lines, f"{'total':>14}  pss {total_pss / MB:7.0f} MB"]), flush=True)
+
+def when_ready(server: Arbiter) -> None:
+    # The application is loaded: move everything allocated so far out of the garbage
+    # collector's reach, so that collections in the workers do not copy its pages
+    gc.freeze()
+
+def post_fork(server: Arbiter, worker: Any) -> None:
+    if INTRA_OP_THREADS <= 0:
+        MODEL_REGISTRY.intra_op_threads = max((os.cpu_count() or 1) // server.num_workers, 1)
+
+def post_worker_init(worker: Any) -> None:
+    # Build the models before the worker accepts connections, a reload then only
+    # routes requests to warm workers. A failure is reported by /ready.
+    try:
+        load_models()
+    except Exception as e:
+        print(f"Worker {worker.pid} could not load the models: {e}")
+
+class FaceRecognitionApplication(BaseApplication):
+    """
+    Gunicorn application serving main.py with the settings of `[serving]`.
+    """
+
+    def __init__(self, options: Dict[str, Any]) -> None:
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self) -> Any:
+        from main import app
+        return app
+
+    def run(self) -> None:
+        MemoryReportingArbiter(self).run()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bind", default=SERVING_BIND, help="Address to listen on")
+    parser.add_argument("--workers", type=int, default=SERVING_WORKERS, help="Number of worker processes")
+    args = parser.parse_args()
+
+    FaceRecognitionApplication({
+        "bind": args.bind,
+        "workers": args.workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": True,
+        "timeout": SERVING_TIMEOUT,
+        "graceful_timeout": SERVING_GRACEFUL_TIMEOUT,
+        "when_ready": when_ready,
+        "post_fork": post_fork,
+        "post_worker_init": post_worker_init,
+    }).run()
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,230 @@
-from typing import List, Tuple
+import itertools
+import json
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from fastapi import HTTPException
 import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+import toml
+from src.embedding_cache import EMBEDDING_CACHE
+from src.metrics import timed_sql
 
+# Load configuration from config.toml
+config = toml.load("config.toml")
+MATCHING_CONFIG = config.get("matching", {})
+MATCHING_INDEX = MATCHING_CONFIG.get("index", "hnsw")
+MATCHING_EF_SEARCH = MATCHING_CONFIG.get("ef_search", 40)
+MATCHING_PROBES = MATCHING_CONFIG.get("probes", 10)
+MATCHING_ITERATIVE_SCAN = MATCHING_CONFIG.get("iterative_scan", "off")
+MATCHING_CANDIDATES = MATCHING_CONFIG.get("candidates", 10)
+MATCHING_STRATEGY = MATCHING_CONFIG.get("strategy", "centroids")
+MATCHING_CLUSTER_CANDIDATES = MATCHING_CONFIG.get("cluster_candidates", 3)
+MATCHING_QUANTIZATION = MATCHING_CONFIG.get("quantization", "none")
+MATCHING_RERANK_CANDIDATES = MATCHING_CONFIG.get("rerank_candidates", 40)
+PARTITIONING_CONFIG = config.get("partitioning", {})
+DELETE_CHUNK_SIZE = PARTITIONING_CONFIG.get("delete_chunk_size", 5000)
+PARTITION_LOCK_TIMEOUT_MS = PARTITIONING_CONFIG.get("lock_timeout_ms", 5000)
+
+# The tables partitioned by tenant, see postgres/schema.sql
+PARTITIONED_TABLES = ("images", "faces", "clusters", "review_pending")
+
+# Perceptual hashes are indexed as four 16-bit substrings, see postgres/schema.sql
+PHASH_SUBSTRINGS = 4
+PHASH_SUBSTRING_BITS = 16
+
+# Advisory lock held shared by the transactions that write embeddings, and exclusively
+# by the swap to another face model's columns
+FACE_MODEL_LOCK = 0x66616365
+# The columns holding embeddings of the face model. A switch to another model fills
+# a <column>_next column next to each and swaps them, see src/reembedding.py.
+EMBEDDING_COLUMNS = (("faces", "embedding"), ("clusters", "embedding_sum"))
+
+def _ann_search_options() -> Tuple[str, Tuple[str, ...]]:
+    """
+    Build the statement that applies the vector index search options from config.toml
+    to the current transaction. It is sent together with the search query so that both
+    take a single round trip.
+    
+    Returns:
+        tuple: The SQL statement and its parameters.
+    """
+    if MATCHING_INDEX == "hnsw":
+        search_option, search_value = "hnsw.ef_search", MATCHING_EF_SEARCH
+    else:
+        search_option, search_value = "ivfflat.probes", MATCHING_PROBES
+    if MATCHING_ITERATIVE_SCAN == "off":
+        return "SELECT set_config(%s, %s, true);", (search_option, str(search_value))
+    # Iterative scans (pgvector 0.8+) keep walking the index until enough rows pass the
+    # tenant filter, instead of returning fewer than LIMIT rows
+    return ("SELECT set_config(%s, %s, true), set_config(%s, %s, true);",
+            (search_option, str(search_value), f"{MATCHING_INDEX}.iterative_scan", MATCHING_ITERATIVE_SCAN))
+
+def _approximate_distance(column: str, query: str, dimension: int) -> str:
+    """
+    Build the distance expression that the vector index of `column` is searched with,
+    for the configured quantization. Each form matches an index in postgres/schema.sql
+    or postgres/migrations/007_quantized_indexes.sql.
+    
+    Args:
+        column (str): The vector column, e.g. faces.embedding.
+        query (str): The SQL expression of the query vector.
+        dimension (int): The dimension of the embeddings, which the quantized indexes are cast to.
+    
+    Returns:
+        str: An ORDER BY expression, nearest first.
+    """
+    if MATCHING_QUANTIZATION == "halfvec":
+        return f"{column}::halfvec({dimension}) <=> {query}::halfvec({dimension})"
+    if MATCHING_QUANTIZATION == "binary":
+        # Hamming distance between the sign bits, only good enough to pick candidates
+        return f"binary_quantize({column})::bit({dimension}) <~> binary_quantize({query})"
+    return f"{column} <=> {query}"
+
+def _vector_literal(embedding: List[float]) -> str:
+    """
+    Format an embedding in pgvector's text representation.
+    
+    Args:
+        embedding (List[float]): The embedding vector.
+    
+    Returns:
+        str: The vector literal.
+    """
+    return "[" + ",".join(repr(float(value)) for value in embedding) + "]"
+
+def _add_faces_to_clusters(cur: psycopg2.extensions.cursor, tenant_id: str, face_ids: List[str]) -> None:
+    """
+    Add newly inserted faces to the running sums of their clusters, creating clusters
+    seen for the first time.
+    
+    A cluster stores the sum of its L2-normalized member embeddings. Cosine distance
+    ignores scale, so the sum can be compared to a face as is, without dividing by
+    the face count. The radius only grows here: it is the largest distance of a
+    member to the centroid at the time it joined.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        face_ids (List[str]): The IDs of the inserted faces.
+    """
+    # The increments are added to the stored values in ON CONFLICT, so concurrent
+    # inserts into the same cluster do not overwrite each other
+    cur.execute("""
+        WITH added AS (
+            SELECT cluster_id, l2_normalize(embedding) AS embedding
+            FROM faces
+            WHERE tenant_id = %s AND id = ANY(%s)
+        ), per_cluster AS (
+            SELECT cluster_id, sum(embedding) AS embedding_sum, count(*) AS face_count
+            FROM added
+            GROUP BY cluster_id
+        )
+        INSERT INTO clusters (tenant_id, id, embedding_sum, face_count, radius)
+        SELECT %s, per_cluster.cluster_id, per_cluster.embedding_sum, per_cluster.face_count, (
+            SELECT max(added.embedding <=> COALESCE(clusters.embedding_sum + per_cluster.embedding_sum, per_cluster.embedding_sum))
+            FROM added
+            WHERE added.cluster_id = per_cluster.cluster_id
+        )
+        FROM per_cluster
+        LEFT JOIN clusters ON clusters.tenant_id = %s AND clusters.id = per_cluster.cluster_id
+        ON CONFLICT (tenant_id, id) DO UPDATE SET
+            embedding_sum = clusters.embedding_sum + EXCLUDED.embedding_sum,
+            face_count = clusters.face_count + EXCLUDED.face_count,
+            radius = GREATEST(clusters.radius, EXCLUDED.radius)
+    """, (tenant_id, face_ids, tenant_id, tenant_id))
+
+def _remove_faces_from_clusters(cur: psycopg2.extensions.cursor, tenant_id: str, removed_faces_sql: str, params: Tuple) -> None:
+    """
+    Run a statement that removes faces from their clusters and subtract them from the
+    running sums of those clusters, in the same statement. Clusters left without faces
+    are deleted. The radius is not shrunk, it stays an upper bound until the cluster is
+    rebuilt.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        removed_faces_sql (str): A DELETE or UPDATE on faces returning the previous cluster_id and the embedding.
+        params (Tuple): The parameters of `removed_faces_sql`.
+    """
+    cur.execute(f"""
+        WITH removed(cluster_id, embedding) AS (
+            {removed_faces_sql}
+        ), per_cluster AS (
+            SELECT cluster_id, sum(l2_normalize(embedding)) AS embedding_sum, count(*) AS face_count
+            FROM removed
+            GROUP BY cluster_id
+        ), emptied AS (
+            DELETE FROM clusters
+            USING per_cluster
+            WHERE clusters.tenant_id = %s AND clusters.id = per_cluster.cluster_id AND clusters.face_count <= per_cluster.face_count
+        )
+        UPDATE clusters
+        SET embedding_sum = clusters.embedding_sum - per_cluster.embedding_sum, face_count = clusters.face_count - per_cluster.face_count
+        FROM per_cluster
+        WHERE clusters.tenant_id = %s AND clusters.id = per_cluster.cluster_id AND clusters.face_count > per_cluster.face_count
+    """, params + (tenant_id, tenant_id))
+
+@timed_sql
+def sql_rebuild_clusters(cur: psycopg2.extensions.cursor, tenant_id: str) -> None:
+    """
+    Recompute the clusters of a tenant from its faces, after faces were written without
+    going through the functions of this module.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+    """
+    cur.execute("DELETE FROM clusters WHERE tenant_id = %s", (tenant_id,))
+    cur.execute("""
+        INSERT INTO clusters (tenant_id, id, embedding_sum, face_count, radius)
+        SELECT tenant_id, cluster_id, sum(l2_normalize(embedding)), count(*), 0
+        FROM faces
+        WHERE tenant_id = %s
+        GROUP BY tenant_id, cluster_id
+    """, (tenant_id,))
+    cur.execute("""
+        UPDATE clusters
+        SET radius = COALESCE(members.radius, 0)
+        FROM (
+            SELECT faces.cluster_id, max(faces.embedding <=> clusters.embedding_sum) AS radius
+            FROM faces
+            JOIN clusters ON clusters.tenant_id = faces.tenant_id AND clusters.id = faces.cluster_id
+            WHERE faces.tenant_id = %s
+            GROUP BY faces.cluster_id
+        ) AS members
+        WHERE clusters.tenant_id = %s AND clusters.id = members.cluster_id
+    """, (tenant_id, tenant_id))
+
+@timed_sql
+def sql_get_embedding_dimension(cur: psycopg2.extensions.cursor, table: str, column: str = "embedding", tenant_id: Optional[str] = None) -> Optional[int]:
+    """
+    Read the dimension of a vector column from its type. A column declared without one,
+    like images.embedding, holds vectors of any dimension: given a tenant, the dimension
+    of the vectors it stored there is read instead.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        table (str): The table name.
+        column (str): The vector column.
+        tenant_id (Optional[str]): The tenant whose vectors to look at if the column has no dimension.
+    
+    Returns:
+        Optional[int]: The number of dimensions, None if the column has none and the tenant stored no vector in it.
+    """
+    # The type modifier of vector(n) is n, and -1 for a plain vector
+    cur.execute("SELECT atttypmod FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s", (table, column))
+    dimension = cur.fetchone()[0]
+    if dimension > 0:
+        return dimension
+    if tenant_id is None:
+        return None
+    cur.execute(sql.SQL("SELECT vector_dims({}) FROM {} WHERE tenant_id = %s AND {} IS NOT NULL LIMIT 1").format(
+        sql.Identifier(column), sql.Identifier(table), sql.Identifier(column)), (tenant_id,))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+@timed_sql
 def sql_insert_image(cur: psycopg2.extensions.cursor, tenant_id: str, image_id: str, phash: str, embedding: List[float]) -> None:
     """
     Insert a new image record into the images table.
@@ -15,6 +238,7 @@ def sql_insert_image(cur: psycopg2.extensions.cursor, tenant_id: str, image_id:
     """
     cur.execute("INSERT INTO images (tenant_id, id, phash, embedding) VALUES (%s, %s, %s, %s)", (tenant_id, image_id, phash, embedding))
 
+@timed_sql
 def sql_insert_face(cur: psycopg2.extensions.cursor, tenant_id: str, face_id: str, image_id: str, cluster_id: str, facial_area_json: str, is_auto_matched: bool, embedding: List[float]) -> None:
     """
     Insert a new face record into the faces table.
@@ -31,8 +255,11 @@ def sql_insert_face(cur: psycopg2.extensions.cursor, tenant_id: str, face_id: st
     """
     cur.execute("INSERT INTO faces (tenant_id, id, image_id, cluster_id, facial_area, is_auto_matched, embedding) VALUES (%s, %s, %s, %s, %s, %s, %s)", 
                 (tenant_id, face_id, image_id, cluster_id, facial_area_json, is_auto_matched, embedding))
+    _add_faces_to_clusters(cur, tenant_id, [face_id])
+    EMBEDDING_CACHE.add_face(cur, tenant_id, face_id, image_id, cluster_id, embedding)
 
-def sql_insert_review_pending(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_id: str) -> None:
+@timed_sql
+def sql_insert_review_pending(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_id: str, image_id: str) -> None:
     """
     Insert a new review pending record into the review_pending table.
     
@@ -40,9 +267,170 @@ def sql_insert_review_pending(cur: psycopg2.extensions.cursor, tenant_id: str, c
         cur (psycopg2.extensions.cursor): Database cursor object.
         tenant_id (str): The tenant ID.
         cluster_id (str): The cluster ID.
+        image_id (str): The ID of the image the cluster was first seen in.
+    """
+    cur.execute("INSERT INTO review_pending (tenant_id, cluster_id, image_id) VALUES (%s, %s, %s)", (tenant_id, cluster_id, image_id))
+
+@timed_sql
+def sql_insert_images(cur: psycopg2.extensions.cursor, tenant_id: str, images: List[Tuple[str, str, str, Optional[List[float]]]]) -> None:
+    """
+    Insert several image records into the images table with one statement.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        images (List[Tuple[str, str, str, Optional[List[float]]]]): The image IDs, perceptual hashes, SHA-256 of the
+            uploads and whole-image embedding vectors, None for images embedded later or never.
+    """
+    execute_values(cur, "INSERT INTO images (tenant_id, id, phash, content_sha256, embedding) VALUES %s",
+                   [(tenant_id, image_id, phash, content_sha256, embedding) for image_id, phash, content_sha256, embedding in images],
+                   template="(%s, %s, %s, %s, %s::vector)", page_size=1000)
+
+@timed_sql
+def sql_get_images_to_embed(cur: psycopg2.extensions.cursor, tenant_id: str, after_image_id: str, limit: int, recompute: bool) -> List[str]:
+    """
+    Retrieve a page of the images of a tenant that have no whole-image embedding yet.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        after_image_id (str): The last image ID of the previous page, "" for the first page.
+        limit (int): The maximum number of image IDs to return.
+        recompute (bool): Also return the images that already have one.
+    
+    Returns:
+        list: The image IDs, in order.
+    """
+    cur.execute("""
+        SELECT id FROM images
+        WHERE tenant_id = %s AND id > %s AND (embedding IS NULL OR %s)
+        ORDER BY id
+        LIMIT %s
+    """, (tenant_id, after_image_id, recompute, limit))
+    return [row[0] for row in cur.fetchall()]
+
+@timed_sql
+def sql_set_image_embeddings(cur: psycopg2.extensions.cursor, tenant_id: str, embeddings: List[Tuple[str, List[float]]]) -> None:
+    """
+    Store the whole-image embeddings of several images with one statement.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        embeddings (List[Tuple[str, List[float]]]): The image IDs and their embedding vectors.
+    """
+    execute_values(cur, """
+        UPDATE images SET embedding = data.embedding
+        FROM (VALUES %s) AS data (tenant_id, id, embedding)
+        WHERE images.tenant_id = data.tenant_id AND images.id = data.id
+    """, [(tenant_id, image_id, embedding) for image_id, embedding in embeddings], template="(%s, %s, %s::vector)", page_size=1000)
+
+@timed_sql
+def sql_find_image_by_content(cur: psycopg2.extensions.cursor, tenant_id: str, content_sha256: str) -> Optional[str]:
+    """
+    Find an image of the tenant uploaded with exactly the same bytes.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        content_sha256 (str): The SHA-256 of the upload.
+    
+    Returns:
+        Optional[str]: The image ID, or None.
+    """
+    cur.execute("SELECT id FROM images WHERE tenant_id = %s AND content_sha256 = %s LIMIT 1", (tenant_id, content_sha256))
+    result = cur.fetchone()
+    return result[0] if result is not None else None
+
+@timed_sql
+def sql_copy_image(cur: psycopg2.extensions.cursor, tenant_id: str, source_image_id: str, image_id: str, content_sha256: str, phash: Optional[str]) -> List[Tuple[str, str]]:
+    """
+    Insert a new image that reuses the faces, clusters, embeddings and crops of an existing one.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        source_image_id (str): The ID of the image to copy.
+        image_id (str): The ID of the new image.
+        content_sha256 (str): The SHA-256 of the new upload.
+        phash (Optional[str]): The perceptual hash of the new upload, None to keep the source's.
+    
+    Returns:
+        list: The new face IDs and their cluster IDs.
+    """
+    _share_face_model_lock(cur)
+    cur.execute("""
+        INSERT INTO images (tenant_id, id, phash, content_sha256, embedding)
+        SELECT tenant_id, %s, COALESCE(%s, phash), %s, embedding
+        FROM images
+        WHERE tenant_id = %s AND id = %s
+    """, (image_id, phash, content_sha256, tenant_id, source_image_id))
+    if cur.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Image not found")
+    cur.execute("""
+        INSERT INTO faces (tenant_id, id, image_id, cluster_id, facial_area, is_auto_matched, embedding, crop_offset, crop_length)
+        SELECT tenant_id, gen_random_uuid()::text, %s, cluster_id, facial_area, TRUE, embedding, crop_offset, crop_length
+        FROM faces
+        WHERE tenant_id = %s AND image_id = %s
+        RETURNING id, cluster_id, embedding::real[]
+    """, (image_id, tenant_id, source_image_id))
+    faces = cur.fetchall()
+    _add_faces_to_clusters(cur, tenant_id, [face_id for face_id, _, _ in faces])
+    for face_id, cluster_id, embedding in faces:
+        EMBEDDING_CACHE.add_face(cur, tenant_id, face_id, image_id, cluster_id, embedding)
+    return [(face_id, cluster_id) for face_id, cluster_id, _ in faces]
+
+def _share_face_model_lock(cur: psycopg2.extensions.cursor) -> None:
+    cur.execute("SELECT pg_advisory_xact_lock_shared(%s)", (FACE_MODEL_LOCK,))
+
+@timed_sql
+def sql_share_face_model(cur: psycopg2.extensions.cursor) -> str:
+    """
+    Retrieve the face model that the embeddings to write must be computed with, and
+    keep it from being switched until the transaction ends.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    
+    Returns:
+        str: The DeepFace model name.
+    """
+    _share_face_model_lock(cur)
+    return sql_get_face_model(cur)
+
+@timed_sql
+def sql_insert_faces(cur: psycopg2.extensions.cursor, tenant_id: str, faces: List[Tuple[str, str, str, str, bool, List[float], Optional[int], Optional[int]]]) -> None:
+    """
+    Insert several face records into the faces table with one statement.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        faces (List[Tuple[str, str, str, str, bool, List[float], Optional[int], Optional[int]]]): The face IDs, image IDs,
+            cluster IDs, facial areas in JSON format, auto matched flags, embedding vectors, and offsets and lengths
+            of the crops in the tenant's pack file, None if they are not kept.
+    """
+    execute_values(cur, "INSERT INTO faces (tenant_id, id, image_id, cluster_id, facial_area, is_auto_matched, embedding, crop_offset, crop_length) VALUES %s",
+                   [(tenant_id, *face) for face in faces],
+                   template="(%s, %s, %s, %s, %s, %s, %s::vector, %s, %s)", page_size=1000)
+    _add_faces_to_clusters(cur, tenant_id, [face[0] for face in faces])
+    for face_id, image_id, cluster_id, _, _, embedding, _, _ in faces:
+        EMBEDDING_CACHE.add_face(cur, tenant_id, face_id, image_id, cluster_id, embedding)
+
+@timed_sql
+def sql_insert_review_pendings(cur: psycopg2.extensions.cursor, tenant_id: str, reviews: List[Tuple[str, str]]) -> None:
+    """
+    Insert several review pending records into the review_pending table with one statement.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        reviews (List[Tuple[str, str]]): The cluster IDs and the IDs of the images they were first seen in.
     """
-    cur.execute("INSERT INTO review_pending (tenant_id, cluster_id) VALUES (%s, %s)", (tenant_id, cluster_id))
+    execute_values(cur, "INSERT INTO review_pending (tenant_id, cluster_id, image_id) VALUES %s",
+                   [(tenant_id, cluster_id, image_id) for cluster_id, image_id in reviews], page_size=1000)
 
+@timed_sql
 def sql_delete_faces_by_image(cur: psycopg2.extensions.cursor, tenant_id: str, image_id: str) -> None:
     """
     Delete face records associated with a specific image.
@@ -52,8 +440,10 @@ def sql_delete_faces_by_image(cur: psycopg2.extensions.cursor, tenant_id: str, i
         tenant_id (str): The tenant ID.
         image_id (str): The image ID.
     """
-    cur.execute("DELETE FROM faces WHERE tenant_id = %s AND image_id = %s", (tenant_id, image_id))
+    _remove_faces_from_clusters(cur, tenant_id, "DELETE FROM faces WHERE tenant_id = %s AND image_id = %s RETURNING cluster_id, embedding", (tenant_id, image_id))
+    EMBEDDING_CACHE.remove_faces_by_image(cur, tenant_id, image_id)
 
+@timed_sql
 def sql_delete_image(cur: psycopg2.extensions.cursor, tenant_id: str, image_id: str) -> None:
     """
     Delete an image record from the images table.
@@ -63,8 +453,12 @@ def sql_delete_image(cur: psycopg2.extensions.cursor, tenant_id: str, image_id:
         tenant_id (str): The tenant ID.
         image_id (str): The image ID.
     """
+    # Remove the faces first so that they are subtracted from their clusters, the
+    # ON DELETE CASCADE of faces.image_id would bypass that
+    sql_delete_faces_by_image(cur, tenant_id, image_id)
     cur.execute("DELETE FROM images WHERE tenant_id = %s AND id = %s", (tenant_id, image_id))
 
+@timed_sql
 def sql_delete_face(cur: psycopg2.extensions.cursor, tenant_id: str, face_id: str) -> None:
     """
     Delete a face record from the faces table.
@@ -74,50 +468,100 @@ def sql_delete_face(cur: psycopg2.extensions.cursor, tenant_id: str, face_id: st
         tenant_id (str): The tenant ID.
         face_id (str): The face ID.
     """
-    cur.execute("DELETE FROM faces WHERE tenant_id = %s AND id = %s", (tenant_id, face_id))
+    _remove_faces_from_clusters(cur, tenant_id, "DELETE FROM faces WHERE tenant_id = %s AND id = %s RETURNING cluster_id, embedding", (tenant_id, face_id))
+    EMBEDDING_CACHE.remove_face(cur, tenant_id, face_id)
 
-def sql_delete_faces_by_cluster(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_id: str) -> None:
+@timed_sql
+def sql_delete_cluster_chunk(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_id: str, chunk_size: int) -> bool:
     """
-    Delete face records associated with a specific cluster.
+    Delete the faces of a cluster found in up to `chunk_size` of its images, along with
+    those of the images that show no other cluster. The cluster itself is deleted with
+    its last face.
     
-    Args:
-        cur (psycopg2.extensions.cursor): Database cursor object.
-        tenant_id (str): The tenant ID.
-        cluster_id (str): The cluster ID.
-    """
-    cur.execute("DELETE FROM faces WHERE tenant_id = %s AND cluster_id = %s", (tenant_id, cluster_id))
-
-def sql_delete_images_by_cluster(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_id: str) -> None:
-    """
-    Delete image records associated with a specific cluster.
+    Call it until it returns True, committing in between, so that no transaction holds
+    the locks of a large cluster for long.
     
     Args:
         cur (psycopg2.extensions.cursor): Database cursor object.
         tenant_id (str): The tenant ID.
         cluster_id (str): The cluster ID.
+        chunk_size (int): The maximum number of images handled per call.
+    
+    Returns:
+        bool: True once the cluster has no faces left.
     """
-    cur.execute("DELETE FROM images WHERE tenant_id = %s AND cluster_id = %s", (tenant_id, cluster_id))
+    cur.execute("SELECT DISTINCT image_id FROM faces WHERE tenant_id = %s AND cluster_id = %s ORDER BY image_id LIMIT %s", (tenant_id, cluster_id, chunk_size))
+    image_ids = [row[0] for row in cur.fetchall()]
+    if len(image_ids) == 0:
+        return True
+    # Images are found through the faces of the cluster, so they go first
+    cur.execute("""
+        DELETE FROM images
+        WHERE tenant_id = %s
+          AND id = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM faces WHERE faces.tenant_id = %s AND faces.image_id = images.id AND faces.cluster_id <> %s)
+    """, (tenant_id, image_ids, tenant_id, cluster_id))
+    _remove_faces_from_clusters(cur, tenant_id, "DELETE FROM faces WHERE tenant_id = %s AND cluster_id = %s AND image_id = ANY(%s) RETURNING cluster_id, embedding",
+                                (tenant_id, cluster_id, image_ids))
+    EMBEDDING_CACHE.remove_faces_by_cluster(cur, tenant_id, cluster_id, image_ids)
+    return len(image_ids) < chunk_size
 
-def sql_delete_faces_by_tenant(cur: psycopg2.extensions.cursor, tenant_id: str) -> None:
+@timed_sql
+def sql_delete_tenant_chunk(cur: psycopg2.extensions.cursor, tenant_id: str, chunk_size: int) -> bool:
     """
-    Delete face records associated with a specific tenant.
+    Delete up to `chunk_size` images of a tenant and their faces, or once none are
+    left, up to `chunk_size` of its clusters and review pending records.
+    
+    Call it until it returns True, committing in between. Tenants with dedicated
+    partitions are deleted at once with `sql_drop_tenant_partitions` instead.
     
     Args:
         cur (psycopg2.extensions.cursor): Database cursor object.
         tenant_id (str): The tenant ID.
+        chunk_size (int): The maximum number of rows deleted per table and call.
+    
+    Returns:
+        bool: True once nothing of the tenant is left.
     """
-    cur.execute("DELETE FROM faces WHERE tenant_id = %s", (tenant_id,))
+    EMBEDDING_CACHE.invalidate(tenant_id, cur)
+    cur.execute("SELECT id FROM images WHERE tenant_id = %s LIMIT %s", (tenant_id, chunk_size))
+    image_ids = [row[0] for row in cur.fetchall()]
+    if len(image_ids) > 0:
+        # The clusters go with the rest of the tenant, their sums are not maintained here
+        cur.execute("DELETE FROM faces WHERE tenant_id = %s AND image_id = ANY(%s)", (tenant_id, image_ids))
+        cur.execute("DELETE FROM images WHERE tenant_id = %s AND id = ANY(%s)", (tenant_id, image_ids))
+        return False
+    for table in ("clusters", "review_pending"):
+        cur.execute(f"DELETE FROM {table} WHERE tenant_id = %s AND id IN (SELECT id FROM {table} WHERE tenant_id = %s LIMIT %s)", (tenant_id, tenant_id, chunk_size))
+        if cur.rowcount == chunk_size:
+            return False
+    return True
 
-def sql_delete_images_by_tenant(cur: psycopg2.extensions.cursor, tenant_id: str) -> None:
+@timed_sql
+def sql_drop_tenant_partitions(cur: psycopg2.extensions.cursor, tenant_id: str) -> bool:
     """
-    Delete image records associated with a specific tenant.
+    Delete a tenant that has dedicated partitions by dropping them, which takes the same
+    time however many rows they hold and leaves nothing to vacuum.
     
     Args:
         cur (psycopg2.extensions.cursor): Database cursor object.
         tenant_id (str): The tenant ID.
+    
+    Returns:
+        bool: False if the tenant lives in the shared partitions, and nothing was dropped.
     """
-    cur.execute("DELETE FROM images WHERE tenant_id = %s", (tenant_id,))
+    cur.execute("DELETE FROM tenant_partitions WHERE tenant_id = %s RETURNING suffix", (tenant_id,))
+    row = cur.fetchone()
+    if row is None:
+        return False
+    # Dropping a partition locks its parent table. Give up rather than queue every
+    # other query of every tenant behind a long-running one.
+    cur.execute("SELECT set_config('lock_timeout', %s, true)", (f"{PARTITION_LOCK_TIMEOUT_MS}ms",))
+    cur.execute(sql.SQL("DROP TABLE {}").format(sql.SQL(", ").join(sql.Identifier(f"{table}_{row[0]}") for table in PARTITIONED_TABLES)))
+    EMBEDDING_CACHE.invalidate(tenant_id, cur)
+    return True
 
+@timed_sql
 def sql_review_pending(cur: psycopg2.extensions.cursor, tenant_id: str, review_id: str) -> Tuple[int, str, str]:
     """
     Retrieve a review pending record from the review_pending table.
@@ -136,22 +580,30 @@ def sql_review_pending(cur: psycopg2.extensions.cursor, tenant_id: str, review_i
         raise HTTPException(status_code=404, detail="Review not found")
     return result
 
-def sql_get_review_list(cur: psycopg2.extensions.cursor, tenant_id: str, limit: int, skip: int) -> List[Tuple[int, str, str]]:
+@timed_sql
+def sql_get_review_list(cur: psycopg2.extensions.cursor, tenant_id: str, limit: int, after_id: Optional[int]) -> List[Tuple[int, str, str]]:
     """
-    Retrieve a list of review pending records from the review_pending table.
+    Retrieve a page of review pending records from the review_pending table, in ID order.
+    
+    Pages are read with keyset pagination on (tenant_id, id), so that every page is a
+    range scan of the (tenant_id, id) primary key however deep it is.
     
     Args:
         cur (psycopg2.extensions.cursor): Database cursor object.
         tenant_id (str): The tenant ID.
         limit (int): The maximum number of records to retrieve.
-        skip (int): The number of records to skip.
+        after_id (Optional[int]): The ID of the last record of the previous page, None for the first page.
     
     Returns:
         list: A list of review pending records.
     """
-    cur.execute("SELECT id, cluster_id, image_id FROM review_pending WHERE tenant_id = %s LIMIT %s OFFSET %s", (tenant_id, limit, skip))
+    if after_id is None:
+        cur.execute("SELECT id, cluster_id, image_id FROM review_pending WHERE tenant_id = %s ORDER BY id LIMIT %s", (tenant_id, limit))
+    else:
+        cur.execute("SELECT id, cluster_id, image_id FROM review_pending WHERE tenant_id = %s AND id > %s ORDER BY id LIMIT %s", (tenant_id, after_id, limit))
     return cur.fetchall()
 
+@timed_sql
 def sql_delete_review_pending(cur: psycopg2.extensions.cursor, tenant_id: str, review_id: str) -> None:
     """
     Delete a review pending record from the review_pending table.
@@ -163,9 +615,11 @@ def sql_delete_review_pending(cur: psycopg2.extensions.cursor, tenant_id: str, r
     """
     cur.execute("DELETE FROM review_pending WHERE tenant_id = %s AND id = %s", (tenant_id, review_id))
 
+@timed_sql
 def sql_update_face_owner(cur: psycopg2.extensions.cursor, tenant_id: str, face_id: str, to_cluster_id: str) -> None:
     """
-    Update the owner of a face record in the faces table.
+    Update the owner of a face record in the faces table. The face is marked as
+    manually assigned, so re-clustering never moves it again.
     
     Args:
         cur (psycopg2.extensions.cursor): Database cursor object.
@@ -173,8 +627,16 @@ def sql_update_face_owner(cur: psycopg2.extensions.cursor, tenant_id: str, face_
         face_id (str): The face ID.
         to_cluster_id (str): The new cluster ID.
     """
-    cur.execute("UPDATE faces SET cluster_id = %s WHERE tenant_id = %s AND id = %s", (to_cluster_id, tenant_id, face_id))
+    _remove_faces_from_clusters(cur, tenant_id, """
+        UPDATE faces SET cluster_id = %s, is_auto_matched = FALSE
+        FROM (SELECT id, cluster_id FROM faces WHERE tenant_id = %s AND id = %s FOR UPDATE) AS previous
+        WHERE faces.tenant_id = %s AND faces.id = previous.id
+        RETURNING previous.cluster_id, faces.embedding
+    """, (to_cluster_id, tenant_id, face_id, tenant_id))
+    _add_faces_to_clusters(cur, tenant_id, [face_id])
+    EMBEDDING_CACHE.move_face(cur, tenant_id, face_id, to_cluster_id)
 
+@timed_sql
 def sql_get_face(cur: psycopg2.extensions.cursor, tenant_id: str, face_id: str) -> Tuple[str, str, str, bool]:
     """
     Retrieve a face record from the faces table.
@@ -193,6 +655,7 @@ def sql_get_face(cur: psycopg2.extensions.cursor, tenant_id: str, face_id: str)
         raise HTTPException(status_code=404, detail="Face not found")
     return result
 
+@timed_sql
 def sql_get_cluster(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_id: str) -> Tuple[int, int]:
     """
     Retrieve cluster statistics from the faces table.
@@ -211,6 +674,7 @@ def sql_get_cluster(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_id:
         raise HTTPException(status_code=404, detail="Cluster not found")
     return result
 
+@timed_sql
 def sql_get_image(cur: psycopg2.extensions.cursor, tenant_id: str, image_id: str) -> Tuple[List[str], List[str], str]:
     """
     Retrieve an image record and associated faces and clusters from the database.
@@ -236,23 +700,221 @@ def sql_get_image(cur: psycopg2.extensions.cursor, tenant_id: str, image_id: str
         raise HTTPException(status_code=404, detail="Image not found")
     return result
 
-def sql_get_faces(cur: psycopg2.extensions.cursor, tenant_id: str, image_id: str, limit: int, skip: int) -> List[Tuple[str, str, str, str, bool]]:
+@timed_sql
+def sql_get_faces_by_id(cur: psycopg2.extensions.cursor, tenant_id: str, face_ids: List[str]) -> List[Tuple[str, str, str, str, bool]]:
+    """
+    Retrieve several face records from the faces table with one query.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        face_ids (List[str]): The face IDs.
+    
+    Returns:
+        list: The ID, cluster ID, image ID, facial area and auto-match flag of each face that exists.
+    """
+    cur.execute("SELECT id, cluster_id, image_id, facial_area, is_auto_matched FROM faces WHERE tenant_id = %s AND id = ANY(%s)", (tenant_id, face_ids))
+    return cur.fetchall()
+
+@timed_sql
+def sql_get_clusters_by_id(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_ids: List[str]) -> List[Tuple[str, int, int]]:
+    """
+    Retrieve the statistics of several clusters from the faces table with one query.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        cluster_ids (List[str]): The cluster IDs.
+    
+    Returns:
+        list: The ID, number of faces and number of images of each cluster that has faces.
+    """
+    cur.execute("""
+        SELECT cluster_id, COUNT(id), COUNT(DISTINCT image_id)
+        FROM faces
+        WHERE tenant_id = %s AND cluster_id = ANY(%s)
+        GROUP BY cluster_id
+    """, (tenant_id, cluster_ids))
+    return cur.fetchall()
+
+@timed_sql
+def sql_get_images_by_id(cur: psycopg2.extensions.cursor, tenant_id: str, image_ids: List[str]) -> List[Tuple[str, List[str], List[str], str]]:
+    """
+    Retrieve several image records and their faces and clusters with one query.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        image_ids (List[str]): The image IDs.
+    
+    Returns:
+        list: The ID, faces, clusters and perceptual hash of each image that exists.
+    """
+    cur.execute("""
+        SELECT
+            images.id,
+            COALESCE(array_agg(faces.id) FILTER (WHERE faces.id IS NOT NULL), '{}') AS face_ids,
+            COALESCE(array_agg(DISTINCT faces.cluster_id) FILTER (WHERE faces.id IS NOT NULL), '{}') AS cluster_ids,
+            images.phash
+        FROM images
+        LEFT JOIN faces ON faces.tenant_id = images.tenant_id AND faces.image_id = images.id
+        WHERE images.tenant_id = %s AND images.id = ANY(%s)
+        GROUP BY images.id, images.phash
+    """, (tenant_id, image_ids))
+    return cur.fetchall()
+
+@timed_sql
+def sql_get_image_face_clusters(cur: psycopg2.extensions.cursor, tenant_id: str, image_id: str) -> List[Tuple[str, str]]:
+    """
+    Retrieve the faces of an image and their clusters.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        image_id (str): The image ID.
+    
+    Returns:
+        list: The face IDs and their cluster IDs.
+    """
+    cur.execute("SELECT id, cluster_id FROM faces WHERE tenant_id = %s AND image_id = %s", (tenant_id, image_id))
+    return cur.fetchall()
+
+@timed_sql
+def sql_get_image_phashes(cur: psycopg2.extensions.cursor, tenant_id: str, image_ids: List[str]) -> List[Tuple[str, int]]:
     """
-    Retrieve a list of face records associated with a specific image.
+    Retrieve the perceptual hashes of several images as 64-bit integers.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        image_ids (List[str]): The image IDs.
+    
+    Returns:
+        list: The image IDs that exist and their perceptual hashes.
+    """
+    cur.execute("SELECT id, phash_int FROM images WHERE tenant_id = %s AND id = ANY(%s)", (tenant_id, image_ids))
+    return cur.fetchall()
+
+def _hamming_neighbours(value: int, radius: int, bits: int) -> List[int]:
+    """
+    List every value within a Hamming distance of `radius` of `value`.
+    
+    Args:
+        value (int): The value to start from.
+        radius (int): The maximum number of flipped bits.
+        bits (int): The width of the value in bits.
+    
+    Returns:
+        list: The neighbouring values, including `value` itself.
+    """
+    neighbours = [value]
+    for distance in range(1, radius + 1):
+        for positions in itertools.combinations(range(bits), distance):
+            flipped = value
+            for position in positions:
+                flipped ^= 1 << position
+            neighbours.append(flipped)
+    return neighbours
+
+@timed_sql
+def sql_get_similar_images(cur: psycopg2.extensions.cursor, tenant_id: str, image_phashes: List[Tuple[str, int]], max_distance: int) -> List[Tuple[str, str, int]]:
+    """
+    Find the images of the tenant whose perceptual hash is within a Hamming distance of
+    each given image, using multi-index hashing on the hash substrings.
+    
+    By the pigeonhole principle a hash within distance `max_distance` has at least one
+    of its four substrings within distance `max_distance // 4` of the query's, so only
+    those substring values are looked up before the exact distance is checked.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        image_phashes (List[Tuple[str, int]]): The image IDs and perceptual hashes to look up.
+        max_distance (int): The maximum Hamming distance between two hashes.
+    
+    Returns:
+        list: The queried image ID, similar image ID and Hamming distance of each match.
+    """
+    if len(image_phashes) == 0:
+        return []
+    radius = max_distance // PHASH_SUBSTRINGS
+    mask = (1 << PHASH_SUBSTRING_BITS) - 1
+    queries = []
+    for image_id, phash_int in image_phashes:
+        unsigned = phash_int & ((1 << (PHASH_SUBSTRINGS * PHASH_SUBSTRING_BITS)) - 1)
+        substrings = [(unsigned >> (PHASH_SUBSTRING_BITS * (PHASH_SUBSTRINGS - 1 - i))) & mask for i in range(PHASH_SUBSTRINGS)]
+        queries.append(cur.mogrify("(%s, %s::bigint, %s::integer[], %s::integer[], %s::integer[], %s::integer[])",
+                                   (image_id, phash_int, *[_hamming_neighbours(substring, radius, PHASH_SUBSTRING_BITS) for substring in substrings])).decode().replace("%", "%%"))
+    cur.execute(f"""
+        SELECT query.image_id, candidate.id, candidate.distance
+        FROM (VALUES {", ".join(queries)}) AS query(image_id, phash_int, phash_0, phash_1, phash_2, phash_3)
+        JOIN LATERAL (
+            -- Counts the differing bits as text, bit_count() needs PostgreSQL 14
+            SELECT id, length(replace((images.phash_int # query.phash_int)::bit(64)::text, '0', '')) AS distance
+            FROM images
+            WHERE tenant_id = %s AND id <> query.image_id
+              AND (images.phash_0 = ANY(query.phash_0) OR images.phash_1 = ANY(query.phash_1)
+                   OR images.phash_2 = ANY(query.phash_2) OR images.phash_3 = ANY(query.phash_3))
+        ) AS candidate ON TRUE
+        WHERE candidate.distance <= %s
+        ORDER BY query.image_id, candidate.distance
+    """, (tenant_id, max_distance))
+    return cur.fetchall()
+
+@timed_sql
+def sql_get_faces(cur: psycopg2.extensions.cursor, tenant_id: str, image_id: str, limit: int, after_face_id: Optional[str]) -> List[Tuple[str, str, str, str, bool]]:
+    """
+    Retrieve a page of face records associated with a specific image, in face ID order.
+    
+    Pages are read with keyset pagination on (tenant_id, image_id, id), see
+    faces_tenant_image_id_idx.
     
     Args:
         cur (psycopg2.extensions.cursor): Database cursor object.
         tenant_id (str): The tenant ID.
         image_id (str): The image ID.
         limit (int): The maximum number of records to retrieve.
-        skip (int): The number of records to skip.
+        after_face_id (Optional[str]): The ID of the last face of the previous page, None for the first page.
     
     Returns:
         list: A list of face records.
     """
-    cur.execute("SELECT id, cluster_id, image_id, facial_area, is_auto_matched FROM faces WHERE tenant_id = %s AND image_id = %s LIMIT %s OFFSET %s", (tenant_id, image_id, limit, skip))
+    if after_face_id is None:
+        cur.execute("SELECT id, cluster_id, image_id, facial_area, is_auto_matched FROM faces WHERE tenant_id = %s AND image_id = %s ORDER BY id LIMIT %s",
+                    (tenant_id, image_id, limit))
+    else:
+        cur.execute("SELECT id, cluster_id, image_id, facial_area, is_auto_matched FROM faces WHERE tenant_id = %s AND image_id = %s AND id > %s ORDER BY id LIMIT %s",
+                    (tenant_id, image_id, after_face_id, limit))
     return cur.fetchall()
 
+@timed_sql
+def sql_get_cluster_images(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_id: str, limit: int, after_image_id: Optional[str]) -> List[str]:
+    """
+    Retrieve a page of the images that contain a face of a specific cluster, in image ID order.
+    
+    Pages are read with keyset pagination on (tenant_id, cluster_id, image_id), see
+    faces_tenant_cluster_image_idx. An image with several faces of the cluster is
+    listed once.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        cluster_id (str): The cluster ID.
+        limit (int): The maximum number of image IDs to retrieve.
+        after_image_id (Optional[str]): The last image ID of the previous page, None for the first page.
+    
+    Returns:
+        list: The image IDs.
+    """
+    if after_image_id is None:
+        cur.execute("SELECT DISTINCT image_id FROM faces WHERE tenant_id = %s AND cluster_id = %s ORDER BY image_id LIMIT %s",
+                    (tenant_id, cluster_id, limit))
+    else:
+        cur.execute("SELECT DISTINCT image_id FROM faces WHERE tenant_id = %s AND cluster_id = %s AND image_id > %s ORDER BY image_id LIMIT %s",
+                    (tenant_id, cluster_id, after_image_id, limit))
+    return [row[0] for row in cur.fetchall()]
+
+@timed_sql
 def sql_check_matching_faces(cur: psycopg2.extensions.cursor, tenant_id: str, new_face_embedding: List[float], similarity_threshold: float) -> List[Tuple[str, str, float]]:
     """
     Check for matching faces within the same tenant.
@@ -266,16 +928,800 @@ def sql_check_matching_faces(cur: psycopg2.extensions.cursor, tenant_id: str, ne
     Returns:
         list: A list of matching faces with their IDs, cluster IDs, and distances.
     """
-    cur.execute("""
-        WITH RankedFaces AS (
-            SELECT id, cluster_id, embedding <=> %s::vector AS distance
-            FROM faces
-            WHERE tenant_id = %s
-        )
-        SELECT id, cluster_id, distance
-        FROM RankedFaces
-        WHERE distance <= %s
-        ORDER BY distance
-        LIMIT 1
-    """, (new_face_embedding, tenant_id, similarity_threshold))
-    return cur.fetchall()
+    match = sql_match_faces(cur, tenant_id, [new_face_embedding], similarity_threshold)[0]
+    return [match] if match is not None else []
+
+@timed_sql
+def sql_match_faces(cur: psycopg2.extensions.cursor, tenant_id: str, embeddings: List[List[float]], similarity_threshold: float) -> List[Optional[Tuple[str, str, float]]]:
+    """
+    Find the closest existing face of the tenant for each of several new faces in one query.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        embeddings (List[List[float]]): The embedding vectors of the new faces.
+        similarity_threshold (float): The similarity threshold for matching faces.
+    
+    Returns:
+        list: For each new face, in order, the ID, cluster ID and distance of its best match, or None.
+    """
+    if len(embeddings) == 0:
+        return []
+    if EMBEDDING_CACHE.enabled:
+        cached = EMBEDDING_CACHE.match(cur, tenant_id, embeddings, similarity_threshold, sql_count_faces, sql_get_tenant_embeddings)
+        if cached is not None:
+            return [matches[0] if len(matches) > 0 else None for matches in cached]
+
+    if MATCHING_STRATEGY == "centroids":
+        return _match_faces_by_centroid(cur, tenant_id, embeddings, similarity_threshold)
+
+    options_sql, options_params = _ann_search_options()
+    # Each new face gets its own nearest neighbour search. The inner query orders by the
+    # raw distance expression so the planner can walk the vector index; the threshold is
+    # applied to its candidates afterwards, as filtering on the distance first would
+    # force an exact scan of the tenant's faces. With a quantized index the candidates
+    # are reranked by their full-precision distance before the threshold is applied.
+    cur.execute(options_sql + f"""
+        SELECT new_faces.ordinality, best.id, best.cluster_id, best.distance
+        FROM unnest(%s::vector[]) WITH ORDINALITY AS new_faces(embedding, ordinality)
+        LEFT JOIN LATERAL (
+            SELECT id, cluster_id, embedding <=> new_faces.embedding AS distance
+            FROM (
+                SELECT id, cluster_id, embedding
+                FROM faces
+                WHERE tenant_id = %s
+                ORDER BY {_approximate_distance("embedding", "new_faces.embedding", len(embeddings[0]))}
+                LIMIT %s
+            ) AS candidates
+            WHERE embedding <=> new_faces.embedding <= %s
+            ORDER BY distance
+            LIMIT 1
+        ) AS best ON TRUE
+        ORDER BY new_faces.ordinality
+    """, options_params + ([_vector_literal(embedding) for embedding in embeddings], tenant_id,
+                           MATCHING_CANDIDATES if MATCHING_QUANTIZATION == "none" else MATCHING_RERANK_CANDIDATES, similarity_threshold))
+    return [(face_id, cluster_id, distance) if face_id is not None else None for _, face_id, cluster_id, distance in cur.fetchall()]
+
+def _match_faces_by_centroid(cur: psycopg2.extensions.cursor, tenant_id: str, embeddings: List[List[float]], similarity_threshold: float) -> List[Optional[Tuple[str, str, float]]]:
+    """
+    Match new faces in two stages: find the nearest cluster centroids of each face with
+    the vector index on clusters, then compare the face to the members of only those
+    clusters. Tenants have far fewer clusters than faces, so the index search is
+    correspondingly smaller.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        embeddings (List[List[float]]): The embedding vectors of the new faces.
+        similarity_threshold (float): The similarity threshold for matching faces.
+    
+    Returns:
+        list: For each new face, in order, the ID, cluster ID and distance of its best match, or None.
+    """
+    options_sql, options_params = _ann_search_options()
+    # With a quantized index, more clusters than needed are read from it and the
+    # nearest ones by full-precision distance are kept
+    cur.execute(options_sql + f"""
+        SELECT new_faces.ordinality, best.id, best.cluster_id, best.distance
+        FROM unnest(%s::vector[]) WITH ORDINALITY AS new_faces(embedding, ordinality)
+        LEFT JOIN LATERAL (
+            SELECT faces.id, faces.cluster_id, faces.embedding <=> new_faces.embedding AS distance
+            FROM (
+                SELECT id
+                FROM (
+                    SELECT id, embedding_sum
+                    FROM clusters
+                    WHERE tenant_id = %s
+                    ORDER BY {_approximate_distance("embedding_sum", "new_faces.embedding", len(embeddings[0]))}
+                    LIMIT %s
+                ) AS candidates
+                ORDER BY embedding_sum <=> new_faces.embedding
+                LIMIT %s
+            ) AS nearest_clusters
+            JOIN faces ON faces.tenant_id = %s AND faces.cluster_id = nearest_clusters.id
+            WHERE faces.embedding <=> new_faces.embedding <= %s
+            ORDER BY distance
+            LIMIT 1
+        ) AS best ON TRUE
+        ORDER BY new_faces.ordinality
+    """, options_params + ([_vector_literal(embedding) for embedding in embeddings], tenant_id,
+                           MATCHING_CLUSTER_CANDIDATES if MATCHING_QUANTIZATION == "none" else max(MATCHING_RERANK_CANDIDATES, MATCHING_CLUSTER_CANDIDATES),
+                           MATCHING_CLUSTER_CANDIDATES, tenant_id, similarity_threshold))
+    return [(face_id, cluster_id, distance) if face_id is not None else None for _, face_id, cluster_id, distance in cur.fetchall()]
+
+@timed_sql
+def sql_count_faces(cur: psycopg2.extensions.cursor, tenant_id: str) -> int:
+    """
+    Count the faces of a tenant.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+    
+    Returns:
+        int: The number of faces.
+    """
+    cur.execute("SELECT COUNT(*) FROM faces WHERE tenant_id = %s", (tenant_id,))
+    return cur.fetchone()[0]
+
+@timed_sql
+def sql_get_tenant_embeddings(cur: psycopg2.extensions.cursor, tenant_id: str) -> List[Tuple[str, str, str, List[float]]]:
+    """
+    Retrieve every face embedding of a tenant.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+    
+    Returns:
+        list: The face IDs, image IDs, cluster IDs and embedding vectors.
+    """
+    cur.execute("SELECT id, image_id, cluster_id, embedding::real[] FROM faces WHERE tenant_id = %s", (tenant_id,))
+    return cur.fetchall()
+
+@timed_sql
+def sql_count_clusters(cur: psycopg2.extensions.cursor, tenant_id: str) -> int:
+    """
+    Count the clusters of a tenant.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+    
+    Returns:
+        int: The number of clusters.
+    """
+    cur.execute("SELECT COUNT(*) FROM clusters WHERE tenant_id = %s", (tenant_id,))
+    return cur.fetchone()[0]
+
+def sql_iter_cluster_centroids(cur: psycopg2.extensions.cursor, tenant_id: str, chunk_size: int) -> Iterator[List[Tuple[str, List[float], int, bool]]]:
+    """
+    Read the clusters of a tenant in chunks. Use a named (server-side) cursor so that
+    only one chunk is held in memory at a time.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        chunk_size (int): The number of clusters per chunk.
+    
+    Yields:
+        list: The cluster IDs, embedding sums, face counts, and whether the cluster holds a manually assigned face.
+    """
+    cur.itersize = chunk_size
+    cur.execute("""
+        SELECT id, embedding_sum::real[], face_count,
+               EXISTS (SELECT 1 FROM faces WHERE faces.tenant_id = clusters.tenant_id AND faces.cluster_id = clusters.id AND NOT faces.is_auto_matched)
+        FROM clusters
+        WHERE tenant_id = %s
+        ORDER BY id
+    """, (tenant_id,))
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if len(rows) == 0:
+            return
+        yield rows
+
+@timed_sql
+def sql_merge_clusters(cur: psycopg2.extensions.cursor, tenant_id: str, merges: List[Tuple[str, str]]) -> int:
+    """
+    Move every face of some clusters into other clusters, and fold their running sums
+    and review pending records into the target clusters.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        merges (List[Tuple[str, str]]): The IDs of the clusters to merge and of the clusters they are merged into.
+    
+    Returns:
+        int: The number of faces moved.
+    """
+    source_ids = [source_id for source_id, _ in merges]
+    target_ids = [target_id for _, target_id in merges]
+    cur.execute("""
+        UPDATE faces SET cluster_id = merges.target_id
+        FROM unnest(%s::text[], %s::text[]) AS merges(source_id, target_id)
+        WHERE faces.tenant_id = %s AND faces.cluster_id = merges.source_id
+    """, (source_ids, target_ids, tenant_id))
+    moved = cur.rowcount
+    cur.execute("""
+        WITH merged AS (
+            DELETE FROM clusters
+            USING unnest(%s::text[], %s::text[]) AS merges(source_id, target_id)
+            WHERE clusters.tenant_id = %s AND clusters.id = merges.source_id
+            RETURNING merges.target_id, clusters.embedding_sum, clusters.face_count
+        ), per_target AS (
+            SELECT target_id, sum(embedding_sum) AS embedding_sum, sum(face_count) AS face_count
+            FROM merged
+            GROUP BY target_id
+        )
+        UPDATE clusters
+        SET embedding_sum = clusters.embedding_sum + per_target.embedding_sum, face_count = clusters.face_count + per_target.face_count
+        FROM per_target
+        WHERE clusters.tenant_id = %s AND clusters.id = per_target.target_id
+    """, (source_ids, target_ids, tenant_id, tenant_id))
+    # The radius of a merged cluster cannot be derived from its parts, measure it again
+    cur.execute("""
+        UPDATE clusters
+        SET radius = COALESCE((
+            SELECT max(faces.embedding <=> clusters.embedding_sum)
+            FROM faces
+            WHERE faces.tenant_id = clusters.tenant_id AND faces.cluster_id = clusters.id
+        ), 0)
+        WHERE tenant_id = %s AND id = ANY(%s)
+    """, (tenant_id, list(set(target_ids))))
+    cur.execute("DELETE FROM review_pending WHERE tenant_id = %s AND cluster_id = ANY(%s)", (tenant_id, source_ids))
+    EMBEDDING_CACHE.invalidate(tenant_id, cur)
+    return moved
+
+@timed_sql
+def sql_enqueue_job(cur: psycopg2.extensions.cursor, tenant_id: str, job_id: str, kind: str, payload: Dict[str, Any]) -> None:
+    """
+    Add a job to the queue and wake up an idle worker once the transaction commits.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        job_id (str): The job ID.
+        kind (str): The kind of job, which selects the handler that runs it.
+        payload (Dict[str, Any]): The arguments of the job.
+    """
+    cur.execute("INSERT INTO jobs (id, tenant_id, kind, payload) VALUES (%s, %s, %s, %s); NOTIFY jobs",
+                (job_id, tenant_id, kind, json.dumps(payload)))
+
+@timed_sql
+def sql_claim_job(cur: psycopg2.extensions.cursor, lease_seconds: float) -> Optional[Tuple[str, str, str, Dict[str, Any], int]]:
+    """
+    Take the oldest available job and lease it to the caller for `lease_seconds`.
+    
+    Workers skip rows locked by other workers instead of waiting on them, so any number
+    of workers can poll the queue concurrently. A running job whose lease has expired,
+    because its worker died, becomes available again.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        lease_seconds (float): How long the job is reserved for the caller.
+    
+    Returns:
+        Optional[tuple]: The job ID, tenant ID, kind, payload and number of attempts so far including this one, or None.
+    """
+    cur.execute("""
+        UPDATE jobs
+        SET status = 'running', attempts = attempts + 1, started_at = now(), available_at = now() + make_interval(secs => %s)
+        WHERE id = (
+            SELECT id
+            FROM jobs
+            WHERE status IN ('queued', 'running') AND available_at <= now()
+            ORDER BY available_at
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, tenant_id, kind, payload, attempts
+    """, (lease_seconds,))
+    return cur.fetchone()
+
+@timed_sql
+def sql_renew_job_lease(cur: psycopg2.extensions.cursor, job_id: str, lease_seconds: float) -> None:
+    """
+    Extend the lease of a running job, for jobs that commit their progress as they go
+    and may run for longer than one lease.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        job_id (str): The job ID.
+        lease_seconds (float): How long the job stays reserved from now.
+    """
+    cur.execute("UPDATE jobs SET available_at = now() + make_interval(secs => %s) WHERE id = %s AND status = 'running'", (lease_seconds, job_id))
+
+@timed_sql
+def sql_set_job_progress(cur: psycopg2.extensions.cursor, job_id: str, progress: Dict[str, Any]) -> None:
+    """
+    Record how far a running job has got, reported by GET /jobs/{job_id}.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        job_id (str): The job ID.
+        progress (Dict[str, Any]): The progress of the job.
+    """
+    cur.execute("UPDATE jobs SET progress = %s WHERE id = %s", (json.dumps(progress), job_id))
+
+@timed_sql
+def sql_finish_job(cur: psycopg2.extensions.cursor, job_id: str, result: Dict[str, Any]) -> None:
+    """
+    Mark a job as done and store its result.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        job_id (str): The job ID.
+        result (Dict[str, Any]): The result of the job.
+    """
+    cur.execute("UPDATE jobs SET status = 'done', result = %s, error = NULL, finished_at = now() WHERE id = %s", (json.dumps(result), job_id))
+
+@timed_sql
+def sql_fail_job(cur: psycopg2.extensions.cursor, job_id: str, error: str, retry_after_seconds: Optional[float]) -> None:
+    """
+    Record that a job attempt failed, and either queue it again or give up on it.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        job_id (str): The job ID.
+        error (str): The error message.
+        retry_after_seconds (Optional[float]): The delay before the job is retried, None to mark it as failed.
+    """
+    if retry_after_seconds is None:
+        cur.execute("UPDATE jobs SET status = 'failed', error = %s, finished_at = now() WHERE id = %s", (error, job_id))
+    else:
+        cur.execute("UPDATE jobs SET status = 'queued', error = %s, available_at = now() + make_interval(secs => %s) WHERE id = %s",
+                    (error, retry_after_seconds, job_id))
+
+@timed_sql
+def sql_get_job(cur: psycopg2.extensions.cursor, tenant_id: str, job_id: str) -> Tuple[str, str, str, Optional[Dict[str, Any]], Optional[str], int, Any, Any, Optional[Dict[str, Any]]]:
+    """
+    Retrieve a job of the tenant.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        job_id (str): The job ID.
+    
+    Returns:
+        tuple: The job ID, kind, status, result, error, number of attempts, creation time, finish time and progress.
+    """
+    cur.execute("SELECT id, kind, status, result, error, attempts, created_at, finished_at, progress FROM jobs WHERE tenant_id = %s AND id = %s", (tenant_id, job_id))
+    result = cur.fetchone()
+    if result is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return result
+
+@timed_sql
+def sql_find_active_job(cur: psycopg2.extensions.cursor, tenant_id: str, kind: str, payload: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """
+    Find a job of the tenant of the given kind that is queued or running.
+    
+    Other transactions looking for a job of the same tenant and kind wait until this
+    one ends, so a job it then enqueues is the only one they can find.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        kind (str): The kind of job.
+        payload (Optional[Dict[str, Any]]): Only find a job whose payload has these values.
+    
+    Returns:
+        Optional[str]: The job ID, or None.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s), hashtext(%s))", (kind, tenant_id))
+    cur.execute("""
+        SELECT id FROM jobs
+        WHERE tenant_id = %s AND kind = %s AND status IN ('queued', 'running') AND (%s::jsonb IS NULL OR payload @> %s::jsonb)
+        LIMIT 1
+    """, (tenant_id, kind, *(2 * [json.dumps(payload) if payload is not None else None])))
+    result = cur.fetchone()
+    return result[0] if result is not None else None
+
+@timed_sql
+def sql_count_jobs(cur: psycopg2.extensions.cursor) -> Dict[str, int]:
+    """
+    Count the jobs waiting in the queue or being run, across all tenants.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    
+    Returns:
+        dict: The number of queued and running jobs.
+    """
+    cur.execute("SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status")
+    return {"queued": 0, "running": 0, **dict(cur.fetchall())}
+
+@timed_sql
+def sql_get_face_model(cur: psycopg2.extensions.cursor) -> str:
+    """
+    Retrieve the face model whose embeddings faces.embedding holds.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    
+    Returns:
+        str: The DeepFace model name.
+    """
+    cur.execute("SELECT model_version FROM face_model")
+    return cur.fetchone()[0]
+
+@timed_sql
+def sql_lock_face_model(cur: psycopg2.extensions.cursor) -> None:
+    """
+    Wait for the transactions writing faces to finish and keep new ones out until the
+    transaction ends: those writing embeddings, see `sql_share_face_model`, and those
+    deleting or moving faces, which the lock on the tables holds back while reads go on.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (FACE_MODEL_LOCK,))
+    cur.execute("LOCK TABLE faces, clusters IN SHARE MODE")
+
+@timed_sql
+def sql_get_face_tenants(cur: psycopg2.extensions.cursor) -> List[str]:
+    """
+    List the tenants that have faces.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    
+    Returns:
+        list: The tenant IDs.
+    """
+    cur.execute("SELECT tenant_id FROM faces GROUP BY tenant_id ORDER BY tenant_id")
+    return [row[0] for row in cur.fetchall()]
+
+@timed_sql
+def sql_count_faces_to_reembed(cur: psycopg2.extensions.cursor, tenant_id: str, model_version: str) -> Tuple[int, int, int]:
+    """
+    Count the faces of a tenant, those already embedded with `model_version` and those without a crop.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        model_version (str): The face model being rolled out.
+    
+    Returns:
+        tuple: The number of faces, of faces embedded with the model, and of faces without a crop.
+    """
+    cur.execute("""
+        SELECT COUNT(*), COUNT(next.face_id), COUNT(*) FILTER (WHERE next.face_id IS NULL AND faces.crop_offset IS NULL)
+        FROM faces
+        LEFT JOIN face_embeddings_next AS next ON next.model_version = %s AND next.tenant_id = faces.tenant_id AND next.face_id = faces.id
+        WHERE faces.tenant_id = %s
+    """, (model_version, tenant_id))
+    return cur.fetchone()
+
+@timed_sql
+def sql_get_faces_to_reembed(cur: psycopg2.extensions.cursor, tenant_id: str, model_version: str, after_face_id: str, limit: int) -> List[Tuple[str, int, int]]:
+    """
+    Retrieve a page of the faces of a tenant that have a crop but no embedding of `model_version` yet.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        model_version (str): The face model being rolled out.
+        after_face_id (str): The last face ID of the previous page, "" for the first page.
+        limit (int): The maximum number of faces to return.
+    
+    Returns:
+        list: The face IDs and the offsets and lengths of their crops, in face ID order.
+    """
+    cur.execute("""
+        SELECT faces.id, faces.crop_offset, faces.crop_length
+        FROM faces
+        WHERE faces.tenant_id = %s AND faces.id > %s AND faces.crop_offset IS NOT NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM face_embeddings_next AS next
+              WHERE next.model_version = %s AND next.tenant_id = faces.tenant_id AND next.face_id = faces.id
+          )
+        ORDER BY faces.id
+        LIMIT %s
+    """, (tenant_id, after_face_id, model_version, limit))
+    return cur.fetchall()
+
+@timed_sql
+def sql_stage_embeddings(cur: psycopg2.extensions.cursor, tenant_id: str, model_version: str, embeddings: List[Tuple[str, List[float]]]) -> None:
+    """
+    Store embeddings of a face model that is being rolled out, next to the current ones.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        model_version (str): The face model being rolled out.
+        embeddings (List[Tuple[str, List[float]]]): The face IDs and their embedding vectors.
+    """
+    execute_values(cur, """
+        INSERT INTO face_embeddings_next (model_version, tenant_id, face_id, embedding) VALUES %s
+        ON CONFLICT (model_version, tenant_id, face_id) DO UPDATE SET embedding = EXCLUDED.embedding
+    """, [(model_version, tenant_id, face_id, embedding) for face_id, embedding in embeddings], template="(%s, %s, %s, %s::vector)", page_size=1000)
+
+@timed_sql
+def sql_prepare_face_model_switch(cur: psycopg2.extensions.cursor, dimension: int) -> None:
+    """
+    Add the columns that the embeddings of the face model being switched to are written
+    into, typed with its dimension: faces.embedding_next, clusters.embedding_sum_next
+    and clusters.radius_next. Those left by an earlier attempt are dropped first. From
+    then on, the faces inserted, deleted or moved are logged into face_model_switch_log.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        dimension (int): The dimension of the new model's embeddings.
+    """
+    # Adding a column without a volatile default does not rewrite the table
+    cur.execute("""
+        ALTER TABLE faces DROP COLUMN IF EXISTS embedding_next, ADD COLUMN embedding_next vector(%s);
+        ALTER TABLE clusters DROP COLUMN IF EXISTS embedding_sum_next, DROP COLUMN IF EXISTS radius_next,
+            ADD COLUMN embedding_sum_next vector(%s), ADD COLUMN radius_next REAL NOT NULL DEFAULT 0;
+        TRUNCATE face_model_switch_log;
+        DROP TRIGGER IF EXISTS face_model_switch_log ON faces;
+        CREATE TRIGGER face_model_switch_log AFTER INSERT OR DELETE OR UPDATE OF cluster_id ON faces
+            FOR EACH ROW EXECUTE FUNCTION log_face_model_switch();
+    """, (dimension, dimension))
+
+@timed_sql
+def sql_face_model_switch_in_progress(cur: psycopg2.extensions.cursor) -> bool:
+    """
+    Check whether src/reembedding.py is switching to another face model, between
+    `sql_prepare_face_model_switch` and `sql_swap_embedding_columns`.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    
+    Returns:
+        bool: True if faces.embedding_next exists.
+    """
+    cur.execute("SELECT 1 FROM pg_attribute WHERE attrelid = 'faces'::regclass AND attname = 'embedding_next' AND NOT attisdropped")
+    return cur.fetchone() is not None
+
+@timed_sql
+def sql_abort_face_model_switch(cur: psycopg2.extensions.cursor) -> None:
+    """
+    Undo `sql_prepare_face_model_switch` after a failed switch. The staged embeddings are
+    kept for the next attempt.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    """
+    cur.execute("""
+        DROP TRIGGER IF EXISTS face_model_switch_log ON faces;
+        ALTER TABLE faces DROP COLUMN IF EXISTS embedding_next;
+        ALTER TABLE clusters DROP COLUMN IF EXISTS embedding_sum_next, DROP COLUMN IF EXISTS radius_next;
+        TRUNCATE face_model_switch_log;
+    """)
+
+@timed_sql
+def sql_fill_next_embeddings(cur: psycopg2.extensions.cursor, tenant_id: str, model_version: str) -> int:
+    """
+    Copy the embeddings of a tenant staged for `model_version` into faces.embedding_next.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        model_version (str): The face model being switched to.
+    
+    Returns:
+        int: The number of faces updated.
+    """
+    cur.execute("""
+        UPDATE faces SET embedding_next = next.embedding
+        FROM face_embeddings_next AS next
+        WHERE faces.tenant_id = %s AND next.model_version = %s AND next.tenant_id = faces.tenant_id AND next.face_id = faces.id
+    """, (tenant_id, model_version))
+    return cur.rowcount
+
+@timed_sql
+def sql_compute_next_clusters(cur: psycopg2.extensions.cursor, tenant_id: str, cluster_ids: Optional[List[str]] = None) -> None:
+    """
+    Compute clusters.embedding_sum_next and clusters.radius_next from faces.embedding_next,
+    the way `sql_rebuild_clusters` computes the current ones.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        cluster_ids (Optional[List[str]]): The clusters to compute, by default all those of the tenant.
+    """
+    cur.execute("""
+        UPDATE clusters
+        SET embedding_sum_next = members.embedding_sum
+        FROM (
+            SELECT cluster_id, sum(l2_normalize(embedding_next)) AS embedding_sum
+            FROM faces
+            WHERE tenant_id = %s AND (%s::text[] IS NULL OR cluster_id = ANY(%s))
+            GROUP BY cluster_id
+        ) AS members
+        WHERE clusters.tenant_id = %s AND clusters.id = members.cluster_id
+    """, (tenant_id, cluster_ids, cluster_ids, tenant_id))
+    cur.execute("""
+        UPDATE clusters
+        SET radius_next = COALESCE(members.radius, 0)
+        FROM (
+            SELECT faces.cluster_id, max(faces.embedding_next <=> clusters.embedding_sum_next) AS radius
+            FROM faces
+            JOIN clusters ON clusters.tenant_id = faces.tenant_id AND clusters.id = faces.cluster_id
+            WHERE faces.tenant_id = %s AND (%s::text[] IS NULL OR faces.cluster_id = ANY(%s))
+            GROUP BY faces.cluster_id
+        ) AS members
+        WHERE clusters.tenant_id = %s AND clusters.id = members.cluster_id
+    """, (tenant_id, cluster_ids, cluster_ids, tenant_id))
+
+@timed_sql
+def sql_take_face_model_switch_log(cur: psycopg2.extensions.cursor) -> List[Tuple[str, Optional[str], str]]:
+    """
+    Remove and return the faces logged since the last call, see `sql_prepare_face_model_switch`.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    
+    Returns:
+        list: The tenant IDs, the face IDs, None for a face that left its cluster, and the cluster IDs.
+    """
+    cur.execute("DELETE FROM face_model_switch_log RETURNING tenant_id, face_id, cluster_id")
+    return cur.fetchall()
+
+@timed_sql
+def sql_get_faces_without_next_embedding(cur: psycopg2.extensions.cursor, tenant_id: str, face_ids: List[str]) -> List[Tuple[str, Optional[int], Optional[int]]]:
+    """
+    Retrieve those of some faces of a tenant that have no faces.embedding_next yet.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        face_ids (List[str]): The face IDs.
+    
+    Returns:
+        list: The face IDs and the offsets and lengths of their crops, None if they were not kept.
+    """
+    cur.execute("""
+        SELECT id, crop_offset, crop_length
+        FROM faces
+        WHERE tenant_id = %s AND id = ANY(%s) AND embedding_next IS NULL
+        ORDER BY id
+    """, (tenant_id, face_ids))
+    return cur.fetchall()
+
+@timed_sql
+def sql_set_next_embeddings(cur: psycopg2.extensions.cursor, tenant_id: str, embeddings: List[Tuple[str, List[float]]]) -> None:
+    """
+    Write embeddings of the face model being switched to into faces.embedding_next.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        embeddings (List[Tuple[str, List[float]]]): The face IDs and their embedding vectors.
+    """
+    execute_values(cur, """
+        UPDATE faces SET embedding_next = data.embedding
+        FROM (VALUES %s) AS data (tenant_id, id, embedding)
+        WHERE faces.tenant_id = data.tenant_id AND faces.id = data.id
+    """, [(tenant_id, face_id, embedding) for face_id, embedding in embeddings], template="(%s, %s, %s::vector)", page_size=1000)
+
+@timed_sql
+def sql_get_vector_indexes(cur: psycopg2.extensions.cursor, table: str, column: str) -> List[Tuple[str, str]]:
+    """
+    List the vector indexes of a column: those of postgres/schema.sql and of
+    postgres/migrations/007_quantized_indexes.sql, or whichever were built instead.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        table (str): The table name.
+        column (str): The vector column.
+    
+    Returns:
+        list: The index names and their definitions from USING on,
+            e.g. "USING hnsw (embedding vector_cosine_ops) WITH (m='16', ef_construction='64')".
+    """
+    cur.execute("""
+        SELECT index.relname, pg_get_indexdef(index.oid)
+        FROM pg_index
+        JOIN pg_class AS index ON index.oid = pg_index.indexrelid
+        JOIN pg_am ON pg_am.oid = index.relam
+        WHERE pg_index.indrelid = %s::regclass AND pg_am.amname IN ('hnsw', 'ivfflat')
+        ORDER BY index.relname
+    """, (table,))
+    return [(name, definition[definition.index(" USING ") + 1:]) for name, definition in cur.fetchall()
+            if re.search(rf"\b{column}\b", definition) is not None]
+
+@timed_sql
+def sql_create_next_embedding_indexes(cur: psycopg2.extensions.cursor, dimension: int) -> None:
+    """
+    Build on each <column>_next column of `EMBEDDING_COLUMNS` the vector indexes that
+    its column has, named <index>_next, with the quantized ones cast to `dimension`.
+    
+    They are built concurrently on each partition, which does not block writes, then
+    created on the table, which only attaches them. The cursor must be in autocommit mode.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        dimension (int): The dimension of the new model's embeddings.
+    """
+    for table, column in EMBEDDING_COLUMNS:
+        cur.execute("""
+            SELECT pg_class.relname
+            FROM pg_partition_tree(%s::regclass) AS tree
+            JOIN pg_class ON pg_class.oid = tree.relid
+            WHERE tree.isleaf
+        """, (table,))
+        partitions = [row[0] for row in cur.fetchall()]
+        for name, using in sql_get_vector_indexes(cur, table, column):
+            using = re.sub(rf"\b{column}\b", f"{column}_next", using)
+            using = re.sub(r"\b(halfvec|bit)\(\d+\)", rf"\g<1>({dimension})", using)
+            for partition in partitions:
+                cur.execute(sql.SQL("CREATE INDEX CONCURRENTLY ON {} ").format(sql.Identifier(partition)) + sql.SQL(using))
+            cur.execute(sql.SQL("CREATE INDEX {} ON {} ").format(sql.Identifier(f"{name}_next"), sql.Identifier(table)) + sql.SQL(using))
+
+@timed_sql
+def sql_swap_embedding_columns(cur: psycopg2.extensions.cursor) -> None:
+    """
+    Replace the columns of `EMBEDDING_COLUMNS` and clusters.radius with their filled
+    <column>_next counterparts, give their indexes the names of the replaced ones and
+    stop logging faces. Only catalogs are changed, so the switch holds its locks briefly.
+    
+    The new columns are only checked to be NOT NULL for the rows written from then on,
+    `sql_validate_embedding_columns` checks the others once the switch has committed.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    """
+    cur.execute("DROP TRIGGER face_model_switch_log ON faces")
+    for table, column in EMBEDDING_COLUMNS + (("clusters", "radius"),):
+        indexes = sql_get_vector_indexes(cur, table, f"{column}_next")
+        # Dropping a column is a catalog change, and drops its indexes
+        cur.execute(sql.SQL("ALTER TABLE {} DROP COLUMN {}").format(sql.Identifier(table), sql.Identifier(column)))
+        cur.execute(sql.SQL("ALTER TABLE {} RENAME COLUMN {} TO {}").format(sql.Identifier(table), sql.Identifier(f"{column}_next"), sql.Identifier(column)))
+        for name, _ in indexes:
+            cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(sql.Identifier(name), sql.Identifier(name[:-len("_next")])))
+    for table, column in EMBEDDING_COLUMNS:
+        cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK ({} IS NOT NULL) NOT VALID").format(
+            sql.Identifier(table), sql.Identifier(f"{table}_{column}_not_null_check"), sql.Identifier(column)))
+    EMBEDDING_CACHE.clear(cur)
+
+@timed_sql
+def sql_validate_embedding_columns(cur: psycopg2.extensions.cursor) -> None:
+    """
+    Make the columns swapped in by `sql_swap_embedding_columns` NOT NULL. Validating the
+    check constraints scans the tables without blocking writes, and lets SET NOT NULL
+    skip its own scan.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+    """
+    for table, column in EMBEDDING_COLUMNS:
+        constraint = sql.Identifier(f"{table}_{column}_not_null_check")
+        cur.execute(sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(sql.Identifier(table), constraint))
+        cur.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN {} SET NOT NULL").format(sql.Identifier(table), sql.Identifier(column)))
+        cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(sql.Identifier(table), constraint))
+
+@timed_sql
+def sql_set_face_model(cur: psycopg2.extensions.cursor, model_version: str) -> None:
+    """
+    Record the face model whose embeddings faces.embedding now holds, and drop its staged embeddings.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        model_version (str): The DeepFace model name.
+    """
+    cur.execute("UPDATE face_model SET model_version = %s, switched_at = now()", (model_version,))
+    cur.execute("DELETE FROM face_embeddings_next WHERE model_version = %s", (model_version,))
+
+@timed_sql
+def sql_get_images_without_crops(cur: psycopg2.extensions.cursor, tenant_id: str, after_image_id: str, limit: int) -> List[Tuple[str, List[str], List[Dict[str, int]]]]:
+    """
+    Retrieve a page of the images of a tenant that have faces without a crop.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        after_image_id (str): The last image ID of the previous page, "" for the first page.
+        limit (int): The maximum number of images to return.
+    
+    Returns:
+        list: The image IDs, in order, with the IDs and facial areas of their faces without a crop.
+    """
+    cur.execute("""
+        SELECT image_id, array_agg(id), array_agg(facial_area)
+        FROM faces
+        WHERE tenant_id = %s AND image_id > %s AND crop_offset IS NULL
+        GROUP BY image_id
+        ORDER BY image_id
+        LIMIT %s
+    """, (tenant_id, after_image_id, limit))
+    return cur.fetchall()
+
+@timed_sql
+def sql_set_face_crops(cur: psycopg2.extensions.cursor, tenant_id: str, crops: List[Tuple[str, int, int]]) -> None:
+    """
+    Record where the crops of several faces are in the tenant's pack file.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): Database cursor object.
+        tenant_id (str): The tenant ID.
+        crops (List[Tuple[str, int, int]]): The face IDs and the offsets and lengths of their crops.
+    """
+    execute_values(cur, """
+        UPDATE faces SET crop_offset = data.crop_offset, crop_length = data.crop_length
+        FROM (VALUES %s) AS data (tenant_id, id, crop_offset, crop_length)
+        WHERE faces.tenant_id = data.tenant_id AND faces.id = data.id
+    """, [(tenant_id, face_id, offset, length) for face_id, offset, length in crops], template="(%s, %s, %s::bigint, %s::integer)", page_size=1000)
@@ -0,0 +1,309 @@
+"""
+Export and import of a tenant's images and faces, to move a tenant between databases
+or keep an offline copy of it.
+
+An export is a directory of five files:
+
+    manifest.json           format version, tenant ID, face model, and row count and embedding dimension of each table
+    images.pgcopy           id, phash and content_sha256 of every image, in COPY BINARY format
+    images_embeddings.npy   the image embeddings, float32 of shape (images, dimension), in the order of images.pgcopy, NaN where NULL
+    faces.pgcopy            id, image_id, cluster_id, facial_area and is_auto_matched of every face
+    faces_embeddings.npy    the face embeddings, float32 of shape (faces, dimension), in the order of faces.pgcopy
+
+The dimensions are those of the embedding columns of the exporting database, and an
+import checks them against those of the importing one. images.embedding has no fixed
+dimension, its arrays take that of the tenant's image embeddings.
+
+Rows are streamed with `COPY ... (FORMAT BINARY)` in both directions, so memory use
+does not grow with the tenant: the export writes each row as it arrives, into the
+.pgcopy file and a memory-mapped .npy file, and the import reads the .npy files
+memory-mapped. The embeddings can be loaded with `numpy.load` without Postgres.
+
+Clusters are rebuilt from the faces on import. The review queue and the face crops
+are not exported, so imported faces cannot be re-embedded with another model, and an
+export only imports into a database that uses the same face model.
+
+    python -m src.transfer export --tenant-id my_tenant --path exports/my_tenant
+    python -m src.transfer import --path exports/my_tenant --tenant-id my_tenant --dedicated
+
+An import into dedicated partitions loads standalone tables that have no indexes
+yet and attaches them, which builds the indexes once over all the rows instead of
+inserting into the vector indexes row by row. Use it for large tenants, with the
+same caveat as `python -m src.partitioning promote`.
+"""
+import argparse
+import datetime
+import json
+import os
+import tarfile
+import time
+from typing import Any, BinaryIO, Dict, Iterator, Optional
+import numpy as np
+import psycopg2
+from psycopg2 import sql
+from src.partitioning import analyze_tenant_tables, attach_tenant_tables, create_tenant_tables
+from src.pgcopy import HEADER, TRAILER, CopyBinaryReader, CopyBinaryStream, decode_vector, encode_row, encode_text, encode_vector, read_rows
+from src.sql import PARTITIONED_TABLES, sql_face_model_switch_in_progress, sql_get_embedding_dimension, sql_get_face_model, sql_rebuild_clusters, sql_share_face_model
+from src.utils import get_db_connection
+
+FORMAT_VERSION = 1
+# Exports made before the dimension was recorded per table
+LEGACY_DIMENSION = 128
+MANIFEST_NAME = "manifest.json"
+# The exported columns of each table besides tenant_id and embedding, id first
+EXPORTED_COLUMNS = {
+    "images": ("id", "phash", "content_sha256"),
+    "faces": ("id", "image_id", "cluster_id", "facial_area", "is_auto_matched"),
+}
+EXPORT_FILES = {MANIFEST_NAME} | {name for table in EXPORTED_COLUMNS for name in (f"{table}.pgcopy", f"{table}_embeddings.npy")}
+COPY_BUFFER_SIZE = 1 << 20
+
+class _ExportSink:
+    """
+    File-like target of a `COPY ... TO STDOUT (FORMAT BINARY)` whose last column is
+    the embedding. Each row is split as it arrives: the embedding goes into the
+    memory-mapped array and the other columns into the .pgcopy file.
+    """
+
+    def __init__(self, file: BinaryIO, embeddings: np.ndarray) -> None:
+        self._reader = CopyBinaryReader()
+        self._file = file
+        self._embeddings = embeddings
+        self.rows = 0
+        file.write(HEADER)
+
+    def write(self, data: bytes) -> None:
+        for row in self._reader.feed(data):
+            if self.rows >= len(self._embeddings):
+                raise ValueError("The table has more rows than were counted")
+            # Whole-image embeddings are NULL until they are computed
+            self._embeddings[self.rows] = decode_vector(row[-1]) if row[-1] is not None else np.nan
+            self._file.write(encode_row(row[:-1]))
+            self.rows += 1
+
+    def close(self) -> None:
+        self._file.write(TRAILER)
+
+def _column_list(columns: tuple) -> sql.Composed:
+    return sql.SQL(", ").join(sql.Identifier(column) for column in columns)
+
+def export_tenant(conn: psycopg2.extensions.connection, tenant_id: str, path: str) -> Dict[str, Any]:
+    """
+    Write the images and faces of a tenant to a directory, from a single snapshot.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object.
+        tenant_id (str): The tenant ID.
+        path (str): The directory to write to, created if needed.
+
+    Returns:
+        dict: The manifest of the export.
+    """
+    os.makedirs(path, exist_ok=True)
+    tables = {}
+    conn.rollback()
+    try:
+        with conn.cursor() as cur:
+            # The counts size the .npy files, so they must see the same rows as the copies
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            model_version = sql_get_face_model(cur)
+            for table, columns in EXPORTED_COLUMNS.items():
+                cur.execute(sql.SQL("SELECT count(*) FROM {} WHERE tenant_id = %s").format(sql.Identifier(table)), (tenant_id,))
+                count = cur.fetchone()[0]
+                # 0 for a tenant without any whole-image embedding, every row is then NULL
+                dimension = sql_get_embedding_dimension(cur, table, tenant_id=tenant_id) or 0
+                embeddings = np.lib.format.open_memmap(os.path.join(path, f"{table}_embeddings.npy"), mode="w+",
+                                                       dtype=np.float32, shape=(count, dimension))
+                with open(os.path.join(path, f"{table}.pgcopy"), "wb") as file:
+                    sink = _ExportSink(file, embeddings)
+                    cur.copy_expert(sql.SQL("COPY (SELECT {}, embedding FROM {} WHERE tenant_id = {}) TO STDOUT (FORMAT BINARY)").format(
+                        _column_list(columns), sql.Identifier(table), sql.Literal(tenant_id)), sink, COPY_BUFFER_SIZE)
+                    sink.close()
+                embeddings.flush()
+                tables[table] = {"rows": sink.rows, "columns": list(columns), "dimension": dimension}
+    finally:
+        conn.rollback()
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "tenant_id": tenant_id,
+        "exported_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "model_version": model_version,
+        "tables": tables,
+    }
+    # Written last, an export without a manifest is incomplete
+    with open(os.path.join(path, MANIFEST_NAME), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+def read_manifest(path: str) -> Dict[str, Any]:
+    """
+    Read and check the manifest of an export.
+
+    Args:
+        path (str): The directory of the export.
+
+    Returns:
+        dict: The manifest.
+    """
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        raise ValueError(f"{path} has no {MANIFEST_NAME}, the export is incomplete")
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported export format version {manifest.get('format_version')}")
+    for table, columns in EXPORTED_COLUMNS.items():
+        if manifest["tables"][table]["columns"] != list(columns):
+            raise ValueError(f"Unexpected columns for {table} in the manifest")
+        manifest["tables"][table].setdefault("dimension", manifest.get("dimension", LEGACY_DIMENSION))
+    return manifest
+
+def _copy_in(cur: psycopg2.extensions.cursor, path: str, table: str, rows: int, dimension: int, target: str, tenant_id: str) -> None:
+    """
+    Load one table of an export into `target` under `tenant_id`.
+    """
+    expected = sql_get_embedding_dimension(cur, table)
+    if expected is not None and dimension != expected:
+        raise ValueError(f"The export has {dimension}-dimensional {table} embeddings, expected {expected}")
+    if rows == 0:
+        return
+    embeddings = np.load(os.path.join(path, f"{table}_embeddings.npy"), mmap_mode="r")
+    if embeddings.shape != (rows, dimension):
+        raise ValueError(f"{table}_embeddings.npy has shape {embeddings.shape}, expected ({rows}, {dimension})")
+    tenant = encode_text(tenant_id)
+    columns = EXPORTED_COLUMNS[table]
+    with open(os.path.join(path, f"{table}.pgcopy"), "rb") as file:
+        stream = CopyBinaryStream(
+            [row[0], tenant, *row[1:], encode_vector(embedding) if len(embedding) > 0 and not np.isnan(embedding[0]) else None]
+            for row, embedding in zip(read_rows(file, COPY_BUFFER_SIZE), embeddings)
+        )
+        cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN (FORMAT BINARY)").format(
+            sql.Identifier(target), _column_list((columns[0], "tenant_id", *columns[1:], "embedding"))), stream, COPY_BUFFER_SIZE)
+    if stream.rows != rows:
+        raise ValueError(f"{table}.pgcopy has {stream.rows} rows, expected {rows}")
+
+def import_tenant(conn: psycopg2.extensions.connection, path: str, tenant_id: Optional[str] = None, dedicated: bool = False) -> Dict[str, Any]:
+    """
+    Load an export into a tenant that has no data, and rebuild its clusters.
+
+    Everything happens in the current transaction, so a failed import leaves nothing
+    behind. The statistics of dedicated partitions are collected after the commit
+    by `analyze_tenant_tables`.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, left uncommitted.
+        path (str): The directory of the export.
+        tenant_id (Optional[str]): The tenant to import into, by default the exported one.
+        dedicated (bool): Load into new dedicated partitions, unless the tenant already has some.
+
+    Returns:
+        dict: The tenant ID, the number of images and faces imported, and the suffix of the dedicated partitions created, if any.
+    """
+    manifest = read_manifest(path)
+    tenant_id = tenant_id if tenant_id is not None else manifest["tenant_id"]
+    suffix = None
+    with conn.cursor() as cur:
+        cur.execute(" UNION ALL ".join(f"(SELECT 1 FROM {table} WHERE tenant_id = %s LIMIT 1)" for table in PARTITIONED_TABLES), (tenant_id,) * len(PARTITIONED_TABLES))
+        if cur.fetchone() is not None:
+            raise ValueError(f"Tenant {tenant_id} already has data, delete it before importing")
+        # The faces of the export have no crops to re-embed them with another model
+        model_version = sql_share_face_model(cur)
+        if sql_face_model_switch_in_progress(cur):
+            raise ValueError("The faces are being switched to another face model, import once src.reembedding has finished")
+        # Exports made before the face model was recorded are Facenet
+        if manifest.get("model_version", "Facenet") != model_version:
+            raise ValueError(f"The export has {manifest.get('model_version', 'Facenet')} embeddings, the faces are embedded with {model_version}")
+        if dedicated:
+            suffix = create_tenant_tables(cur, tenant_id)
+        for table in EXPORTED_COLUMNS:
+            target = f"{table}_{suffix}" if suffix is not None else table
+            _copy_in(cur, path, table, manifest["tables"][table]["rows"], manifest["tables"][table]["dimension"], target, tenant_id)
+        if suffix is not None:
+            attach_tenant_tables(cur, tenant_id, suffix)
+        sql_rebuild_clusters(cur, tenant_id)
+    return {
+        "tenant_id": tenant_id,
+        "images": manifest["tables"]["images"]["rows"],
+        "faces": manifest["tables"]["faces"]["rows"],
+        "partition_suffix": suffix,
+    }
+
+def iter_tar(path: str) -> Iterator[bytes]:
+    """
+    Stream the files of an export as an uncompressed tar archive, one chunk at a
+    time. Embeddings barely compress, so the archive is not compressed.
+
+    Args:
+        path (str): The directory of the export.
+
+    Returns:
+        Iterator[bytes]: The chunks of the archive.
+    """
+    for name in sorted(os.listdir(path)):
+        if name not in EXPORT_FILES:
+            continue
+        info = tarfile.TarInfo(name)
+        info.size = os.path.getsize(os.path.join(path, name))
+        info.mtime = int(time.time())
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        with open(os.path.join(path, name), "rb") as file:
+            while chunk := file.read(COPY_BUFFER_SIZE):
+                yield chunk
+        yield b"\0" * (-info.size % tarfile.BLOCKSIZE)
+    yield b"\0" * (2 * tarfile.BLOCKSIZE)
+
+def extract_tar(file: BinaryIO, path: str) -> None:
+    """
+    Extract an export archive made by `iter_tar`, compressed or not, as a stream.
+    Only the files of an export are extracted, anything else is ignored.
+
+    Args:
+        file (BinaryIO): The archive.
+        path (str): The directory to extract to, created if needed.
+    """
+    os.makedirs(path, exist_ok=True)
+    with tarfile.open(fileobj=file, mode="r|*") as archive:
+        for member in archive:
+            # Archives made with tar from inside the directory name their files ./manifest.json
+            name = os.path.basename(member.name)
+            if not member.isfile() or name not in EXPORT_FILES:
+                continue
+            with archive.extractfile(member) as source, open(os.path.join(path, name), "wb") as target:
+                while chunk := source.read(COPY_BUFFER_SIZE):
+                    target.write(chunk)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="Write a tenant to a directory")
+    export_parser.add_argument("--tenant-id", required=True, help="Tenant to export")
+    export_parser.add_argument("--path", required=True, help="Directory to write the export to")
+    import_parser = commands.add_parser("import", help="Load an export into a tenant without data")
+    import_parser.add_argument("--path", required=True, help="Directory of the export")
+    import_parser.add_argument("--tenant-id", help="Tenant to import into, by default the exported one")
+    import_parser.add_argument("--dedicated", action="store_true", help="Load into dedicated partitions, see src/partitioning.py")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    conn = get_db_connection()
+    try:
+        if args.command == "export":
+            manifest = export_tenant(conn, args.tenant_id, args.path)
+            print(f"Exported {manifest['tables']['images']['rows']} images and {manifest['tables']['faces']['rows']} faces to {args.path}")
+        else:
+            try:
+                result = import_tenant(conn, args.path, args.tenant_id, args.dedicated)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if result["partition_suffix"] is not None:
+                analyze_tenant_tables(conn, result["partition_suffix"])
+            print(f"Imported {result['images']} images and {result['faces']} faces into tenant {result['tenant_id']}")
+    finally:
+        conn.close()
+    print(f"Done in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,21 @@
 from fastapi import HTTPException
+import base64
+import json
 import toml
+import threading
+import time
 from contextlib import contextmanager
 import psycopg2
-from typing import Generator
+from psycopg2.pool import ThreadedConnectionPool
+from typing import Callable, Dict, Generator, List, Optional, Tuple, Union
 
 # Load configuration from config.toml
 config = toml.load("config.toml")
-DB_CONFIG = config["database"]
+DB_CONFIG = dict(config["database"])
+POOL_MIN_SIZE = DB_CONFIG.pop("pool_min_size", 1)
+POOL_MAX_SIZE = DB_CONFIG.pop("pool_max_size", 10)
+POOL_ACQUIRE_TIMEOUT = DB_CONFIG.pop("pool_acquire_timeout", 5.0)
+POOL_HEALTH_CHECK_AFTER = DB_CONFIG.pop("pool_health_check_after", 30.0)
 AUTH_TOKEN = config["auth"]["token"]
 
 def get_db_connection() -> psycopg2.extensions.connection:
@@ -16,7 +25,167 @@ def get_db_connection() -> psycopg2.extensions.connection:
     Returns:
         psycopg2.extensions.connection: Database connection object.
     """
-    return psycopg2.connect(**DB_CONFIG)
+    return psycopg2.connect(connection_factory=TransactionConnection, **DB_CONFIG)
+
+class TransactionConnection(psycopg2.extensions.connection):
+    """
+    Connection of `get_db_connection` and of the pool. Code that keeps in-process state
+    derived from its writes registers callbacks in `on_commit`: they run once the
+    current transaction has committed and are dropped if it rolls back, so other
+    threads never see uncommitted writes through that state.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.on_commit: List[Callable[[], None]] = []
+
+    def commit(self) -> None:
+        super().commit()
+        callbacks, self.on_commit = self.on_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self) -> None:
+        super().rollback()
+        self.on_commit.clear()
+
+class ConnectionPool:
+    """
+    A bounded pool of database connections shared by all requests of the process.
+    
+    Callers wait up to `acquire_timeout` seconds for a free connection. Connections
+    that have been idle for longer than `health_check_after` seconds are probed with
+    `SELECT 1` before being handed out, and broken connections are replaced.
+    """
+
+    def __init__(self, min_size: int, max_size: int, acquire_timeout: float, health_check_after: float) -> None:
+        self._pool = ThreadedConnectionPool(min_size, max_size, connection_factory=TransactionConnection, **DB_CONFIG)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._last_used: Dict[int, float] = {}
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_after = health_check_after
+        self.stats = {
+            "acquired": 0,
+            "in_use": 0,
+            "timeouts": 0,
+            "discarded": 0,
+            "acquire_seconds_total": 0.0,
+            "acquire_seconds_max": 0.0,
+        }
+
+    def acquire(self) -> psycopg2.extensions.connection:
+        """
+        Take a healthy connection from the pool.
+        
+        Returns:
+            psycopg2.extensions.connection: Database connection object.
+        
+        Raises:
+            HTTPException: If no connection becomes available within the acquire timeout.
+        """
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise HTTPException(status_code=503, detail="Timed out waiting for a database connection")
+        try:
+            # After a database restart every idle connection may be broken: they are
+            # discarded one by one until a healthy one, or a new one, comes out
+            for _ in range(self.max_size + 1):
+                conn = self._pool.getconn()
+                if self._is_healthy(conn):
+                    break
+                self._discard(conn)
+            else:
+                raise HTTPException(status_code=503, detail="No healthy database connection")
+        except Exception:
+            self._slots.release()
+            raise
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.stats["acquired"] += 1
+            self.stats["in_use"] += 1
+            self.stats["acquire_seconds_total"] += waited
+            self.stats["acquire_seconds_max"] = max(self.stats["acquire_seconds_max"], waited)
+        return conn
+
+    def release(self, conn: psycopg2.extensions.connection) -> None:
+        """
+        Return a connection to the pool, closing it if it is broken.
+        
+        Args:
+            conn (psycopg2.extensions.connection): The connection to return.
+        """
+        try:
+            if conn.closed:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            with self._lock:
+                self.stats["in_use"] -= 1
+            self._slots.release()
+
+    def close(self) -> None:
+        """
+        Close every connection held by the pool.
+        """
+        self._pool.closeall()
+
+    def _is_healthy(self, conn: psycopg2.extensions.connection) -> bool:
+        """
+        Check that a connection is usable, probing it if it has been idle for a while.
+        """
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0.0) < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn: psycopg2.extensions.connection) -> None:
+        """
+        Remove a connection from the pool for good.
+        """
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+        with self._lock:
+            self.stats["discarded"] += 1
+
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool() -> ConnectionPool:
+    """
+    Get the process-wide connection pool, creating it from the `[database]` section of
+    config.toml on first use.
+    
+    Returns:
+        ConnectionPool: The connection pool.
+    """
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = ConnectionPool(POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_ACQUIRE_TIMEOUT, POOL_HEALTH_CHECK_AFTER)
+        return _db_pool
+
+def close_db_pool() -> None:
+    """
+    Close the process-wide connection pool if it has been created.
+    """
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.close()
+            _db_pool = None
 
 def verify_token(token: str) -> None:
     """
@@ -31,6 +200,42 @@ def verify_token(token: str) -> None:
     if token != AUTH_TOKEN:
         raise HTTPException(status_code=403, detail="Invalid authentication token")
 
+def encode_cursor(key: List[Union[str, int]]) -> str:
+    """
+    Encode the sort key of the last row of a page as an opaque pagination cursor.
+    
+    Args:
+        key (List[Union[str, int]]): The sort key values of the last row.
+    
+    Returns:
+        str: The cursor, safe to use in a URL.
+    """
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: Optional[str], key_types: Tuple[type, ...]) -> Optional[List[Union[str, int]]]:
+    """
+    Decode a pagination cursor produced by `encode_cursor`.
+    
+    Args:
+        cursor (Optional[str]): The cursor sent by the client, None for the first page.
+        key_types (Tuple[type, ...]): The expected type of each sort key value.
+    
+    Returns:
+        Optional[list]: The sort key values, or None for the first page.
+    
+    Raises:
+        HTTPException: If the cursor is malformed.
+    """
+    if cursor is None or cursor == "":
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(key, list) or len(key) != len(key_types) or not all(isinstance(value, key_type) for value, key_type in zip(key, key_types)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
 @contextmanager
 def db_transaction(token: str) -> Generator[psycopg2.extensions.cursor, None, None]:
     """
@@ -46,19 +251,20 @@ def db_transaction(token: str) -> Generator[psycopg2.extensions.cursor, None, No
         HTTPException: If an error occurs during the transaction.
     """
     verify_token(token)  # Verify the token here
-    conn = get_db_connection()
+    pool = get_db_pool()
+    conn = pool.acquire()
     cur = conn.cursor()
     try:
         yield cur  # Yield the cursor to the calling function
-        conn.commit() # Commit transaction if needed
+        conn.commit() # Commit transaction if needed, then run its on_commit callbacks
     except HTTPException as e:
         # If an HTTPException is raised, use the status code and detail from the exception
         conn.rollback()
         raise e
     except Exception as e:
         # If any other exception is raised, return a 500 error with the exception message
-        conn.rollback() # Rollback transaction on error
+        conn.rollback() # Rollback transaction on error, dropping its on_commit callbacks
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         cur.close()
-        conn.close()
+        pool.release(conn)
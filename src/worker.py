@@ -0,0 +1,341 @@
+"""
+Background workers for the job queue in the jobs table.
+
+Each worker process loads the face models once, then claims jobs with
+`FOR UPDATE SKIP LOCKED` and runs them one at a time. Idle workers sleep until an
+enqueued job is announced with NOTIFY, or until `poll_interval` has passed.
+
+    python -m src.worker --processes 2
+"""
+import argparse
+import multiprocessing
+import os
+import select
+import shutil
+import signal
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+import psycopg2
+import toml
+from src.crops import remove_crops
+from src.detection import detection_settings
+from src.image_embedding import BACKFILL_JOB_KIND, backfill_image_embeddings, image_embedding_settings
+from src.pipeline import (DEDUP_ENABLED, DEDUP_PHASH_DISTANCE, SIMILARITY_THRESHOLD,
+                          analyze_image, decode_upload, embed_analysis, find_duplicate, hash_content, load_models, store_analyses, use_face_model)
+from src.reclustering import RECLUSTER_JOB_KIND, recluster_tenant
+from src.reembedding import REEMBED_JOB_KIND, reembed_tenant
+from src.sql import (DELETE_CHUNK_SIZE, sql_claim_job, sql_copy_image, sql_delete_cluster_chunk, sql_delete_tenant_chunk, sql_fail_job,
+                     sql_finish_job, sql_get_face_model, sql_get_image_face_clusters, sql_renew_job_lease, sql_set_job_progress)
+from src.transfer import extract_tar, import_tenant
+from src.utils import get_db_connection
+
+# Load configuration from config.toml
+config = toml.load("config.toml")
+JOBS_CONFIG = config.get("jobs", {})
+JOB_PROCESSES = JOBS_CONFIG.get("processes", 2)
+JOB_POLL_INTERVAL = JOBS_CONFIG.get("poll_interval", 5.0)
+JOB_LEASE_SECONDS = JOBS_CONFIG.get("lease_seconds", 600)
+JOB_MAX_ATTEMPTS = JOBS_CONFIG.get("max_attempts", 3)
+JOB_RETRY_DELAY = JOBS_CONFIG.get("retry_delay", 10.0)
+TRANSFER_LEASE_SECONDS = config.get("transfer", {}).get("lease_seconds", 3600)
+
+@dataclass
+class Job:
+    """
+    A job claimed from the queue.
+
+    Attributes:
+        id (str): The job ID.
+        tenant_id (str): The tenant ID.
+        kind (str): The kind of job.
+        payload (Dict[str, Any]): The arguments of the job.
+        attempts (int): The number of attempts so far, including the current one.
+    """
+    id: str
+    tenant_id: str
+    kind: str
+    payload: Dict[str, Any]
+    attempts: int
+
+def run_insert_image(conn: psycopg2.extensions.connection, job: Job) -> Dict[str, Any]:
+    """
+    Run the insert pipeline on an upload saved by /insert-image-async.
+
+    The image and its faces are written in the transaction that marks the job as
+    done, so a job that fails or is retried never leaves a partial image behind.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, left uncommitted.
+        job (Job): The job, with the image ID, upload path and on_duplicate action in its payload.
+
+    Returns:
+        dict: The image ID and face IDs, and the ID of the existing image if the upload is a duplicate.
+    """
+    image_id = job.payload["image_id"]
+    on_duplicate = job.payload["on_duplicate"]
+    with open(job.payload["path"], "rb") as file:
+        data = file.read()
+
+    content_sha256 = hash_content(data)
+    upload = decode_upload(data, content_sha256)
+    with conn.cursor() as cur:
+        if DEDUP_ENABLED and on_duplicate != "process":
+            duplicate_of = find_duplicate(cur, job.tenant_id, content_sha256, upload.phash if DEDUP_PHASH_DISTANCE > 0 else None, DEDUP_PHASH_DISTANCE)
+            if duplicate_of is not None:
+                if on_duplicate == "return":
+                    # No new image is created, so the saved upload is not needed
+                    os.remove(job.payload["path"])
+                    return {"image_id": duplicate_of, "face_ids": dict(sql_get_image_face_clusters(cur, job.tenant_id, duplicate_of)), "duplicate_of": duplicate_of}
+                faces = sql_copy_image(cur, job.tenant_id, duplicate_of, image_id, content_sha256, upload.phash)
+                return {"image_id": image_id, "face_ids": dict(faces), "duplicate_of": duplicate_of}
+
+    analysis = analyze_image(upload, detection_settings(job.tenant_id), image_embedding_settings(job.tenant_id))
+    embed_analysis(analysis)
+    with conn.cursor() as cur:
+        face_ids = store_analyses(cur, job.tenant_id, [(image_id, analysis)], SIMILARITY_THRESHOLD)[image_id]
+    return {"image_id": image_id, "face_ids": face_ids}
+
+def _run_in_chunks(conn: psycopg2.extensions.connection, job: Job, delete_chunk: Callable[[psycopg2.extensions.cursor], bool]) -> int:
+    """
+    Call `delete_chunk` until it reports that it is done, committing after each chunk
+    so that locks are released and the work done survives a retry.
+
+    Returns:
+        int: The number of chunks.
+    """
+    chunks = 0
+    done = False
+    while not done:
+        with conn.cursor() as cur:
+            done = delete_chunk(cur)
+            sql_renew_job_lease(cur, job.id, JOB_LEASE_SECONDS)
+        conn.commit()
+        chunks += 1
+    return chunks
+
+def run_delete_tenant(conn: psycopg2.extensions.connection, job: Job) -> Dict[str, Any]:
+    """
+    Delete a tenant of the shared partitions in chunks, queued by DELETE /tenant.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each chunk.
+        job (Job): The job.
+
+    Returns:
+        dict: The number of chunks deleted.
+    """
+    chunks = _run_in_chunks(conn, job, lambda cur: sql_delete_tenant_chunk(cur, job.tenant_id, DELETE_CHUNK_SIZE))
+    remove_crops(job.tenant_id)
+    return {"chunks": chunks}
+
+def run_delete_cluster(conn: psycopg2.extensions.connection, job: Job) -> Dict[str, Any]:
+    """
+    Delete a cluster in chunks, queued by DELETE /cluster.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each chunk.
+        job (Job): The job, with the cluster ID in its payload.
+
+    Returns:
+        dict: The cluster ID and the number of chunks deleted.
+    """
+    cluster_id = job.payload["cluster_id"]
+    return {"cluster_id": cluster_id, "chunks": _run_in_chunks(conn, job, lambda cur: sql_delete_cluster_chunk(cur, job.tenant_id, cluster_id, DELETE_CHUNK_SIZE))}
+
+def run_import_tenant(conn: psycopg2.extensions.connection, job: Job) -> Dict[str, Any]:
+    """
+    Load an export archive uploaded to /import-tenant into the job's tenant.
+
+    The import runs in one transaction, committed with the job's result, so the lease
+    is first extended to `[transfer] lease_seconds` for another worker not to start
+    the same import meanwhile.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, left uncommitted.
+        job (Job): The job, with the archive path and whether to use dedicated partitions in its payload.
+
+    Returns:
+        dict: The tenant ID, the number of images and faces imported, and the suffix of the dedicated partitions created, if any.
+    """
+    with conn.cursor() as cur:
+        sql_renew_job_lease(cur, job.id, TRANSFER_LEASE_SECONDS)
+    conn.commit()
+    archive_path = job.payload["path"]
+    export_path = archive_path + ".d"
+    try:
+        with open(archive_path, "rb") as file:
+            extract_tar(file, export_path)
+        result = import_tenant(conn, export_path, job.tenant_id, job.payload["dedicated"])
+    finally:
+        shutil.rmtree(export_path, ignore_errors=True)
+    # Kept until the import succeeds, for retries
+    os.remove(archive_path)
+    return result
+
+def run_backfill_image_embeddings(conn: psycopg2.extensions.connection, job: Job) -> Dict[str, Any]:
+    """
+    Compute the missing whole-image embeddings of the job's tenant, queued by
+    POST /image-embeddings.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each batch.
+        job (Job): The job, with the descriptor and whether to recompute existing embeddings in its payload.
+
+    Returns:
+        dict: The number of images embedded and of images whose upload is missing.
+    """
+    return backfill_image_embeddings(conn, job.tenant_id, job.payload["descriptor"], job.payload["recompute"],
+                                     on_batch=lambda cur: sql_renew_job_lease(cur, job.id, JOB_LEASE_SECONDS))
+
+def run_recluster(conn: psycopg2.extensions.connection, job: Job) -> Dict[str, Any]:
+    """
+    Merge the clusters of the job's tenant whose centroids are close, queued by POST /recluster.
+
+    Loading and comparing the centroids commits nothing on `conn`, whose transaction
+    streams them, so the lease is renewed on a connection of its own meanwhile.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each batch of merges.
+        job (Job): The job, with whether to apply the merges in its payload.
+
+    Returns:
+        dict: The number of clusters, the proposed merges and, when applied, the number of faces moved.
+    """
+    lease_conn = get_db_connection()
+
+    def renew_lease() -> None:
+        with lease_conn.cursor() as cur:
+            sql_renew_job_lease(cur, job.id, JOB_LEASE_SECONDS)
+        lease_conn.commit()
+
+    try:
+        return recluster_tenant(conn, job.tenant_id, apply=job.payload["apply"],
+                                on_batch=lambda cur: sql_renew_job_lease(cur, job.id, JOB_LEASE_SECONDS), on_progress=renew_lease)
+    finally:
+        lease_conn.close()
+
+def run_reembed_faces(conn: psycopg2.extensions.connection, job: Job) -> Dict[str, Any]:
+    """
+    Stage the embeddings of another face model for the faces of the job's tenant,
+    queued by POST /face-embeddings or `python -m src.reembedding queue`. A retry
+    resumes where the failed attempt stopped.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object, committed after each batch.
+        job (Job): The job, with the model name in its payload.
+
+    Returns:
+        dict: The progress once every face with a crop is embedded, see `reembed_tenant`.
+    """
+    def on_batch(cur: psycopg2.extensions.cursor, progress: Dict[str, Any]) -> None:
+        sql_renew_job_lease(cur, job.id, JOB_LEASE_SECONDS)
+        sql_set_job_progress(cur, job.id, progress)
+
+    return reembed_tenant(conn, job.tenant_id, job.payload["model_name"], on_batch=on_batch)
+
+# Handlers by job kind. A handler may commit intermediate progress itself; whatever
+# it leaves uncommitted is committed together with the job's result.
+JOB_HANDLERS: Dict[str, Callable[[psycopg2.extensions.connection, Job], Dict[str, Any]]] = {
+    "insert_image": run_insert_image,
+    "delete_tenant": run_delete_tenant,
+    "delete_cluster": run_delete_cluster,
+    "import_tenant": run_import_tenant,
+    BACKFILL_JOB_KIND: run_backfill_image_embeddings,
+    RECLUSTER_JOB_KIND: run_recluster,
+    REEMBED_JOB_KIND: run_reembed_faces,
+}
+
+def run_job(conn: psycopg2.extensions.connection, job: Job) -> None:
+    """
+    Run a claimed job and record its outcome.
+
+    Args:
+        conn (psycopg2.extensions.connection): Database connection object.
+        job (Job): The job to run.
+    """
+    start = time.perf_counter()
+    try:
+        handler = JOB_HANDLERS.get(job.kind)
+        if handler is None:
+            raise ValueError(f"Unknown job kind {job.kind}")
+        result = handler(conn, job)
+        with conn.cursor() as cur:
+            sql_finish_job(cur, job.id, result)
+        conn.commit()
+        print(f"Job {job.id} ({job.kind}) done in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        conn.rollback()
+        traceback.print_exc()
+        retry_after = JOB_RETRY_DELAY * job.attempts if job.attempts < JOB_MAX_ATTEMPTS else None
+        with conn.cursor() as cur:
+            sql_fail_job(cur, job.id, str(e), retry_after)
+        conn.commit()
+
+def _claim(conn: psycopg2.extensions.connection) -> Optional[Job]:
+    with conn.cursor() as cur:
+        row = sql_claim_job(cur, JOB_LEASE_SECONDS)
+        if row is not None:
+            # Follow a switch to another face model made since the last job
+            use_face_model(sql_get_face_model(cur))
+    conn.commit()
+    return Job(*row) if row is not None else None
+
+def work(stopping: Callable[[], bool]) -> None:
+    """
+    Claim and run jobs until `stopping` returns True. The job in progress is always finished.
+
+    Args:
+        stopping (Callable[[], bool]): Tells the worker to exit once it is idle.
+    """
+    load_models()
+    conn = get_db_connection()
+    # Notifications are only delivered to a connection outside of a transaction
+    listener = get_db_connection()
+    listener.set_session(autocommit=True)
+    try:
+        with listener.cursor() as cur:
+            cur.execute("LISTEN jobs")
+        while not stopping():
+            job = _claim(conn)
+            if job is not None:
+                run_job(conn, job)
+                continue
+            if select.select([listener], [], [], JOB_POLL_INTERVAL) != ([], [], []):
+                listener.poll()
+                listener.notifies.clear()
+    finally:
+        listener.close()
+        conn.close()
+
+def _worker_main() -> None:
+    stop = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.append(signum))
+    print(f"Worker {os.getpid()} started")
+    work(lambda: len(stop) > 0)
+    print(f"Worker {os.getpid()} stopped")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=JOB_PROCESSES, help="Number of worker processes")
+    args = parser.parse_args()
+
+    # Spawned rather than forked, so that every worker initialises TensorFlow itself
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_worker_main, name=f"worker-{i}") for i in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    def stop(signum: int, frame: Any) -> None:
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in processes:
+        process.join()
+
+if __name__ == "__main__":
+    main()